@@ -0,0 +1,23 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import itertools
+import subprocess
+import sys
+
+
+def run_each(module: str, argv: list[str], values_by_option: dict[str, list[str]]) -> None:
+    """
+    Run the benchmark once per combination of the given option values, each in its own process,
+    because settings and metrics are process-wide. The other arguments are passed as they are.
+    """
+    common_args = []
+    is_varied = False
+    for arg in argv:
+        if arg.startswith('--'):
+            is_varied = arg.partition('=')[0] in values_by_option
+        if not is_varied:
+            common_args.append(arg)
+    for values in itertools.product(*values_by_option.values()):
+        option_args = [arg for option, value in zip(values_by_option, values) for arg in (option, value)]
+        subprocess.run([sys.executable, '-m', module, *option_args, *common_args], check=False)
@@ -0,0 +1,108 @@
+"""
+Generates IdP fixtures shaped like `fixtures/ldap_test_data.json` with a realistic team tree.
+
+    python -m benchmarks.fixture_generator --users 10000 --output fixtures/ldap_10k.json
+"""
+import argparse
+import json
+import math
+import random
+from typing import Any, Optional
+
+SEARCH_BASE = 'DC=example,DC=com'
+
+# Presets used by the benchmarks
+SIZES = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '200k': 200_000}
+
+# Users of a leaf team and children of the other teams
+_TEAM_SIZE = 20
+_FAN_OUT = 6
+# Teams at the top of the tree
+_MAX_DIVISIONS = 8
+
+_FIRST_NAMES = ['Min-jun', 'Seo-yeon', 'Ji-ho', 'Ha-eun', 'Do-yun', 'Su-ah', 'John', 'Jane', 'Alice', 'Bob']
+_LAST_NAMES = ['Kim', 'Lee', 'Park', 'Choi', 'Jung', 'Kang', 'Cho', 'Yoon', 'Smith', 'Brown']
+_TITLES = ['Manager', 'Engineer', 'Team Leader', 'Staff']
+_TEAM_WORDS = ['Sales', 'Network', 'Platform', 'Marketing', 'Finance', 'Media', 'Customer', 'Security',
+               'Infra', 'Strategy', 'Data', 'Service']
+_LEVEL_NAMES = ['Division', 'Group', 'Department', 'Team', 'Unit', 'Cell']
+
+
+def generate_fixture(user_count: int, seed: int = 0, team_size: int = _TEAM_SIZE,
+                     user_ous: tuple[str, ...] = ('Users',), group_ous: tuple[str, ...] = ('Groups',),
+                     search_base: str = SEARCH_BASE) -> dict[str, list[dict[str, Any]]]:
+    """
+    Users are spread over leaf teams of about `team_size` users, which are grouped into a tree of up to 8 divisions.
+    Like the real directory, a few users have no mail, no mobile or a title in their display name,
+    some belong to two teams and some team names are duplicated.
+    Users and groups are spread over the given OUs of `search_base`.
+    """
+    rng = random.Random(seed)
+    user_bases = [f"OU={ou},{search_base}" for ou in user_ous]
+    group_bases = [f"OU={ou},{search_base}" for ou in group_ous]
+    users = [_generate_user(i, user_bases[i % len(user_bases)], rng) for i in range(user_count)]
+
+    leaf_count = max(1, math.ceil(user_count / team_size))
+    levels: list[list[dict[str, Any]]] = [[_new_group(i, group_bases) for i in range(leaf_count)]]
+    while len(levels[-1]) > _MAX_DIVISIONS:
+        parent_count = math.ceil(len(levels[-1]) / _FAN_OUT)
+        offset = sum(len(level) for level in levels)
+        levels.append([_new_group(offset + i, group_bases) for i in range(parent_count)])
+
+    # Names count levels from the top. Numbers wrap around so that some names are duplicated
+    for depth, level in enumerate(reversed(levels)):
+        level_name = _LEVEL_NAMES[min(depth, len(_LEVEL_NAMES) - 1)]
+        for group in level:
+            group['displayName'] = f"{rng.choice(_TEAM_WORDS)} {level_name} {rng.randrange(1, 200)}"
+
+    # Link each level to the one above it
+    for children, parents in zip(levels, levels[1:]):
+        for child in children:
+            parent = rng.choice(parents)
+            parent['member'].append(child['distinguishedName'])
+            child['memberOf'].append(parent['distinguishedName'])
+
+    leaves = levels[0]
+    for i, user in enumerate(users):
+        leaves[i % leaf_count]['member'].append(user['distinguishedName'])
+        second_leaf = rng.randrange(leaf_count)
+        if rng.random() < 0.05 and second_leaf != i % leaf_count:
+            leaves[second_leaf]['member'].append(user['distinguishedName'])
+
+    # Parents come after their children in the directory, as they usually do
+    groups = [group for level in levels for group in level]
+    return {'users': users, 'groups': groups}
+
+
+def _generate_user(i: int, base: str, rng: random.Random) -> dict[str, Any]:
+    name = f"{rng.choice(_FIRST_NAMES)} {rng.choice(_LAST_NAMES)} {i:06d}"
+    display_name = f"{name}/{rng.choice(_TITLES)}" if rng.random() < 0.3 else name
+    mobile: Optional[str] = f"+82-10-{rng.randrange(10 ** 4):04d}-{rng.randrange(10 ** 4):04d}" \
+        if rng.random() < 0.8 else None
+    return {
+        'distinguishedName': f"CN={name},{base}",
+        'mail': f"user{i:06d}@example.com" if rng.random() < 0.99 else '',
+        'displayName': display_name,
+        'mobile': mobile
+    }
+
+
+def _new_group(i: int, bases: list[str]) -> dict[str, Any]:
+    return {
+        'distinguishedName': f"CN=G{i:06d},{bases[i % len(bases)]}",
+        'displayName': '',
+        'member': [],
+        'memberOf': []
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate an IdP fixture like fixtures/ldap_test_data.json")
+    parser.add_argument('--users', default='1k', help=f"Number of users or one of {', '.join(SIZES)}")
+    parser.add_argument('--team-size', type=int, default=_TEAM_SIZE, help="Users per team at the bottom of the tree")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+    with open(args.output, 'w') as f:
+        json.dump(generate_fixture(SIZES.get(args.users) or int(args.users), args.seed, args.team_size), f,
+                  ensure_ascii=False, indent=2)
@@ -0,0 +1,145 @@
+"""
+Runs the LDAP import of `idp_data` against an in-process stand-in directory and reports what it took.
+
+    python -m benchmarks.ldap_benchmark --users 10k 200k --team-size 3000 --user-ous 4 --page-size 1000 --profile
+    python -m benchmarks.ldap_benchmark --users 10k --user-ous 8 --latency 0.05 --search-concurrency 1 8
+
+Page sizes, attribute lists and the number of OUs searched at once can be tuned this way without touching
+the real directory.
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+from typing import Any
+
+from benchmarks.common import run_each
+from benchmarks.fixture_generator import SEARCH_BASE, SIZES, generate_fixture
+from benchmarks.stand_in_directory import StandInDirectory
+
+_BIND_USER = 'CN=svc_provisioning,OU=Service Accounts,DC=example,DC=com'
+_BIND_PASSWORD = 'benchmark'
+# Functions shown with --profile
+_PROFILE_LINES = 30
+# See `_measure_search` of idp_data
+_SEARCH_KINDS = ('ou', 'dn', 'range')
+
+
+def _configure_environment(user_ous: tuple[str, ...], group_ous: tuple[str, ...], page_size: int,
+                           search_concurrency: int) -> None:
+    """ATTENTION: Settings are read when `src` is imported, so this must be called before importing it"""
+    os.environ.setdefault('SWIT_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('SWIT_CLIENT_SECRET', 'benchmark')
+    os.environ.setdefault('OPERATION_AUTH_KEY', 'benchmark')
+    os.environ['IS_RUNNING_LOCALLY'] = 'False'
+    os.environ['LDAP_SERVER_DOMAIN'] = 'stand_in_directory'
+    os.environ['LDAP_SERVER_PORT'] = '636'
+    os.environ['LDAP_USER'] = _BIND_USER
+    os.environ['LDAP_PASSWORD'] = _BIND_PASSWORD
+    os.environ['LDAP_SEARCH_BASE'] = SEARCH_BASE
+    os.environ['LDAP_USER_OUS'] = ','.join(user_ous)
+    os.environ['LDAP_GROUP_OUS'] = ','.join(group_ous)
+    os.environ['LDAP_PAGE_SIZE'] = str(page_size)
+    os.environ['LDAP_SEARCH_CONCURRENCY'] = str(search_concurrency)
+    os.environ['LDAP_INCREMENTAL_SYNC'] = 'False'
+
+
+def run_ldap_benchmark(fixture: dict[str, Any], max_value_range: int, latency: float,
+                       profile: bool, profile_output: str) -> dict[str, Any]:
+    from src.core.metrics import ldap_binds, ldap_entries, ldap_search_duration, ldap_searches
+    from src.services.idp_data import import_idp_snapshot
+    from src.services.ldap_connection import LdapSettings, use_stand_in_directory
+
+    setup_start_time = time.perf_counter()
+    ldap_settings = LdapSettings()
+    use_stand_in_directory(StandInDirectory(fixture, ldap_settings.LDAP_USER, ldap_settings.LDAP_PASSWORD,
+                                            max_value_range, latency).connect)
+    setup_time = time.perf_counter() - setup_start_time
+    member_counts = [len(group['member']) for group in fixture['groups']]
+    del fixture
+
+    profiler = cProfile.Profile() if profile else None
+    tracemalloc.start()
+    cpu_start_time = time.process_time()
+    start_time = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    idp = import_idp_snapshot()
+    if profiler:
+        profiler.disable()
+    wall_time = time.perf_counter() - start_time
+    cpu_time = time.process_time() - cpu_start_time
+    peak_traced_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # The stand-in runs in the same process, so serving the entries counts as search time.
+    #  Searches run at once are added up
+    search_time = sum(ldap_search_duration.get_sum(kind=kind) for kind in _SEARCH_KINDS)
+    if profiler:
+        stats = pstats.Stats(profiler, stream=sys.stderr).sort_stats(pstats.SortKey.CUMULATIVE)
+        stats.print_stats(_PROFILE_LINES)
+        if profile_output:
+            stats.dump_stats(profile_output)
+    result = {
+        'search_concurrency': ldap_settings.LDAP_SEARCH_CONCURRENCY,
+        'setup_seconds': round(setup_time, 3),
+        'wall_seconds': round(wall_time, 3),
+        'cpu_seconds': round(cpu_time, 3),
+        'search_seconds': round(search_time, 3),
+        # tracemalloc slows the import down, more so with --profile
+        'peak_traced_mib': round(peak_traced_memory / 2 ** 20, 1),
+        'max_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'binds': int(ldap_binds.get()),
+        'searches': {kind: int(ldap_searches.get(kind=kind)) for kind in _SEARCH_KINDS},
+        'entries': {kind: int(ldap_entries.get(kind=kind)) for kind in _SEARCH_KINDS},
+        'imported_users': len(idp.users),
+        'imported_teams': len(idp.teams),
+        'imported_memberships': sum(len(team.users) for team in idp.teams),
+        'max_group_members': max(member_counts, default=0),
+    }
+    if ldap_settings.LDAP_SEARCH_CONCURRENCY == 1:
+        # Building IdpUser and IdpTeam from the entries. Only known when searches don't overlap
+        result['conversion_seconds'] = round(wall_time - search_time, 3)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the LDAP import against a stand-in directory")
+    parser.add_argument('--users', nargs='+', default=['10k'],
+                        help=f"Numbers of users or presets ({', '.join(SIZES)})")
+    parser.add_argument('--team-size', type=int, default=2000, help="Members of each group at the bottom of the tree")
+    parser.add_argument('--user-ous', type=int, default=1, help="Number of OUs the users are spread over")
+    parser.add_argument('--group-ous', type=int, default=1, help="Number of OUs the groups are spread over")
+    parser.add_argument('--page-size', type=int, default=500, help="LDAP_PAGE_SIZE")
+    parser.add_argument('--search-concurrency', nargs='+', type=int, default=[8],
+                        help="LDAP_SEARCH_CONCURRENCY. Several values are run one after the other")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds each search request to the directory takes")
+    parser.add_argument('--max-value-range', type=int, default=1500,
+                        help="Values of an attribute the directory returns at once, like MaxValRange of AD")
+    parser.add_argument('--profile', action='store_true', help="Print the slowest functions of the import")
+    parser.add_argument('--profile-output', default='', help="Also save the profile to this file for snakeviz etc.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if len(args.users) > 1 or len(args.search_concurrency) > 1:
+        run_each('benchmarks.ldap_benchmark', sys.argv[1:], {
+            '--users': args.users,
+            '--search-concurrency': [str(concurrency) for concurrency in args.search_concurrency]})
+        return
+
+    user_count = SIZES.get(args.users[0]) or int(args.users[0])
+    user_ous = tuple(f"Users{i + 1}" for i in range(args.user_ous))
+    group_ous = tuple(f"Groups{i + 1}" for i in range(args.group_ous))
+    fixture = generate_fixture(user_count, args.seed, args.team_size, user_ous, group_ous)
+    _configure_environment(user_ous, group_ous, args.page_size, args.search_concurrency[0])
+    result = run_ldap_benchmark(fixture, args.max_value_range, args.latency, args.profile, args.profile_output)
+    print(json.dumps({'users': user_count, **result}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
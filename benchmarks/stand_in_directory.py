@@ -0,0 +1,171 @@
+"""
+An in-process stand-in of the Active Directory used by the benchmarks, served with ldap3's MOCK_SYNC strategy.
+"""
+import re
+import time
+import uuid
+from typing import Any, Callable, Optional
+
+from ldap3 import BASE, MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE, MOCK_SYNC, OFFLINE_AD_2012_R2, SUBTREE, \
+    Connection, Server
+from ldap3.utils.dn import parse_dn
+
+from src.services.ldap_dn import parse_dn_key
+
+_USER_OBJECT_CLASSES = ['top', 'person', 'organizationalPerson', 'user']
+_GROUP_OBJECT_CLASSES = ['top', 'group']
+# Attributes AD returns by range when they have too many values
+_RANGED_ATTRIBUTES = ('member',)
+# Assertions on DNs in filters, and the separators in a DN with the spaces around them
+_DN_ASSERTION = re.compile(r'(\(distinguishedName=)([^)]*)\)', re.IGNORECASE)
+_DN_SEPARATOR = re.compile(r'\s*([,=])\s*')
+# Where the DC keeps its invocationId, under the domain
+_NTDS_SETTINGS = 'CN=NTDS Settings,CN=DC1,CN=Servers,CN=Default-First-Site-Name,CN=Sites,CN=Configuration'
+
+
+class StandInDirectory:
+    """
+    A directory filled with the users and groups of a fixture shaped like `fixtures/ldap_test_data.json`.
+    The OUs holding them and the bind user are added as well.
+    Like AD with its MaxValRange policy, at most `max_value_range` values of `member` are returned per entry,
+    as `member;range=0-1499` for instance, and the rest must be asked for with `member;range=1500-*`.
+    Each search request (each page of a paged search) takes `latency` seconds, like a directory far away.
+    Like a DC, every entry has a `uSNChanged` and the rootDSE holds the highest of them,
+    so that changes made with `modify` are imported incrementally.
+    ATTENTION: The AD schema is loaded so that single-valued attributes are returned as values, not lists,
+      like the real directory. Empty values are left out, which AD doesn't store either.
+    """
+    def __init__(self, fixture: dict[str, Any], bind_user: str, bind_password: str,
+                 max_value_range: Optional[int] = None, latency: float = 0.0) -> None:
+        self.server = Server('stand_in_directory', get_info=OFFLINE_AD_2012_R2)  # type: ignore[arg-type]
+        self.max_value_range = max_value_range
+        self.latency = latency
+        self.highest_usn = 0
+        conn = Connection(self.server, user=bind_user, password=bind_password, client_strategy=MOCK_SYNC)
+        conn.strategy.add_entry(bind_user, {'objectClass': _USER_OBJECT_CLASSES, 'userPassword': bind_password})
+        containers: set[str] = set()
+        for entries, object_classes in ((fixture['users'], _USER_OBJECT_CLASSES),
+                                        (fixture['groups'], _GROUP_OBJECT_CLASSES)):
+            for entry in entries:
+                dn = entry['distinguishedName']
+                _add_containers(conn, dn, containers)
+                attributes = {name: value for name, value in entry.items() if value not in (None, '', [])}
+                self.highest_usn += 1
+                conn.strategy.add_entry(dn, {'objectClass': object_classes, **attributes,
+                                             'uSNChanged': self.highest_usn})
+        domain = ','.join(f"{name}={value}" for name, value, _ in parse_dn(bind_user) if name.upper() == 'DC')
+        self.ds_service_name = f"{_NTDS_SETTINGS},{domain}"
+        _add_containers(conn, self.ds_service_name, containers)
+        conn.strategy.add_entry(self.ds_service_name, {'objectClass': ['top', 'nTDSDSA'],
+                                                       'invocationId': uuid.uuid4().bytes})
+        conn.bind()
+        # Kept bound to modify entries
+        self._conn = conn
+
+    def connect(self, user: str, password: str) -> Connection:
+        """Pass this to `use_stand_in_directory`"""
+        conn = Connection(self.server, user=user, password=password, client_strategy=MOCK_SYNC,
+                          auto_range=False, raise_exceptions=True)
+        # ATTENTION: The mock doesn't know ranges or latency, so its search is wrapped for this connection only
+        if self.max_value_range:
+            conn.strategy._execute_search = _serve_by_range(
+                conn.strategy._execute_search, self.max_value_range)
+        if self.latency:
+            conn.strategy._execute_search = _delay(conn.strategy._execute_search, self.latency)
+        conn.search = self._serve_root_dse(conn, _match_dns(conn.search))  # type: ignore[method-assign]
+        return conn
+
+    def modify(self, dn: str, attributes: dict[str, Any]) -> None:
+        """
+        Replace attributes of an entry, which gives it the next USN like on AD.
+        `memberOf` of its members follows `member` without changing their USN, because it's a back link.
+        """
+        if 'member' in attributes:
+            self._conn.search(dn, '(objectClass=*)', BASE, attributes=['member'])
+            assert self._conn.response, f'No entry {dn}'
+            # Members may be spelled differently, like AD may return them
+            members = {parse_dn_key(member): member
+                       for member in self._conn.response[0]['attributes'].get('member', [])}
+            new_members = {parse_dn_key(member): member for member in attributes['member']}
+            for key in members.keys() - new_members.keys():
+                self._conn.modify(members[key], {'memberOf': [(MODIFY_DELETE, [dn])]})
+            for key in new_members.keys() - members.keys():
+                self._conn.modify(new_members[key], {'memberOf': [(MODIFY_ADD, [dn])]})
+        self.highest_usn += 1
+        self._conn.modify(dn, {
+            name: [(MODIFY_REPLACE, value if isinstance(value, list) else [value])]
+            for name, value in {**attributes, 'uSNChanged': self.highest_usn}.items()})
+
+    def restore(self) -> None:
+        """Give the DC a new invocationId, like restoring it from a backup does"""
+        self._conn.modify(self.ds_service_name, {'invocationId': [(MODIFY_REPLACE, [uuid.uuid4().bytes])]})
+
+    def _serve_root_dse(self, conn: Connection, search: Callable[..., bool]) -> Callable[..., bool]:
+        """The mock has no rootDSE, whose attributes aren't in the schema either"""
+        def search_with_root_dse(search_base: str, search_filter: str, search_scope: str = SUBTREE,
+                                 *args: Any, **kwargs: Any) -> bool:
+            if search_base or search_scope != BASE:
+                return search(search_base, search_filter, search_scope, *args, **kwargs)
+            conn.response = [{'type': 'searchResEntry', 'dn': '', 'attributes': {
+                'highestCommittedUSN': self.highest_usn,
+                'dsServiceName': self.ds_service_name
+            }}]
+            conn.result = {'result': 0, 'description': 'success'}
+            return True
+        return search_with_root_dse
+
+
+def _serve_by_range(execute_search: Callable[[dict[str, Any]], Any],
+                    max_value_range: int) -> Callable[[dict[str, Any]], Any]:
+    def execute_ranged_search(request: dict[str, Any]) -> Any:
+        # Low bounds of the ranged attributes requested with a range
+        low_bounds: dict[str, int] = {}
+        attributes = []
+        for attribute in request['attributes']:
+            name, _, value_range = str(attribute).partition(';range=')
+            if value_range and name.lower() in _RANGED_ATTRIBUTES:
+                low_bounds[name.lower()] = int(value_range.partition('-')[0])
+            attributes.append(name)
+        responses, result = execute_search({**request, 'attributes': attributes})
+        for response in responses:
+            for attribute in response['attributes']:
+                name = attribute['type'].lower()
+                if name not in _RANGED_ATTRIBUTES \
+                        or (name not in low_bounds and len(attribute['vals']) <= max_value_range):
+                    continue
+                values = attribute['vals']
+                low = low_bounds.get(name, 0)
+                high = low + max_value_range - 1
+                attribute['vals'] = values[low:high + 1]
+                attribute['type'] += f";range={low}-{'*' if high >= len(values) - 1 else high}"
+        return responses, result
+    return execute_ranged_search
+
+
+def _match_dns(search: Callable[..., bool]) -> Callable[..., bool]:
+    """AD matches DNs in filters whatever their spacing, while the mock only ignores their case"""
+    def search_matching_dns(search_base: str, search_filter: str, *args: Any, **kwargs: Any) -> bool:
+        search_filter = _DN_ASSERTION.sub(lambda match: match[1] + _DN_SEPARATOR.sub(r'\1', match[2]) + ')',
+                                          search_filter)
+        return search(search_base, search_filter, *args, **kwargs)
+    return search_matching_dns
+
+
+def _delay(execute_search: Callable[[dict[str, Any]], Any], latency: float) -> Callable[[dict[str, Any]], Any]:
+    def execute_delayed_search(request: dict[str, Any]) -> Any:
+        time.sleep(latency)
+        return execute_search(request)
+    return execute_delayed_search
+
+
+def _add_containers(conn: Connection, dn: str, containers: set[str]) -> None:
+    """Add the OUs, containers and domain components above an entry, top-down, unless they've been added"""
+    rdns = [f"{name}={value}" for name, value, _ in parse_dn(dn)]
+    for i in range(len(rdns) - 1, 0, -1):
+        container = ','.join(rdns[i:])
+        if container in containers:
+            continue
+        containers.add(container)
+        rdn_type = container.partition('=')[0].upper()
+        object_class = {'OU': 'organizationalUnit', 'CN': 'container'}.get(rdn_type, 'domainDNS')
+        conn.strategy.add_entry(container, {'objectClass': ['top', object_class]})
@@ -0,0 +1,228 @@
+"""
+An in-process stand-in of the Swit API used by the benchmarks, plugged in as an httpx transport.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from typing import Any, Optional
+from urllib.parse import parse_qs
+
+from httpx import BaseTransport, Request, Response
+
+_ROOT_TEAM_ID = 'root'
+_UNASSIGNED_TEAM_ID = 'unassigned'
+_MEMBER_ROLE = 30
+
+
+class StandInSwitApi(BaseTransport):
+    """
+    Keeps an organization in memory and serves the endpoints used by a sync:
+    the user and team listings, team CRUD, team membership and SCIM PATCH (including /Bulk).
+    Every request waits for `latency` seconds (plus up to `jitter`) like a remote server would,
+    and requests beyond `rate_limit` per second are answered with 429 and a Retry-After header.
+    ATTENTION: Requests arrive concurrently from the write executor's threads.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 rate_limit: Optional[float] = None, seed: int = 0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        # Requests by "METHOD endpoint", and those throttled with 429
+        self.calls: Counter[str] = Counter()
+        self.throttled_calls: Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._users: dict[str, dict[str, Any]] = {}
+        # In the order they're listed
+        self._user_list: list[dict[str, Any]] = []
+        self._teams: dict[str, dict[str, Any]] = {}
+        # Case-folded team names, which must be unique on Swit
+        self._team_names: Counter[str] = Counter()
+        self._add_team({'team_id': _ROOT_TEAM_ID, 'team_name': 'Organization', 'parent_id': '', 'users': []})
+        self._add_team({'team_id': _UNASSIGNED_TEAM_ID, 'team_name': 'Unassigned', 'parent_id': _ROOT_TEAM_ID,
+                        'users': []})
+        self._next_team_id = 1
+        # Token bucket of the rate limit
+        self._tokens = rate_limit or 0.0
+        self._refilled_at = time.monotonic()
+
+    def add_users_from_fixture(self, fixture: dict[str, Any], joined_ratio: float = 0.95,
+                               stale_ratio: float = 0.1) -> None:
+        """
+        Add the users of an IdP fixture who have joined Swit (by SSO).
+        `stale_ratio` of them have an outdated name or phone number to be updated by the sync.
+        """
+        for raw_user in fixture['users']:
+            if not raw_user['mail'] or self._rng.random() >= joined_ratio:
+                continue
+            user_id = f"u{len(self._users) + 1}"
+            name = raw_user['displayName'].split('/')[0]
+            tel = raw_user['mobile'] or ''
+            if self._rng.random() < stale_ratio:
+                name, tel = f"{name} (old)", ''
+            user = {
+                'user_id': user_id,
+                'user_name': name,
+                'email': raw_user['mail'],
+                'tel': tel,
+                'timezone': 'Asia/Seoul',
+                'language': 'ko',
+                'is_active': True,
+                'role': _MEMBER_ROLE
+            }
+            self._users[user_id] = user
+            self._user_list.append(user)
+
+    def reset_counts(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.throttled_calls.clear()
+
+    def handle_request(self, request: Request) -> Response:
+        request.read()
+        path = request.url.path.removeprefix('/v1/api').removeprefix('/scim/v2')
+        endpoint = f"{request.method} {'/Users/{id}' if path.startswith('/Users/') else path}"
+        with self._lock:
+            self.calls[endpoint] += 1
+            retry_after = self._take_token()
+            if retry_after is not None:
+                self.throttled_calls[endpoint] += 1
+        if retry_after is not None:
+            return Response(429, headers={'Retry-After': f"{retry_after:.3f}"}, json={'detail': 'Too many requests'})
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._rng.uniform(0, self.jitter))
+
+        body = json.loads(request.content) if request.content else {}
+        with self._lock:
+            if request.method == 'GET' and path == '/organization.user.list':
+                params = parse_qs(request.url.query.decode())
+                return self._list_users(int(params['cnt'][0]), int(params['page'][0]))
+            if request.method == 'GET' and path == '/user.team.list':
+                return self._list_teams()
+            if request.method == 'POST' and path == '/team.create':
+                return self._create_team(body)
+            if request.method == 'POST' and path == '/team.update':
+                return self._update_team(body)
+            if request.method == 'POST' and path == '/team.delete':
+                return self._delete_team(body)
+            if request.method == 'POST' and path in ('/team.user.add', '/team.user.remove'):
+                return self._update_members(body, is_add=path == '/team.user.add')
+            if request.method == 'PATCH' and path.startswith('/Users/'):
+                return self._patch_user(path.removeprefix('/Users/'), body)
+            if request.method == 'POST' and path == '/Bulk':
+                return self._bulk(body)
+        return Response(404, json={'detail': f"Unknown endpoint {endpoint}"})
+
+    def _take_token(self) -> Optional[float]:
+        """Returns how long to wait if the rate limit is exceeded"""
+        if not self.rate_limit:
+            return None
+        now = time.monotonic()
+        self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate_limit
+        self._tokens -= 1
+        return None
+
+    def _list_users(self, count: int, page: int) -> Response:
+        users = self._user_list[(page - 1) * count:page * count]
+        return Response(200, json={'data': {'users': users}})
+
+    def _list_teams(self) -> Response:
+        teams = []
+        for team in self._teams.values():
+            depth = 0
+            parent_id = team['parent_id']
+            while parent_id in self._teams:
+                depth += 1
+                parent_id = self._teams[parent_id]['parent_id']
+            teams.append({**team, 'depth': depth})
+        return Response(200, json={'data': {'team': teams}})
+
+    def _create_team(self, body: dict[str, Any]) -> Response:
+        if self._is_name_taken(body['name']):
+            return Response(400, json={'detail': 'Duplicate team name'})
+        if body['parent_id'] not in self._teams:
+            return Response(400, json={'detail': 'Parent team not found'})
+        team_id = f"t{self._next_team_id}"
+        self._next_team_id += 1
+        team = {'team_id': team_id, 'team_name': body['name'], 'parent_id': body['parent_id'], 'users': []}
+        if body.get('reference'):
+            team['reference'] = body['reference']
+        self._add_team(team)
+        return Response(200, json={'data': team})
+
+    def _update_team(self, body: dict[str, Any]) -> Response:
+        team = self._teams.get(body['id'])
+        if team is None:
+            return Response(404, json={'detail': 'Team not found'})
+        if 'name' in body:
+            if body['name'].casefold() != team['team_name'].casefold() and self._is_name_taken(body['name']):
+                return Response(400, json={'detail': 'Duplicate team name'})
+            self._team_names[team['team_name'].casefold()] -= 1
+            self._team_names[body['name'].casefold()] += 1
+            team['team_name'] = body['name']
+        if 'parent_id' in body:
+            if body['parent_id'] not in self._teams:
+                return Response(400, json={'detail': 'Parent team not found'})
+            team['parent_id'] = body['parent_id']
+        return Response(200, json={'data': team})
+
+    def _delete_team(self, body: dict[str, Any]) -> Response:
+        deleted_team = self._teams.pop(body['id'], None)
+        if deleted_team is None:
+            return Response(404, json={'detail': 'Team not found'})
+        self._team_names[deleted_team['team_name'].casefold()] -= 1
+        # Children of a deleted team move up to the root team
+        for team in self._teams.values():
+            if team['parent_id'] == body['id']:
+                team['parent_id'] = _ROOT_TEAM_ID
+        return Response(200, json={})
+
+    def _update_members(self, body: dict[str, Any], is_add: bool) -> Response:
+        team = self._teams.get(body['id'])
+        if team is None:
+            return Response(404, json={'detail': 'Team not found'})
+        if is_add:
+            team['users'] = team['users'] + [user_id for user_id in body['user_ids']
+                                             if user_id in self._users and user_id not in team['users']]
+        else:
+            user_ids = set(body['user_ids'])
+            team['users'] = [user_id for user_id in team['users'] if user_id not in user_ids]
+        return Response(200, json={})
+
+    def _patch_user(self, user_id: str, body: dict[str, Any]) -> Response:
+        user = self._users.get(user_id)
+        if user is None:
+            return Response(404, json={'detail': 'User not found'})
+        for operation in body['Operations']:
+            if operation['path'] == 'displayName':
+                user['user_name'] = operation['value']
+            else:
+                user['tel'] = operation['value']
+        return Response(200, json={'id': user_id})
+
+    def _bulk(self, body: dict[str, Any]) -> Response:
+        results = []
+        for operation in body['Operations']:
+            res = self._patch_user(operation['path'].removeprefix('/Users/'), operation['data'])
+            results.append({
+                'method': operation['method'],
+                'bulkId': operation['bulkId'],
+                'status': str(res.status_code),
+                'response': res.json()
+            })
+        return Response(200, json={
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:BulkResponse'],
+            'Operations': results
+        })
+
+    def _add_team(self, team: dict[str, Any]) -> None:
+        self._teams[team['team_id']] = team
+        self._team_names[team['team_name'].casefold()] += 1
+
+    def _is_name_taken(self, name: str) -> bool:
+        return self._team_names[name.casefold()] > 0
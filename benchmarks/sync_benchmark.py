@@ -0,0 +1,121 @@
+"""
+Runs `sync_to_swit` end to end against the stand-in Swit API and reports what it took.
+
+    python -m benchmarks.sync_benchmark --users 1k 10k --runs 2 --latency 0.05
+
+Each size is run in a fresh temporary directory (so a fresh database) with a generated fixture.
+The first run creates every team; later runs show the steady state of an unchanged directory.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from benchmarks.common import run_each
+from benchmarks.fixture_generator import SIZES, generate_fixture
+from benchmarks.stand_in_swit import StandInSwitApi
+
+
+def _configure_environment(fixture_path: str, client_rate: float) -> None:
+    """ATTENTION: Settings are read when `src` is imported, so this must be called before importing it"""
+    os.environ.setdefault('SWIT_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('SWIT_CLIENT_SECRET', 'benchmark')
+    os.environ.setdefault('OPERATION_AUTH_KEY', 'benchmark')
+    os.environ['IS_RUNNING_LOCALLY'] = 'True'
+    os.environ['LOCAL_IDP_FIXTURE_PATH'] = fixture_path
+    os.environ['SWIT_API_RATE_LIMIT'] = str(client_rate)
+    os.environ['SWIT_API_MAX_RATE_LIMIT'] = str(client_rate)
+    os.environ['SWIT_WEBHOOK_URL'] = ''
+    os.environ['SYNC_REPORT_DIR'] = ''
+
+
+def run_sync_benchmark(stand_in: StandInSwitApi, runs: int, trace_memory: bool) -> list[dict[str, Any]]:
+    """Run the sync `runs` times in the current directory and measure each run"""
+    from src.core.http import shared_transport
+    from src.core.metrics import sync_runs
+    from src.database import close_db, init_db
+    from src.services.data_sync import sync_to_swit
+    from src.services.swit_oauth import token_manager
+    from src.services.swit_schemas import SwitTokens
+
+    init_db()
+    shared_transport.replace_pool(stand_in)
+    token_manager.set_tokens(SwitTokens(access_token='benchmark', refresh_token='benchmark',
+                                        expires_at=datetime.now(timezone.utc) + timedelta(days=1)))
+    results = []
+    for run in range(1, runs + 1):
+        stand_in.reset_counts()
+        failure_count = sync_runs.get(result='failure')
+        if trace_memory:
+            tracemalloc.start()
+        cpu_start_time = time.process_time()
+        start_time = time.perf_counter()
+        sync_to_swit()
+        wall_time = time.perf_counter() - start_time
+        cpu_time = time.process_time() - cpu_start_time
+        result: dict[str, Any] = {
+            'run': run,
+            'succeeded': sync_runs.get(result='failure') == failure_count,
+            'wall_seconds': round(wall_time, 3),
+            # Includes the stand-in, which runs in the same process
+            'cpu_seconds': round(cpu_time, 3),
+            # The peak of the whole process so far, in MiB (ru_maxrss is in KiB on Linux)
+            'max_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'api_calls': dict(sorted(stand_in.calls.items())),
+            'throttled_calls': dict(sorted(stand_in.throttled_calls.items())),
+        }
+        if trace_memory:
+            result['peak_traced_mib'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            tracemalloc.stop()
+        results.append(result)
+    close_db()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark a sync against a stand-in Swit API")
+    parser.add_argument('--users', nargs='+', default=['1k'],
+                        help=f"Numbers of users or presets ({', '.join(SIZES)})")
+    parser.add_argument('--runs', type=int, default=2, help="Syncs per size. Runs after the first are steady-state")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds each API request takes")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many seconds added to the latency")
+    parser.add_argument('--server-rate-limit', type=float, default=None,
+                        help="Requests per second the stand-in accepts before answering 429")
+    parser.add_argument('--client-rate', type=float, default=1000.0,
+                        help="SWIT_API_RATE_LIMIT and SWIT_API_MAX_RATE_LIMIT of the client")
+    parser.add_argument('--stale-ratio', type=float, default=0.1, help="Ratio of Swit users to be updated")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Measure the peak of Python allocations with tracemalloc, which slows the run down")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if len(args.users) > 1:
+        run_each('benchmarks.sync_benchmark', sys.argv[1:], {'--users': args.users})
+        return
+
+    user_count = SIZES.get(args.users[0]) or int(args.users[0])
+    with tempfile.TemporaryDirectory(prefix='sync_benchmark_') as work_dir:
+        fixture = generate_fixture(user_count, args.seed)
+        fixture_path = os.path.join(work_dir, 'ldap_test_data.json')
+        with open(fixture_path, 'w') as f:
+            json.dump(fixture, f)
+        stand_in = StandInSwitApi(latency=args.latency, jitter=args.jitter,
+                                  rate_limit=args.server_rate_limit, seed=args.seed)
+        stand_in.add_users_from_fixture(fixture, stale_ratio=args.stale_ratio)
+        del fixture
+
+        _configure_environment(fixture_path, args.client_rate)
+        # The database and the sync reports are created in the current directory
+        os.chdir(work_dir)
+        results = run_sync_benchmark(stand_in, args.runs, args.trace_memory)
+    print(json.dumps({'users': user_count, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,24 @@
+import argparse
+
 from werkzeug.serving import is_running_from_reloader
 
 from src.app import create_app
 from src.core.constants import settings
+from src.core.http import close_http_pool
+from src.database import close_db
+from src.services.data_sync import plan_sync_to_swit
 from src.services.provision_manager import provisioner
 from src.services.scheduler import scheduler
 
 app = create_app()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Print the changes a sync would make as JSON without applying them")
+    if parser.parse_args().dry_run:
+        print(plan_sync_to_swit().model_dump_json(indent=2))
+        raise SystemExit(0)
     try:
         if not is_running_from_reloader():
             scheduler.initialize()
@@ -20,3 +31,5 @@ if __name__ == "__main__":
         )
     finally:
         scheduler.stop()
+        close_http_pool()
+        close_db()
@@ -1,5 +1,6 @@
 from typing import Optional
 
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -11,6 +12,7 @@ class Settings(BaseSettings):
     )
 
     IS_RUNNING_LOCALLY: bool = False
+    LOCAL_IDP_FIXTURE_PATH: str = 'fixtures/ldap_test_data.json'  # Read instead of the IdP when running locally
     SWIT_CLIENT_ID: str
     SWIT_CLIENT_SECRET: str
     OPERATION_AUTH_KEY: str
@@ -19,18 +21,52 @@ class Settings(BaseSettings):
 
     # In case of using a daily scheduler
     SCHEDULE_TIME: Optional[str] = None  # example: '20:00'. If you don't want to use scheduler, set None.
+    SCHEDULE_INTERVAL_MINUTES: Optional[int] = None  # example: 10. Useful with LDAP_INCREMENTAL_SYNC
 
     # New user's default settings
     DEFAULT_USER_LANGUAGE: str = 'en'
 
     # Logger
     SWIT_WEBHOOK_URL: Optional[str] = None
+    SWIT_WEBHOOK_QUEUE_SIZE: int = 10000  # Log records waiting to be sent. More are dropped
+
+    # For HTTP connections shared by the API client, OAuth and the webhook logger
+    HTTP_MAX_CONNECTIONS: int = 20
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    HTTP_KEEPALIVE_EXPIRY_SECONDS: float = 30.0
+    HTTP_TIMEOUT_SECONDS: float = 10.0
+    HTTP2_ENABLED: bool = True  # Only if the optional h2 package is installed
 
     # For API
     SWIT_BASE_URL: str = 'https://openapi.swit.io'
+    SWIT_API_RATE_LIMIT: float = 5.0  # Requests per second to start with, shared by all API clients
+    SWIT_API_MAX_RATE_LIMIT: float = 20.0  # The rate grows up to this value while no 429 is returned
+    SWIT_API_MAX_RETRIES: int = 5  # For 429, 5xx and timeouts
+    SWIT_TOKEN_REFRESH_MARGIN_SECONDS: int = 300  # Access tokens are refreshed this long before they expire
+    SWIT_READ_CONCURRENCY: int = 4  # Number of pages of a listing requested at once
+    SCIM_BULK_MAX_OPERATIONS: int = 100  # Users updated per SCIM /Bulk request. 1 disables /Bulk
+    SWIT_ASYNC_MAX_IN_FLIGHT: int = 16  # Requests in flight at once with SWIT_ASYNC_SYNC
 
     # For provisioning
     TEAMS_TO_EXCLUDE: str = ''
+    # Upload thumbnailPhoto or jpegPhoto of the IdP users as their Swit profile photos, when they change
+    SYNC_PROFILE_PHOTOS: bool = False
+    # The Swit API endpoint taking the photo as a multipart file. Required with SYNC_PROFILE_PHOTOS
+    SWIT_PROFILE_PHOTO_PATH: Optional[str] = None
+    SWIT_WRITE_CONCURRENCY: int = 4  # Number of Swit API write calls in flight at once
+    SWIT_ASYNC_SYNC: bool = False  # Apply changes with asyncio and HTTP/2 instead of the write executor
+    # Users and teams unchanged since they were last applied are compared against Swit only at this interval
+    FULL_RECONCILIATION_INTERVAL_HOURS: int = 24
+    # Every change of a run is written to a JSONL file in this directory. Leave empty not to keep them
+    SYNC_REPORT_DIR: str = 'sync_reports'
+    SYNC_REPORT_RETENTION_COUNT: int = 30  # Number of the latest reports kept. 0 keeps all of them
+
+    @model_validator(mode='after')
+    def _check_profile_photo_path(self) -> 'Settings':
+        """Photos must not be sent to an endpoint that isn't known to take them"""
+        if self.SYNC_PROFILE_PHOTOS and not self.SWIT_PROFILE_PHOTO_PATH:
+            raise ValueError("SWIT_PROFILE_PHOTO_PATH must be set to sync profile photos")
+        return self
 
 
 settings = Settings()
@@ -0,0 +1,67 @@
+"""
+A process-wide HTTP connection pool shared by every client, so that connections are kept alive between calls.
+"""
+import importlib.util
+import threading
+from typing import Optional
+
+from httpx import BaseTransport, Client, HTTPTransport, Limits, Request, Response
+
+from src.core.constants import settings
+
+
+def is_http2_available() -> bool:
+    """HTTP/2 needs the optional `h2` package"""
+    return settings.HTTP2_ENABLED and importlib.util.find_spec('h2') is not None
+
+
+class _SharedTransport(BaseTransport):
+    """
+    Sends requests through the shared pool.
+    ATTENTION: Closing a client closes its transport, so closing this one is a no-op.
+      The pool itself is closed by `close_http_pool` on shutdown.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pool: Optional[BaseTransport] = None
+
+    def handle_request(self, request: Request) -> Response:
+        return self._get_pool().handle_request(request)
+
+    def close(self) -> None:
+        pass
+
+    def close_pool(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool:
+            pool.close()
+
+    def replace_pool(self, transport: BaseTransport) -> None:
+        """Send every request through `transport` instead of the network, e.g. to a stand-in of the Swit API"""
+        self.close_pool()
+        with self._lock:
+            self._pool = transport
+
+    def _get_pool(self) -> BaseTransport:
+        with self._lock:
+            if self._pool is None:
+                self._pool = HTTPTransport(
+                    http2=is_http2_available(),
+                    limits=Limits(
+                        max_connections=settings.HTTP_MAX_CONNECTIONS,
+                        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY_SECONDS
+                    ))
+            return self._pool
+
+
+shared_transport = _SharedTransport()
+
+# For one-off requests such as OAuth and webhooks
+http_client = Client(transport=shared_transport, timeout=settings.HTTP_TIMEOUT_SECONDS)
+
+
+def close_http_pool() -> None:
+    """Close the kept-alive connections. Call this on shutdown"""
+    shared_transport.close_pool()
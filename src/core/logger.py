@@ -1,34 +1,126 @@
 import logging
-from logging.handlers import BufferingHandler
-
-from httpx import Client
+import queue
+import random
+import threading
+import time
+from typing import Optional
 
 from src.core.constants import settings
+from src.core.http import http_client
+
+# Swit webhook has a limit of 12,000 characters per message
+_WEBHOOK_MESSAGE_MAX_LENGTH = 6000
+_WEBHOOK_MAX_ATTEMPTS = 4
+_WEBHOOK_BACKOFF_BASE_SECONDS = 1.0
+_WEBHOOK_DRAIN_TIMEOUT_SECONDS = 10.0
 
+# Control messages of the shipper thread
+_FLUSH = object()
+_STOP = object()
 
-class SwitWebhookBufferingHandler(BufferingHandler):
-    """ Add a webhook sender to the logger """
-    def __init__(self, capacity: int = 999) -> None:
-        super().__init__(capacity)
+
+class SwitWebhookBufferingHandler(logging.Handler):
+    """
+    Add a webhook sender to the logger
+    ATTENTION: Logging must never block the caller, so records are only queued here.
+      A background thread batches them into messages that fit the webhook limit and sends them.
+      When the queue is full, records are dropped and the number dropped is reported in the next message.
+    """
+    def __init__(self, queue_size: Optional[int] = None) -> None:
+        super().__init__()
+        self._queue: queue.Queue[object] = queue.Queue(maxsize=queue_size or settings.SWIT_WEBHOOK_QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._dropped_count = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            message = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            with self._thread_lock:
+                self._dropped_count += 1
 
     def flush(self) -> None:
-        if not self.buffer:
+        """Send what has been logged so far without waiting for it"""
+        if self._thread is None:
             return
-        messages = [self.format(record) for record in self.buffer]
-        if settings.SWIT_WEBHOOK_URL:
-            payload = {"text": "\n".join(messages)}
-            with Client() as client:
-                client.post(settings.SWIT_WEBHOOK_URL, json=payload, timeout=10)
-        else:
+        try:
+            self._queue.put_nowait(_FLUSH)
+        except queue.Full:
+            # The shipper is busy and sends full batches anyway
+            pass
+
+    def close(self) -> None:
+        """Drain the queue, waiting up to a few seconds"""
+        with self._thread_lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=_WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+                thread.join(_WEBHOOK_DRAIN_TIMEOUT_SECONDS)
+            except queue.Full:
+                pass
+        super().close()
+
+    def _start(self) -> None:
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._ship, name='swit_webhook_shipper', daemon=True)
+                self._thread.start()
+
+    def _ship(self) -> None:
+        batch: list[str] = []
+        # Running length of the batch joined with newlines
+        batch_length = 0
+        while True:
+            item = self._queue.get()
+            if isinstance(item, str):
+                for chunk in _split(item):
+                    if batch and batch_length + 1 + len(chunk) > _WEBHOOK_MESSAGE_MAX_LENGTH:
+                        self._send(batch)
+                        batch, batch_length = [], 0
+                    batch_length += len(chunk) + (1 if batch else 0)
+                    batch.append(chunk)
+                continue
+            with self._thread_lock:
+                dropped_count, self._dropped_count = self._dropped_count, 0
+            if dropped_count:
+                batch.append(f"... {dropped_count} log messages were dropped because the log queue was full")
+            if batch:
+                self._send(batch)
+                batch, batch_length = [], 0
+            if item is _STOP:
+                return
+
+    @staticmethod
+    def _send(messages: list[str]) -> None:
+        if not settings.SWIT_WEBHOOK_URL:
             print(messages)
-        self.buffer.clear()
-
-    def shouldFlush(self, record: logging.LogRecord) -> bool:
-        """Swit webhook has a limit of 12,000 characters per message, so we flush"""
-        messages = "\n".join([self.format(record) for record in self.buffer])
-        if len(messages) >= 6000:
-            return True
-        return False
+            return
+        payload = {"text": "\n".join(messages)}
+        for attempt in range(_WEBHOOK_MAX_ATTEMPTS):
+            try:
+                res = http_client.post(settings.SWIT_WEBHOOK_URL, json=payload)
+                if res.is_success or (res.is_client_error and res.status_code != 429):
+                    return
+            except Exception:
+                pass
+            time.sleep(random.uniform(0, _WEBHOOK_BACKOFF_BASE_SECONDS * 2 ** attempt))
+        print(f"Failed to send {len(messages)} log messages to the webhook")
+
+
+def _split(message: str) -> list[str]:
+    """Split a message longer than the webhook limit"""
+    return [message[i:i + _WEBHOOK_MESSAGE_MAX_LENGTH]
+            for i in range(0, len(message), _WEBHOOK_MESSAGE_MAX_LENGTH)] or ['']
 
 
 # Create a logger
@@ -0,0 +1,152 @@
+"""
+In-process metrics exposed in the Prometheus text format at /metrics.
+"""
+import bisect
+import threading
+from typing import Iterable, Optional
+
+# Upper bounds of the histogram buckets in seconds
+_HTTP_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_LDAP_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+LabelValues = tuple[str, ...]
+
+
+class _Metric:
+    """
+    A metric family with a fixed set of label names.
+    ATTENTION: Values are updated from the write executor's threads and the asyncio loop, hence the lock.
+      Keep label values bounded (endpoints, not URLs) so that the number of series stays small.
+    """
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def expose(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    def _get_label_values(self, labels: dict[str, str]) -> LabelValues:
+        assert set(labels) == set(self.label_names), f"{self.name} takes labels {self.label_names}"
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def _format_labels(self, label_values: LabelValues, extra: Optional[tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.label_names, label_values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def expose(self) -> list[str]:
+        lines = super().expose()
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{self._format_labels(label_values)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Iterable[str] = (),
+                 buckets: tuple[float, ...] = _HTTP_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self._buckets = buckets
+        # Per label values: non-cumulative counts of each bucket (the last one is +Inf), sum
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            counts = self._counts.setdefault(label_values, [0] * (len(self._buckets) + 1))
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._sums[label_values] = self._sums.get(label_values, 0.0) + value
+
+    def get_sum(self, **labels: str) -> float:
+        label_values = self._get_label_values(labels)
+        with self._lock:
+            return self._sums.get(label_values, 0.0)
+
+    def expose(self) -> list[str]:
+        lines = super().expose()
+        with self._lock:
+            for label_values, counts in sorted(self._counts.items()):
+                cumulative_count = 0
+                for upper_bound, count in zip((*map(_format_value, self._buckets), '+Inf'), counts):
+                    cumulative_count += count
+                    lines.append(f"{self.name}_bucket{self._format_labels(label_values, ('le', upper_bound))} "
+                                 f"{cumulative_count}")
+                lines.append(f"{self.name}_sum{self._format_labels(label_values)} "
+                             f"{_format_value(self._sums[label_values])}")
+                lines.append(f"{self.name}_count{self._format_labels(label_values)} {cumulative_count}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+swit_api_requests = Counter(
+    'swit_api_requests_total', 'Requests sent to the Swit API, including retried attempts',
+    ('method', 'endpoint', 'status'))
+swit_api_request_duration = Histogram(
+    'swit_api_request_duration_seconds', 'Latency of the Swit API', ('method', 'endpoint'))
+swit_api_retries = Counter(
+    'swit_api_retries_total', 'Requests to the Swit API retried, by reason (timeout, 401, 429, 5xx)', ('reason',))
+ldap_binds = Counter('ldap_binds_total', 'Connections bound to the LDAP server')
+ldap_searches = Counter('ldap_searches_total', 'LDAP searches', ('kind',))
+ldap_entries = Counter('ldap_entries_total', 'Entries returned by LDAP searches', ('kind',))
+ldap_search_duration = Histogram(
+    'ldap_search_duration_seconds', 'Duration of LDAP searches including paging', ('kind',), _LDAP_BUCKETS)
+sync_runs = Counter('sync_runs_total', 'Sync runs, by result (success, failure)', ('result',))
+sync_phase_duration = Gauge(
+    'sync_phase_duration_seconds', 'Duration of each phase in the last sync run', ('phase',))
+sync_entities = Counter(
+    'sync_entities_total', 'Users and teams written to Swit, by operation and result', ('operation', 'result'))
+
+_registry: list[_Metric] = [
+    swit_api_requests, swit_api_request_duration, swit_api_retries,
+    ldap_binds, ldap_searches, ldap_entries, ldap_search_duration,
+    sync_runs, sync_phase_duration, sync_entities,
+]
+
+
+def expose_metrics() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    return '\n'.join(line for metric in _registry for line in metric.expose()) + '\n'
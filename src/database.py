@@ -1,19 +1,49 @@
+import json
 import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
 
-from src.services.swit_schemas import SwitTokens
+from src.services.swit_schemas import SwitTokens, AppliedSwitUser, AppliedSwitTeam, LdapWatermark
 
 _DB_NAME = 'service_accounts.db'
 _TABLE_NAME = 'service_accounts'
 _SERVICE_ACCOUNT = 'service_account'
+_LDAP_WATERMARK_TABLE_NAME = 'ldap_watermarks'
+_LDAP_DIRECTORY = 'ldap'
+_APPLIED_USER_TABLE_NAME = 'applied_users'
+_APPLIED_TEAM_TABLE_NAME = 'applied_teams'
+_APPLIED_PHOTO_TABLE_NAME = 'applied_photos'
+_FAILED_ENTRY_TABLE_NAME = 'failed_entries'
+_SYNC_STATE_TABLE_NAME = 'sync_state'
+_LAST_FULL_RECONCILIATION = 'last_full_reconciliation_at'
 
 
-def _get_db() -> sqlite3.Connection:
-    return sqlite3.connect(_DB_NAME)
+_db_lock = threading.RLock()
+_db: Optional[sqlite3.Connection] = None
 
 
-def close_db(db: sqlite3.Connection) -> None:
-    if db is not None:
-        db.close()
+@contextmanager
+def _get_db() -> Iterator[sqlite3.Connection]:
+    """
+    All calls share one persistent connection, used by one thread at a time.
+    The transaction is committed on exit, or rolled back on an exception.
+    """
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = sqlite3.connect(_DB_NAME, check_same_thread=False)
+        with _db:
+            yield _db
+
+
+def close_db() -> None:
+    global _db
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+            _db = None
 
 
 def init_db() -> None:
@@ -24,31 +54,245 @@ def init_db() -> None:
             username VARCHAR(30) PRIMARY KEY,
             access_token TEXT NOT NULL,
             refresh_token TEXT NOT NULL,
+            expires_at TIMESTAMP,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         ''')
+        # ATTENTION: Databases created before tokens had an expiry lack the column
+        service_account_columns = {row[1] for row in c.execute(f"PRAGMA table_info({_TABLE_NAME})")}
+        if 'expires_at' not in service_account_columns:
+            c.execute(f"ALTER TABLE {_TABLE_NAME} ADD COLUMN expires_at TIMESTAMP")
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {_LDAP_WATERMARK_TABLE_NAME} (
+            directory VARCHAR(30) PRIMARY KEY,
+            invocation_id TEXT NOT NULL,
+            highest_usn INTEGER NOT NULL,
+            last_full_scan_at TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {_APPLIED_USER_TABLE_NAME} (
+            ref_id TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            swit_user_id VARCHAR(30),
+            name TEXT NOT NULL,
+            phone_number TEXT NOT NULL,
+            content_hash VARCHAR(64) NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {_APPLIED_TEAM_TABLE_NAME} (
+            ref_id TEXT PRIMARY KEY,
+            swit_team_id VARCHAR(30) NOT NULL,
+            name TEXT NOT NULL,
+            parent_ref_id TEXT,
+            member_emails TEXT NOT NULL,
+            content_hash VARCHAR(64) NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {_APPLIED_PHOTO_TABLE_NAME} (
+            ref_id TEXT PRIMARY KEY,
+            content_hash VARCHAR(64) NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {_FAILED_ENTRY_TABLE_NAME} (
+            ref_id TEXT PRIMARY KEY,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        c.execute(f'''
+        CREATE TABLE IF NOT EXISTS {_SYNC_STATE_TABLE_NAME} (
+            key VARCHAR(30) PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
 
 
 def upsert_service_account(tokens: SwitTokens) -> None:
     with _get_db() as db:
         c = db.cursor()
         c.execute(f'''
-        INSERT INTO {_TABLE_NAME} (username, access_token, refresh_token)
-        VALUES (?, ?, ?)
+        INSERT INTO {_TABLE_NAME} (username, access_token, refresh_token, expires_at)
+        VALUES (?, ?, ?, ?)
         ON CONFLICT(username) DO UPDATE
         SET access_token = EXCLUDED.access_token,
             refresh_token = EXCLUDED.refresh_token,
+            expires_at = EXCLUDED.expires_at,
             updated_at = CURRENT_TIMESTAMP
         ''', (
-            _SERVICE_ACCOUNT, tokens.access_token, tokens.refresh_token))
+            _SERVICE_ACCOUNT, tokens.access_token, tokens.refresh_token,
+            tokens.expires_at.isoformat() if tokens.expires_at else None))
 
 
 def get_service_account() -> SwitTokens:
     with _get_db() as db:
         c = db.cursor()
-        c.execute(f"SELECT access_token, refresh_token FROM {_TABLE_NAME} WHERE username = '{_SERVICE_ACCOUNT}'")
+        c.execute(f"SELECT access_token, refresh_token, expires_at FROM {_TABLE_NAME} "
+                  f"WHERE username = '{_SERVICE_ACCOUNT}'")
         res = c.fetchone()
     if not res:
         raise Exception("Service account not found")
-    return SwitTokens(access_token=res[0], refresh_token=res[1])
+    return SwitTokens(access_token=res[0], refresh_token=res[1],
+                      expires_at=datetime.fromisoformat(res[2]) if res[2] else None)
+
+
+def upsert_ldap_watermark(watermark: LdapWatermark) -> None:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f'''
+        INSERT INTO {_LDAP_WATERMARK_TABLE_NAME} (directory, invocation_id, highest_usn, last_full_scan_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(directory) DO UPDATE
+        SET invocation_id = EXCLUDED.invocation_id,
+            highest_usn = EXCLUDED.highest_usn,
+            last_full_scan_at = EXCLUDED.last_full_scan_at,
+            updated_at = CURRENT_TIMESTAMP
+        ''', (
+            _LDAP_DIRECTORY, watermark.invocation_id, watermark.highest_usn,
+            watermark.last_full_scan_at.isoformat()))
+
+
+def get_ldap_watermark() -> Optional[LdapWatermark]:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f"SELECT invocation_id, highest_usn, last_full_scan_at FROM {_LDAP_WATERMARK_TABLE_NAME} "
+                  f"WHERE directory = '{_LDAP_DIRECTORY}'")
+        res = c.fetchone()
+    if not res:
+        return None
+    return LdapWatermark(invocation_id=res[0], highest_usn=res[1], last_full_scan_at=res[2])
+
+
+def upsert_applied_users(users: Iterable[AppliedSwitUser]) -> None:
+    with _get_db() as db:
+        c = db.cursor()
+        c.executemany(f'''
+        INSERT INTO {_APPLIED_USER_TABLE_NAME} (ref_id, email, swit_user_id, name, phone_number, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(ref_id) DO UPDATE
+        SET email = EXCLUDED.email,
+            swit_user_id = EXCLUDED.swit_user_id,
+            name = EXCLUDED.name,
+            phone_number = EXCLUDED.phone_number,
+            content_hash = EXCLUDED.content_hash,
+            updated_at = CURRENT_TIMESTAMP
+        ''', [(
+            user.ref_id, user.email, user.swit_user_id, user.name, user.phone_number, user.content_hash
+        ) for user in users])
+
+
+def get_applied_users() -> dict[str, AppliedSwitUser]:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f"SELECT ref_id, email, swit_user_id, name, phone_number, content_hash "
+                  f"FROM {_APPLIED_USER_TABLE_NAME}")
+        rows = c.fetchall()
+    return {row[0]: AppliedSwitUser(
+        ref_id=row[0], email=row[1], swit_user_id=row[2], name=row[3], phone_number=row[4], content_hash=row[5]
+    ) for row in rows}
+
+
+def upsert_applied_teams(teams: Iterable[AppliedSwitTeam]) -> None:
+    with _get_db() as db:
+        c = db.cursor()
+        c.executemany(f'''
+        INSERT INTO {_APPLIED_TEAM_TABLE_NAME} (ref_id, swit_team_id, name, parent_ref_id, member_emails, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(ref_id) DO UPDATE
+        SET swit_team_id = EXCLUDED.swit_team_id,
+            name = EXCLUDED.name,
+            parent_ref_id = EXCLUDED.parent_ref_id,
+            member_emails = EXCLUDED.member_emails,
+            content_hash = EXCLUDED.content_hash,
+            updated_at = CURRENT_TIMESTAMP
+        ''', [(
+            team.ref_id, team.swit_team_id, team.name, team.parent_ref_id,
+            json.dumps(team.member_emails), team.content_hash
+        ) for team in teams])
+
+
+def delete_applied_teams(ref_ids: Iterable[str]) -> None:
+    with _get_db() as db:
+        c = db.cursor()
+        c.executemany(f"DELETE FROM {_APPLIED_TEAM_TABLE_NAME} WHERE ref_id = ?",
+                      [(ref_id,) for ref_id in ref_ids])
+
+
+def get_applied_teams() -> dict[str, AppliedSwitTeam]:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f"SELECT ref_id, swit_team_id, name, parent_ref_id, member_emails, content_hash "
+                  f"FROM {_APPLIED_TEAM_TABLE_NAME}")
+        rows = c.fetchall()
+    return {row[0]: AppliedSwitTeam(
+        ref_id=row[0], swit_team_id=row[1], name=row[2], parent_ref_id=row[3],
+        member_emails=json.loads(row[4]), content_hash=row[5]
+    ) for row in rows}
+
+
+def upsert_applied_photos(content_hashes: dict[str, str]) -> None:
+    """Content hashes of the profile photos uploaded, by ref_id of the user"""
+    with _get_db() as db:
+        c = db.cursor()
+        c.executemany(f'''
+        INSERT INTO {_APPLIED_PHOTO_TABLE_NAME} (ref_id, content_hash)
+        VALUES (?, ?)
+        ON CONFLICT(ref_id) DO UPDATE
+        SET content_hash = EXCLUDED.content_hash,
+            updated_at = CURRENT_TIMESTAMP
+        ''', list(content_hashes.items()))
+
+
+def get_applied_photos() -> dict[str, str]:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f"SELECT ref_id, content_hash FROM {_APPLIED_PHOTO_TABLE_NAME}")
+        rows = c.fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def replace_failed_entries(ref_ids: Iterable[str]) -> None:
+    """Ref_ids of the IdP entries which failed to be applied by the last run"""
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f"DELETE FROM {_FAILED_ENTRY_TABLE_NAME}")
+        c.executemany(f"INSERT INTO {_FAILED_ENTRY_TABLE_NAME} (ref_id) VALUES (?)",
+                      [(ref_id,) for ref_id in ref_ids])
+
+
+def get_failed_entries() -> set[str]:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f"SELECT ref_id FROM {_FAILED_ENTRY_TABLE_NAME}")
+        rows = c.fetchall()
+    return {row[0] for row in rows}
+
+
+def set_last_full_reconciliation(reconciled_at: datetime) -> None:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f'''
+        INSERT INTO {_SYNC_STATE_TABLE_NAME} (key, value)
+        VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE
+        SET value = EXCLUDED.value,
+            updated_at = CURRENT_TIMESTAMP
+        ''', (_LAST_FULL_RECONCILIATION, reconciled_at.isoformat()))
+
+
+def get_last_full_reconciliation() -> Optional[datetime]:
+    with _get_db() as db:
+        c = db.cursor()
+        c.execute(f"SELECT value FROM {_SYNC_STATE_TABLE_NAME} WHERE key = '{_LAST_FULL_RECONCILIATION}'")
+        res = c.fetchone()
+    if not res:
+        return None
+    return datetime.fromisoformat(res[0])
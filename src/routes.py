@@ -8,6 +8,8 @@ import werkzeug
 from flask import request, Response, redirect, url_for, session, abort, Blueprint
 
 from src.core.constants import settings
+from src.core.metrics import expose_metrics
+from src.services.data_sync import plan_sync_to_swit
 from src.services.provision_manager import provisioner
 from src.services.swit_oauth import generate_login_url, exchange_authorization_code_for_token
 
@@ -30,9 +32,17 @@ def authenticate(func: Callable[..., Response]) -> Callable[..., Response]:
 def provision_data() -> Response:
     if provisioner.is_in_progress:
         abort(409, "API is already in use.")
+    if request.args.get('plan_only') == '1':
+        # Dry run: return what would be changed without changing anything
+        return Response(plan_sync_to_swit().model_dump_json(indent=2), status=200, mimetype='application/json')
     provisioner.start()
     return Response("Started provisioning.", status=200)
 
+@api.route('/metrics')
+def metrics() -> Response:
+    """Metrics in the Prometheus text format. They hold no personal data, so they're scraped without the secret key"""
+    return Response(expose_metrics(), status=200, mimetype='text/plain; version=0.0.4')
+
 @api.route('/login')
 def login() -> werkzeug.wrappers.response.Response:
     """Login with Swit OAuth2"""
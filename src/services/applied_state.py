@@ -0,0 +1,158 @@
+"""
+Keeps what was last applied to Swit so that steady-state runs only touch changed users, teams and profile photos.
+"""
+import hashlib
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from src.core.constants import settings
+from src.database import get_applied_users, get_applied_teams, upsert_applied_users, \
+    upsert_applied_teams, delete_applied_teams, get_last_full_reconciliation, set_last_full_reconciliation, \
+    get_applied_photos, upsert_applied_photos, replace_failed_entries
+from src.services.idp_data import IdpTeam
+from src.services.swit_schemas import AppliedSwitUser, AppliedSwitTeam
+
+
+class AppliedState:
+    """
+    The last-applied state of users and teams, keyed by ref_id.
+    Entities whose content hash matches the last-applied one are up-to-date and are skipped
+    without comparing them against Swit, except during a full reconciliation.
+    ATTENTION: Full reconciliations are what catch changes made directly on Swit,
+      so they run every FULL_RECONCILIATION_INTERVAL_HOURS.
+    """
+    def __init__(self, is_idp_full_scan: bool) -> None:
+        last_full_reconciliation = get_last_full_reconciliation()
+        self._started_at = datetime.now(timezone.utc)
+        # Every IdP entity is needed to reconcile, which an incremental import doesn't provide
+        self.is_full_reconciliation = is_idp_full_scan and (
+            last_full_reconciliation is None
+            or self._started_at - last_full_reconciliation
+            >= timedelta(hours=settings.FULL_RECONCILIATION_INTERVAL_HOURS))
+        self.users = get_applied_users()
+        self.teams = get_applied_teams()
+        # Content hashes of the last uploaded profile photos, by ref_id
+        self.photo_hashes = get_applied_photos() if settings.SYNC_PROFILE_PHOTOS else {}
+        self._lock = threading.Lock()
+        self._users_to_save: dict[str, AppliedSwitUser] = {}
+        # What was last applied before this run, to undo records of failed updates
+        self._previous_users: dict[str, Optional[AppliedSwitUser]] = {}
+        self._teams_to_save: dict[str, AppliedSwitTeam] = {}
+        self._team_ref_ids_to_delete: set[str] = set()
+        self._photo_hashes_to_save: dict[str, str] = {}
+        # Ref_ids of the users and teams which failed to be applied by this run
+        self._failed_ref_ids: set[str] = set()
+
+    def is_user_up_to_date(self, ref_id: str, email: str, name: str, phone_number: str) -> bool:
+        applied_user = self.users.get(ref_id)
+        return not self.is_full_reconciliation and applied_user is not None \
+            and applied_user.content_hash == _hash(email, name, phone_number)
+
+    def record_user(self, ref_id: str, email: str, swit_user_id: Optional[str],
+                    name: str, phone_number: str) -> None:
+        """`swit_user_id` is None if the user doesn't exist on Swit"""
+        applied_user = AppliedSwitUser(
+            ref_id=ref_id,
+            email=email,
+            swit_user_id=swit_user_id,
+            name=name,
+            phone_number=phone_number,
+            content_hash=_hash(email, name, phone_number)
+        )
+        with self._lock:
+            self._previous_users.setdefault(ref_id, self.users.get(ref_id))
+            self.users[ref_id] = applied_user
+            self._users_to_save[ref_id] = applied_user
+
+    def discard_user(self, ref_id: str) -> None:
+        """Undo `record_user` so that the user is compared against Swit again at the next run (see `record_failure`)"""
+        with self._lock:
+            self._failed_ref_ids.add(ref_id)
+            self._users_to_save.pop(ref_id, None)
+            previous_user = self._previous_users.pop(ref_id, None)
+            if previous_user is None:
+                self.users.pop(ref_id, None)
+            else:
+                self.users[ref_id] = previous_user
+
+    def is_team_up_to_date(self, idp_team: IdpTeam) -> bool:
+        applied_team = self.teams.get(idp_team.ref_id)
+        return not self.is_full_reconciliation and applied_team is not None \
+            and applied_team.content_hash == _hash(idp_team.name, idp_team.parent_ref_id,
+                                                   self._get_member_emails(idp_team))
+
+    def record_team(self, idp_team: IdpTeam, swit_team_id: str) -> None:
+        member_emails = self._get_member_emails(idp_team)
+        applied_team = AppliedSwitTeam(
+            ref_id=idp_team.ref_id,
+            swit_team_id=swit_team_id,
+            name=idp_team.name,
+            parent_ref_id=idp_team.parent_ref_id,
+            member_emails=member_emails,
+            content_hash=_hash(idp_team.name, idp_team.parent_ref_id, member_emails)
+        )
+        with self._lock:
+            self.teams[idp_team.ref_id] = applied_team
+            self._teams_to_save[idp_team.ref_id] = applied_team
+            self._team_ref_ids_to_delete.discard(idp_team.ref_id)
+
+    def forget_team(self, ref_id: str) -> None:
+        with self._lock:
+            self.teams.pop(ref_id, None)
+            self._teams_to_save.pop(ref_id, None)
+            self._team_ref_ids_to_delete.add(ref_id)
+
+    def is_photo_up_to_date(self, ref_id: str, photo_hash: str) -> bool:
+        """
+        ATTENTION: Unlike users and teams, photos aren't uploaded again by full reconciliations,
+          because Swit can't tell whether a photo is the one uploaded
+        """
+        return self.photo_hashes.get(ref_id) == photo_hash
+
+    def record_photo(self, ref_id: str, photo_hash: str) -> None:
+        with self._lock:
+            self.photo_hashes[ref_id] = photo_hash
+            self._photo_hashes_to_save[ref_id] = photo_hash
+
+    def record_failure(self, ref_id: str) -> None:
+        """
+        Keep the ref_id of a user or team which failed to be applied,
+        so that the next incremental import reads its entry again although the IdP watermark moved past it
+        """
+        with self._lock:
+            self._failed_ref_ids.add(ref_id)
+
+    def save(self) -> None:
+        """Persist what has been recorded so far"""
+        with self._lock:
+            users_to_save, self._users_to_save = self._users_to_save, {}
+            teams_to_save, self._teams_to_save = self._teams_to_save, {}
+            team_ref_ids_to_delete, self._team_ref_ids_to_delete = self._team_ref_ids_to_delete, set()
+            photo_hashes_to_save, self._photo_hashes_to_save = self._photo_hashes_to_save, {}
+        upsert_applied_users(users_to_save.values())
+        upsert_applied_teams(teams_to_save.values())
+        delete_applied_teams(team_ref_ids_to_delete)
+        upsert_applied_photos(photo_hashes_to_save)
+
+    def complete(self) -> None:
+        """Call this only after every phase has succeeded"""
+        self.save()
+        with self._lock:
+            failed_ref_ids = set(self._failed_ref_ids)
+        replace_failed_entries(failed_ref_ids)
+        if self.is_full_reconciliation:
+            set_last_full_reconciliation(self._started_at)
+
+    def _get_member_emails(self, idp_team: IdpTeam) -> list[str]:
+        """
+        ATTENTION: Only members who exist on Swit are counted,
+          so that a team changes when one of its members joins Swit
+        """
+        return sorted(user.email for user in idp_team.users
+                      if user.ref_id in self.users and self.users[user.ref_id].swit_user_id)
+
+
+def _hash(*values: object) -> str:
+    return hashlib.sha256(json.dumps(values, ensure_ascii=False).encode('utf-8')).hexdigest()
@@ -0,0 +1,213 @@
+"""
+Applies a sync plan with asyncio, used instead of `SyncUsers` and `SyncTeams` when SWIT_ASYNC_SYNC is set.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Any, Coroutine, Optional
+
+from httpx import HTTPStatusError
+
+from src.services.applied_state import AppliedState
+from src.services.scim_bulk import AsyncScimUserUpdater
+from src.services.swit_api_client import AsyncSwitApiClient
+from src.services.swit_schemas import SwitTeam, SwitTeamRequest
+from src.services.swit_snapshot import SwitSnapshot
+from src.services.sync_plan import SyncPlan, TeamCreation, TeamUpdate
+from src.services.sync_report import SyncReport
+
+
+async def apply_sync_plan_async(swit: SwitSnapshot, applied: AppliedState, plan: SyncPlan,
+                                report: SyncReport) -> None:
+    async with AsyncSwitApiClient() as api_client:
+        await _AsyncSyncPlanApplier(api_client, swit, applied, plan, report).apply()
+
+
+class _AsyncSyncPlanApplier:
+    """
+    ATTENTION: The order of the phases and what is recorded must match `SyncUsers` and `SyncTeams`.
+      Only the way requests are sent differs: every request of a phase is started at once
+      and `AsyncSwitApiClient` caps how many are in flight.
+    """
+    def __init__(self, api_client: AsyncSwitApiClient, swit: SwitSnapshot,
+                 applied: AppliedState, plan: SyncPlan, report: SyncReport) -> None:
+        self._api_client = api_client
+        self._swit = swit
+        self._applied = applied
+        self._plan = plan
+        self._report = report
+        self._failed_team_ref_ids: set[str] = set()
+
+    async def apply(self) -> None:
+        with self._report.phase('users'):
+            await self._update_users()
+        if not self._plan.has_team_changes:
+            print("Teams are up-to-date")
+            return
+        with self._report.phase('teams.remove'):
+            await self._remove_unused_teams()
+        with self._report.phase('teams.create'):
+            await self._create_teams()
+        with self._report.phase('teams.update'):
+            await self._update_teams()
+        self._record_applied_teams()
+
+    async def _update_users(self) -> None:
+        print("Syncing users...")
+        errors = await AsyncScimUserUpdater(self._api_client).update(self._plan.user_updates)
+        for user_update in self._plan.user_updates:
+            error = errors.get(user_update.user_id)
+            if error:
+                # The user is retried at the next run
+                self._applied.discard_user(user_update.ref_id)
+                self._report.record('user.update', user_update.name, error, user_id=user_update.user_id)
+                continue
+            self._swit.update_user(user_update.email, user_update.name, user_update.phone_number)
+            self._report.record('user.update', user_update.name, user_id=user_update.user_id,
+                                operations=user_update.operations)
+        self._applied.save()
+
+    async def _remove_unused_teams(self) -> None:
+        print("Removing unused teams...")
+        swit_teams = [self._swit.teams.get(team_deletion.team_id) for team_deletion in self._plan.team_deletions]
+        await self._run_all([('team.delete', swit_team.name, self._delete_team(swit_team))
+                             for swit_team in swit_teams if swit_team])
+
+    async def _delete_team(self, swit_team: SwitTeam) -> None:
+        try:
+            await self._api_client.post('/team.delete', json={'id': swit_team.id})
+        except HTTPStatusError as e:
+            if e.response.status_code != 404:
+                # The team is left on Swit until the next full reconciliation plans its deletion again
+                self._report.record('team.delete', swit_team.name, str(e), team_id=swit_team.id)
+                return
+            # If the team has already been deleted
+            self._report.record('team.delete', swit_team.name, team_id=swit_team.id, note='Already deleted')
+            self._swit.remove_team(swit_team)
+            return
+        self._swit.remove_team(swit_team)
+        self._report.record('team.delete', swit_team.name, team_id=swit_team.id)
+
+    async def _create_teams(self) -> None:
+        print("Creating teams...")
+        team_creations_by_level: defaultdict[int, list[TeamCreation]] = defaultdict(list)
+        for team_creation in self._plan.team_creations:
+            team_creations_by_level[team_creation.level].append(team_creation)
+        for level in sorted(team_creations_by_level):
+            # ATTENTION: Parents must be created before their children
+            await self._run_all([('team.create', team_creation.name, self._create_team(team_creation))
+                                 for team_creation in team_creations_by_level[level]])
+
+    async def _create_team(self, team_creation: TeamCreation) -> None:
+        team_request = SwitTeamRequest(
+            name=team_creation.name,
+            ref_id=team_creation.ref_id,
+            parent_id=team_creation.parent_id or self._get_swit_team_id(team_creation.parent_ref_id)
+        )
+        res = await self._api_client.post(
+            '/team.create',
+            json=team_request.model_dump(exclude_none=True, by_alias=True))
+        new_swit_team = SwitTeam.model_validate(res.json()['data'])
+        self._swit.add_team(new_swit_team)
+        self._report.record('team.create', new_swit_team.name, team_id=new_swit_team.id,
+                            parent_id=new_swit_team.parent_id)
+
+    async def _update_teams(self) -> None:
+        print("Updating teams...")
+        swit_teams = self._swit.teams
+        operations: list[tuple[str, str, Coroutine[Any, Any, None]]] = []
+        for team_update in self._plan.team_updates:
+            swit_team = swit_teams.get(team_update.team_id)
+            if swit_team is None:
+                self._record_missing_team('team.update', team_update.ref_id)
+                continue
+            operations.append(('team.update', swit_team.name, self._update_team(swit_team, team_update)))
+        for membership_update in self._plan.team_membership_updates:
+            swit_team = swit_teams.get_by_ref(membership_update.ref_id)
+            if swit_team is None:
+                self._record_missing_team('team.members.add', membership_update.ref_id)
+                continue
+            if membership_update.user_ids_to_add:
+                operations.append(('team.members.add', swit_team.name,
+                                   self._add_members(swit_team, set(membership_update.user_ids_to_add))))
+            if membership_update.user_ids_to_remove:
+                operations.append(('team.members.remove', swit_team.name,
+                                   self._remove_members(swit_team, set(membership_update.user_ids_to_remove))))
+        await self._run_all(operations)
+
+    async def _run_all(self, operations: list[tuple[str, str, Coroutine[Any, Any, None]]]) -> None:
+        """
+        Run (operation, name, coroutine) at once. Like `SwitWriteExecutor.wait`, every operation runs to its end
+        before the first failure is raised. Each failure is recorded, as only the first one is raised.
+        """
+        results = await asyncio.gather(*(coroutine for _, _, coroutine in operations), return_exceptions=True)
+        failures = []
+        for (operation, name, _), result in zip(operations, results):
+            if isinstance(result, BaseException):
+                self._report.record(operation, name, str(result) or type(result).__name__)
+                failures.append(result)
+        if failures:
+            raise failures[0]
+
+    def _record_missing_team(self, operation: str, ref_id: str) -> None:
+        """See `SyncTeams._record_missing_team`"""
+        self._failed_team_ref_ids.add(ref_id)
+        self._report.record(operation, ref_id, 'Team not found', ref_id=ref_id)
+
+    async def _update_team(self, swit_team: SwitTeam, team_update: TeamUpdate) -> None:
+        fields_to_update = {}
+        if team_update.name is not None:
+            fields_to_update['name'] = team_update.name
+        if team_update.parent_id or team_update.parent_ref_id:
+            fields_to_update['parent_id'] = team_update.parent_id \
+                or self._get_swit_team_id(team_update.parent_ref_id)
+        try:
+            await self._api_client.post(
+                '/team.update',
+                json=SwitTeamRequest(
+                    id=swit_team.id,
+                    **fields_to_update
+                ).model_dump(exclude_none=True, by_alias=True))
+            self._swit.update_team(swit_team, **fields_to_update)
+            self._report.record('team.update', swit_team.name, team_id=swit_team.id, fields=fields_to_update)
+        except HTTPStatusError as e:
+            if swit_team.ref_id:
+                self._failed_team_ref_ids.add(swit_team.ref_id)
+            self._report.record('team.update', swit_team.name, str(e), team_id=swit_team.id,
+                                fields=fields_to_update)
+
+    async def _add_members(self, swit_team: SwitTeam, members_to_add: set[str]) -> None:
+        await self._api_client.post('/team.user.add', json={
+            'id': swit_team.id,
+            'user_ids': list(members_to_add)
+        })
+        self._swit.add_members(swit_team, members_to_add)
+        self._report.record('team.members.add', swit_team.name, team_id=swit_team.id,
+                            user_ids=sorted(members_to_add))
+
+    async def _remove_members(self, swit_team: SwitTeam, members_to_remove: set[str]) -> None:
+        await self._api_client.post('/team.user.remove', json={
+            'id': swit_team.id,
+            'user_ids': list(members_to_remove)
+        })
+        self._swit.remove_members(swit_team, members_to_remove)
+        self._report.record('team.members.remove', swit_team.name, team_id=swit_team.id,
+                            user_ids=sorted(members_to_remove))
+
+    def _get_swit_team_id(self, ref_id: Optional[str]) -> str:
+        """
+        Resolve the parent of a team, which is either on Swit or created by an earlier level,
+        or the root team for a top-level team.
+        ATTENTION: A failed /team.create aborts the run, so the children of a team are never created without it
+        """
+        swit_teams = self._swit.teams
+        swit_team = swit_teams.get_by_ref(ref_id) if ref_id else None
+        return swit_team.id if swit_team else swit_teams.root_team_id
+
+    def _record_applied_teams(self) -> None:
+        for idp_team in self._plan.changed_teams:
+            swit_team = self._swit.teams.get_by_ref(idp_team.ref_id)
+            if swit_team and idp_team.ref_id not in self._failed_team_ref_ids:
+                self._applied.record_team(idp_team, swit_team.id)
+        for ref_id in self._failed_team_ref_ids:
+            self._applied.record_failure(ref_id)
+        self._applied.save()
@@ -1,152 +1,145 @@
 """ import directory data via ldap """
-import time
-import re
-from collections import Counter
-
-from typing import Any
+import asyncio
+from collections import defaultdict
+from functools import partial
+from typing import Callable, Optional
 
 from httpx import HTTPStatusError
 
 from src.core.constants import settings
-from src.services.idp_data import import_idp_users, import_idp_teams
+from src.core.metrics import sync_runs
+from src.services.applied_state import AppliedState
+from src.services.async_data_sync import apply_sync_plan_async
+from src.services.idp_data import IdpSnapshot, fetch_idp_photos, hash_photo, import_idp_snapshot
+from src.services.scim_bulk import ScimUserUpdater
 from src.services.swit_api_client import SwitApiClient
-from src.services.swit_schemas import SwitTeam, SwitUser, \
-    SwitTeamRequest, SwitUserRoleEnum, SwitUserRequest
+from src.services.swit_schemas import SwitTeam, SwitTeamRequest, SwitUser, SwitUserRoleEnum
+from src.services.swit_snapshot import SwitSnapshot
+from src.services.sync_plan import SyncPlan, TeamCreation, plan_sync
+from src.services.sync_report import SyncReport
+from src.services.write_executor import SwitWriteExecutor
 from src.core.logger import provisioning_logger as logger, SwitWebhookBufferingHandler
 
-# ATTENTION: To avoid rate limiting, we sleep for a short time after each API call
-_SLEEP_TIME = 0.2
+# Profile photos uploaded before the next ones are fetched from the IdP
+_PHOTO_BATCH_SIZE = 50
+# Leading bytes of the image formats found in thumbnailPhoto and jpegPhoto
+_IMAGE_SIGNATURES = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG\r\n\x1a\n': 'image/png',
+    b'GIF8': 'image/gif',
+}
 
 
 def sync_to_swit() -> None:
     """
     Syncs data from the IdP to Swit.
     """
+    # Each write is recorded in the report instead of being logged, so the webhook gets one summary per run
+    report = SyncReport()
     try:
         print("Starting data sync from the IdP to Swit in a separate thread...")
-        SyncUsers()
-        SyncTeams()
+        # ATTENTION: Write calls are spread over a worker pool and paced by the rate governor
+        #  of SwitApiClient, so there is no need to sleep after each API call
+        with SwitApiClient() as api_client, SwitWriteExecutor() as executor:
+            # The IdP and the Swit organization are read once and shared by all phases
+            with report.phase('idp'):
+                idp = import_idp_snapshot()
+            swit = SwitSnapshot(api_client)
+            # Unchanged users and teams are skipped without reading Swit
+            applied = AppliedState(idp.is_full_scan)
+            # Every change is computed before anything is written
+            with report.phase('plan'):
+                plan = plan_sync(idp, swit, applied)
+            for warning in plan.warnings:
+                logger.warning(warning)
+            if settings.SWIT_ASYNC_SYNC:
+                asyncio.run(apply_sync_plan_async(swit, applied, plan, report))
+            else:
+                SyncUsers(api_client, executor, idp, swit, applied, plan, report)
+                SyncTeams(api_client, executor, idp, swit, applied, plan, report)
+            if settings.SYNC_PROFILE_PHOTOS:
+                SyncPhotos(api_client, executor, idp, swit, applied, plan, report)
+        # ATTENTION: Entries that failed to be applied are kept by `applied`, so they're imported again
+        #  by the next run even though the watermark moves past them
+        applied.complete()
+        idp.save_watermark()
+        sync_runs.inc(result='success')
     except Exception as e:
+        sync_runs.inc(result='failure')
         logger.exception(e)
     finally:
+        report.close()
+        if report.has_changes:
+            logger.info(report.summarize())
+        else:
+            print(report.summarize())
         for handler in logger.handlers:
             if isinstance(handler, SwitWebhookBufferingHandler):
                 handler.flush()
         print("Data sync completed.")
 
 
-class Sync:
-    def __init__(self) -> None:
-        self._api_client = SwitApiClient()
-
-    def _get_existing_swit_users(self) -> dict[str, SwitUser]:
-        """Get existing swit users"""
-        # Request for all users
-        page = 0
-        swit_users = []
-        while True:
-            page += 1
-            res = self._api_client.get(
-                '/organization.user.list',
-                params={
-                    'cnt': 1000,
-                    'page': page,
-                })
-            new_users = res.json()['data']['users']
-            if not new_users:
-                break
-            swit_users += new_users
+def plan_sync_to_swit() -> SyncPlan:
+    """
+    Computes the changes `sync_to_swit` would make without writing anything to Swit or to the database.
+    """
+    with SwitApiClient() as api_client:
+        idp = import_idp_snapshot()
+        return plan_sync(idp, SwitSnapshot(api_client), AppliedState(idp.is_full_scan))
 
-        # Map swit users by email
-        swit_users_by_email = {
-            user_json['email']: SwitUser(**user_json)
-            for user_json in swit_users
-        }
-        return swit_users_by_email
+
+class Sync:
+    def __init__(self, api_client: SwitApiClient, executor: SwitWriteExecutor,
+                 idp: IdpSnapshot, swit: SwitSnapshot, applied: AppliedState, plan: SyncPlan,
+                 report: SyncReport) -> None:
+        self._api_client = api_client
+        self._executor = executor
+        self._idp = idp
+        self._swit = swit
+        self._applied = applied
+        self._plan = plan
+        self._report = report
 
 
 class SyncUsers(Sync):
     """
-    Syncs user data from the IdP to Swit.
+    Applies the user updates of a sync plan to Swit.
     """
 
-    def __init__(self) -> None:
-        super().__init__()
-        self._idp_users = import_idp_users()
-        self._create_and_update()
+    def __init__(self, api_client: SwitApiClient, executor: SwitWriteExecutor,
+                 idp: IdpSnapshot, swit: SwitSnapshot, applied: AppliedState, plan: SyncPlan,
+                 report: SyncReport) -> None:
+        super().__init__(api_client, executor, idp, swit, applied, plan, report)
+        with report.phase('users'):
+            self._update()
 
         # TODO
         """ SKB는 현재 IdP 기준으로 활성 여부를 제어하고 있지 않음
         self._update_active_status()
         """
 
-    def _create_and_update(self) -> None:
+    def _update(self) -> None:
         print("Syncing users...")
-        # Fetching existing data from Swit
-        swit_users_by_email = self._get_existing_swit_users()
-        for idp_user in self._idp_users:
-            swit_user = swit_users_by_email.get(idp_user.email)
-
-            # TODO
-            """ SKB는 이 기능을 사용하는 대신 SSO를 통해 회원 가입
-            # Create a new user if it doesn't exist on Swit
-            if not swit_user:
-                username = _clean_string(idp_user.name)
-                self._api_client.post(
-                    '/organization.user.create',
-                    json=SwitUserRequest(
-                        name=username,
-                        email=idp_user.email,
-                        phone_number=idp_user.phone_number,
-                    ).model_dump(exclude_none=True, by_alias=True))
-                logger.info(f"Created user: {username}")
-                time.sleep(_SLEEP_TIME)
-                continue
-
-            # Activate the user if inactive
-            if not swit_user.is_active:
-                self._api_client.post('/organization.user.activate',
-                                      json={'id': swit_user.id})
-                logger.info(f"Activated user: {swit_user.name}")
-                time.sleep(_SLEEP_TIME)
-            """
-            if not swit_user:
+        errors = ScimUserUpdater(self._api_client, self._executor).update(self._plan.user_updates)
+        for user_update in self._plan.user_updates:
+            error = errors.get(user_update.user_id)
+            if error:
+                # The user is retried at the next run
+                self._applied.discard_user(user_update.ref_id)
+                self._report.record('user.update', user_update.name, error, user_id=user_update.user_id)
                 continue
-
-            # TODO: Replace the SCIM API with the new API when it's ready
-            operations = []
-            if _clean_string(idp_user.name) != swit_user.name:
-                operations.append({
-                    "op": "Replace",
-                    "path": "displayName",
-                    "value": _clean_string(idp_user.name)
-                })
-            if idp_user.phone_number != swit_user.phone_number:
-                operations.append({
-                    "op": "Replace",
-                    "path": "phoneNumbers[type eq \"mobile\"].value",
-                    "value": idp_user.phone_number
-                })
-            if not operations:
-                continue
-
-            self._api_client.patch(
-                f"https://saml.swit.io/scim/v2/Users/{swit_user.id}",
-                json={
-                    "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
-                    "Operations": operations
-                }
-            )
-            logger.info(f"Updated user: {_clean_string(idp_user.name)}")
-            time.sleep(_SLEEP_TIME)
+            self._swit.update_user(user_update.email, user_update.name, user_update.phone_number)
+            self._report.record('user.update', user_update.name, user_id=user_update.user_id,
+                                operations=user_update.operations)
+        self._applied.save()
 
     def _update_active_status(self) -> None:
         print("Updating user active status...")
-        swit_users_by_email = self._get_existing_swit_users()
+        swit_users_by_email = self._swit.users_by_email
         active_swit_user_emails = {swit_user.email for swit_user
                                    in swit_users_by_email.values()
                                    if swit_user.is_active}
-        idp_user_emails = {idp_user.email for idp_user in self._idp_users}
+        idp_user_emails = set(self._idp.users_by_email)
 
         # Deactivate users who are active on Swit but not on IdP
         user_emails_to_deactivate = active_swit_user_emails - idp_user_emails
@@ -158,10 +151,9 @@ class SyncUsers(Sync):
                 continue
             if not settings.IS_RUNNING_LOCALLY:
                 # TODO when using test data, unintended deactivation can occur
-                self._api_client.post('/organization.user.deactivate',
+                self._executor.submit(self._api_client.post, '/organization.user.deactivate',
                                       json={'user_id': swit_user.id})
-            logger.info(f"Deactivated user: {swit_user.name}")
-            time.sleep(_SLEEP_TIME)
+            self._report.record('user.deactivate', swit_user.name, user_id=swit_user.id)
 
         # Activate users who are active on IdP but not active on Swit
         user_emails_to_activate = idp_user_emails - active_swit_user_emails
@@ -170,232 +162,273 @@ class SyncUsers(Sync):
                 # In case the user does not exist on Swit
                 continue
             swit_user = swit_users_by_email[email]
-            self._api_client.post('/organization.user.activate',
+            self._executor.submit(self._api_client.post, '/organization.user.activate',
                                   json={'user_id': swit_user.id})
-            logger.info(f"Activated user: {swit_user.name}")
-            time.sleep(_SLEEP_TIME)
+            self._report.record('user.activate', swit_user.name, user_id=swit_user.id)
+        self._executor.wait()
+
+
+class SyncPhotos(Sync):
+    """
+    Uploads the profile photos of the IdP users whose photo changed since it was last uploaded.
+    Whether a photo is already applied can't be read from Swit, so the content hash of the last uploaded photo
+    of each user is kept instead. Photos removed from the IdP are left on Swit.
+    """
+
+    def __init__(self, api_client: SwitApiClient, executor: SwitWriteExecutor,
+                 idp: IdpSnapshot, swit: SwitSnapshot, applied: AppliedState, plan: SyncPlan,
+                 report: SyncReport) -> None:
+        super().__init__(api_client, executor, idp, swit, applied, plan, report)
+        # It's checked when the settings are loaded
+        assert settings.SWIT_PROFILE_PHOTO_PATH, 'No endpoint to upload profile photos to'
+        self._photo_path = settings.SWIT_PROFILE_PHOTO_PATH
+        with report.phase('photos'):
+            self._upload_changed()
+
+    def _upload_changed(self) -> None:
+        print("Syncing profile photos...")
+        swit_users_by_email = self._swit.users_by_email
+        swit_users_by_ref_id = {
+            idp_user.ref_id: swit_users_by_email[idp_user.email] for idp_user in self._idp.users
+            if idp_user.photo_hash and idp_user.email in swit_users_by_email
+            and not self._applied.is_photo_up_to_date(idp_user.ref_id, idp_user.photo_hash)}
+        if not swit_users_by_ref_id:
+            print("Profile photos are up-to-date")
+            return
+        for i, (ref_id, photo) in enumerate(fetch_idp_photos(swit_users_by_ref_id), 1):
+            self._executor.submit(self._upload_photo, swit_users_by_ref_id[ref_id], ref_id, photo)
+            # ATTENTION: Photos wait in the executor's queue, so only a batch of them is held at once
+            if i % _PHOTO_BATCH_SIZE == 0:
+                self._executor.wait()
+        self._executor.wait()
+        self._applied.save()
+
+    def _upload_photo(self, swit_user: SwitUser, ref_id: str, photo: bytes) -> None:
+        """The photo is sent as it is stored in the IdP, without being decoded or resized"""
+        content_type = next((content_type for signature, content_type in _IMAGE_SIGNATURES.items()
+                             if photo.startswith(signature)), 'application/octet-stream')
+        try:
+            self._api_client.post(
+                self._photo_path,
+                data={'user_id': swit_user.id},
+                files={'file': ('photo', photo, content_type)})
+        except HTTPStatusError as e:
+            # The user is imported and the photo uploaded again at the next run
+            self._applied.record_failure(ref_id)
+            self._report.record('user.photo.update', swit_user.name, str(e), user_id=swit_user.id)
+            return
+        self._applied.record_photo(ref_id, hash_photo(photo))
+        self._report.record('user.photo.update', swit_user.name, user_id=swit_user.id, size=len(photo))
 
 
 class SyncTeams(Sync):
     """
-    Syncs team data from the IdP to Swit.
+    Applies the team changes of a sync plan to Swit.
     """
 
-    def __init__(self) -> None:
-        super().__init__()
-        self._idp_teams = import_idp_teams()
-        self._remove_unused()
-        self._create()
-        self._update()
+    def __init__(self, api_client: SwitApiClient, executor: SwitWriteExecutor,
+                 idp: IdpSnapshot, swit: SwitSnapshot, applied: AppliedState, plan: SyncPlan,
+                 report: SyncReport) -> None:
+        super().__init__(api_client, executor, idp, swit, applied, plan, report)
+        self._failed_team_ref_ids: set[str] = set()
+        if not plan.has_team_changes:
+            print("Teams are up-to-date")
+            return
+        with report.phase('teams.remove'):
+            self._remove_unused()
+        with report.phase('teams.create'):
+            self._create()
+        with report.phase('teams.update'):
+            self._update()
+        self._record_applied()
         """ SKB에서 사용하지 않음
         self._sort()
         """
 
     def _remove_unused(self) -> None:
         print("Removing unused teams...")
-        swit_teams_by_ref, all_swit_teams, root_team_id = self._get_existing_swit_teams()
-        idp_team_ref_ids = {team.ref_id for team in self._idp_teams}
-        for swit_team in all_swit_teams:
-            if swit_team.ref_id in idp_team_ref_ids:
-                # If the team is in IdP
-                continue
-            try:
-                self._api_client.post('/team.delete',
-                                      json={'id': swit_team.id})
-            except HTTPStatusError as e:
-                # If the team has already been deleted
-                logger.info(f"Team {swit_team.name} has already been deleted")
-                pass
-            time.sleep(_SLEEP_TIME)
+        for team_deletion in self._plan.team_deletions:
+            swit_team = self._swit.teams.get(team_deletion.team_id)
+            if swit_team:
+                self._executor.submit(self._delete_team, swit_team)
+        self._executor.wait()
+
+    def _delete_team(self, swit_team: SwitTeam) -> None:
+        try:
+            self._api_client.post('/team.delete',
+                                  json={'id': swit_team.id})
+        except HTTPStatusError as e:
+            if e.response.status_code != 404:
+                # The team is left on Swit until the next full reconciliation plans its deletion again
+                self._report.record('team.delete', swit_team.name, str(e), team_id=swit_team.id)
+                return
+            # If the team has already been deleted
+            self._report.record('team.delete', swit_team.name, team_id=swit_team.id, note='Already deleted')
+            self._swit.remove_team(swit_team)
+            return
+        self._swit.remove_team(swit_team)
+        self._report.record('team.delete', swit_team.name, team_id=swit_team.id)
 
     def _create(self) -> None:
+        """
+        Teams of the same level are created concurrently, and each level after its parents
+        """
         print("Creating teams...")
-        swit_teams_by_ref, all_swit_teams, root_team_id = self._get_existing_swit_teams()
-        for idp_team in self._idp_teams:
-            # Create a new one if it doesn't exist on Swit
-            if idp_team.ref_id not in swit_teams_by_ref:
-                res = self._api_client.post(
-                    '/team.create',
-                    json=SwitTeamRequest(
-                        name=_get_unique_team_name(idp_team.name, all_swit_teams),
-                        ref_id=idp_team.ref_id,
-                        parent_id=root_team_id
-                    ).model_dump(exclude_none=True, by_alias=True))
-                new_swit_team = SwitTeam.model_validate(res.json()['data'])
-                logger.info(f"Created team: {new_swit_team.name}")
-                swit_teams_by_ref[idp_team.ref_id] = new_swit_team
-                all_swit_teams.append(new_swit_team)
-                time.sleep(_SLEEP_TIME)
+        team_creations_by_level: defaultdict[int, list[TeamCreation]] = defaultdict(list)
+        for team_creation in self._plan.team_creations:
+            team_creations_by_level[team_creation.level].append(team_creation)
+        for level in sorted(team_creations_by_level):
+            for team_creation in team_creations_by_level[level]:
+                self._executor.submit(
+                    self._create_team,
+                    SwitTeamRequest(
+                        name=team_creation.name,
+                        ref_id=team_creation.ref_id,
+                        parent_id=team_creation.parent_id or self._get_swit_team_id(team_creation.parent_ref_id)
+                    ))
+            # ATTENTION: Parents must be created before their children and all teams before they're updated
+            self._executor.wait()
+
+    def _create_team(self, team_request: SwitTeamRequest) -> SwitTeam:
+        res = self._api_client.post(
+            '/team.create',
+            json=team_request.model_dump(exclude_none=True, by_alias=True))
+        new_swit_team = SwitTeam.model_validate(res.json()['data'])
+        self._swit.add_team(new_swit_team)
+        self._report.record('team.create', new_swit_team.name, team_id=new_swit_team.id,
+                            parent_id=new_swit_team.parent_id)
+        return new_swit_team
 
     def _update(self) -> None:
         """
-        Keep swit teams are up-to-date
         Unlike users, team updates must be done after all teams are created
         because they can refer to each other
         """
         print("Updating teams...")
-        swit_teams_by_ref, all_swit_teams, root_team_id = self._get_existing_swit_teams()
-        swit_users_by_email = self._get_existing_swit_users()
-        for idp_team in self._idp_teams:
-            swit_team = swit_teams_by_ref.get(idp_team.ref_id)
+        swit_teams = self._swit.teams
+        # ATTENTION: Every team is looked up before any job is submitted,
+        #  because renaming or moving a team re-indexes it in the snapshot while the job runs
+        jobs: list[Callable[[], None]] = []
+        for team_update in self._plan.team_updates:
+            swit_team = swit_teams.get(team_update.team_id)
             if swit_team is None:
+                self._record_missing_team('team.update', team_update.ref_id)
                 continue
-
-            # Collect fields to update to minimize API calls
             fields_to_update = {}
+            if team_update.name is not None:
+                fields_to_update['name'] = team_update.name
+            if team_update.parent_id or team_update.parent_ref_id:
+                fields_to_update['parent_id'] = team_update.parent_id \
+                    or self._get_swit_team_id(team_update.parent_ref_id)
+            jobs.append(partial(self._update_team, swit_team, fields_to_update))
+
+        for membership_update in self._plan.team_membership_updates:
+            swit_team = swit_teams.get_by_ref(membership_update.ref_id)
+            if swit_team is None:
+                self._record_missing_team('team.members.add', membership_update.ref_id)
+                continue
+            if membership_update.user_ids_to_add:
+                jobs.append(partial(self._add_members, swit_team, set(membership_update.user_ids_to_add)))
+            if membership_update.user_ids_to_remove:
+                jobs.append(partial(self._remove_members, swit_team, set(membership_update.user_ids_to_remove)))
 
-            # Update team name
-            if _clean_string(swit_team.name) != _clean_string(idp_team.name):
-                fields_to_update['name'] = _get_unique_team_name(idp_team.name, all_swit_teams)
+        for job in jobs:
+            self._executor.submit(job)
+        self._executor.wait()
 
-            # Update parent team
-            new_parent_swit_team_id: str = root_team_id
-            if idp_team.parent_ref_id:
-                parent_swit_team = swit_teams_by_ref.get(idp_team.parent_ref_id)
-                if parent_swit_team:
-                    new_parent_swit_team_id = parent_swit_team.id
-
-            if new_parent_swit_team_id != swit_team.parent_id:
-                fields_to_update['parent_id'] = new_parent_swit_team_id
-
-            # Update team info if necessary
-            if fields_to_update:
-                try:
-                    self._api_client.post(
-                        '/team.update',
-                        json=SwitTeamRequest(
-                            id=swit_team.id,
-                            **fields_to_update
-                        ).model_dump(exclude_none=True, by_alias=True))
-                    logger.info(f"Updated team: {swit_team.name}")
-                except HTTPStatusError as e:
-                    logger.error(f"Failed to update team: {swit_team.name}")
-                    logger.exception(e)
-                time.sleep(_SLEEP_TIME)
-
-            # Check that team members are up-to-date
-            swit_team_user_ids = set(swit_team.user_ids)
-            idp_team_user_ids = {swit_users_by_email[idp_user.email].id
-                                 for idp_user in idp_team.users
-                                 if idp_user.email in swit_users_by_email}
-
-            # Add members
-            members_to_add = idp_team_user_ids - swit_team_user_ids
-            if members_to_add:
-                self._api_client.post(
-                    '/team.user.add',
-                    json={
-                        'id': swit_team.id,
-                        'user_ids': list(members_to_add)
-                    })
-                logger.info(f"Added {len(members_to_add)} members to team: {swit_team.name}")
-                time.sleep(_SLEEP_TIME)
-
-            # remove members
-            members_to_remove = swit_team_user_ids - idp_team_user_ids
-            if members_to_remove:
-                self._api_client.post(
-                    '/team.user.remove',
-                    json={
-                        'id': swit_team.id,
-                        'user_ids': list(members_to_remove)
-                    })
-                logger.info(f"Removed {len(members_to_remove)} members from team: {swit_team.name}")
-                time.sleep(_SLEEP_TIME)
+    def _record_missing_team(self, operation: str, ref_id: str) -> None:
+        """A team to change isn't on Swit anymore, so it isn't recorded as applied and is retried at the next run"""
+        self._failed_team_ref_ids.add(ref_id)
+        self._report.record(operation, ref_id, 'Team not found', ref_id=ref_id)
+
+    def _get_swit_team_id(self, ref_id: Optional[str]) -> str:
+        """
+        Resolve the parent of a team, which is either on Swit or created by an earlier level,
+        or the root team for a top-level team.
+        ATTENTION: A failed /team.create aborts the run, so the children of a team are never created without it
+        """
+        swit_teams = self._swit.teams
+        swit_team = swit_teams.get_by_ref(ref_id) if ref_id else None
+        return swit_team.id if swit_team else swit_teams.root_team_id
+
+    def _update_team(self, swit_team: SwitTeam, fields_to_update: dict[str, str]) -> None:
+        try:
+            self._api_client.post(
+                '/team.update',
+                json=SwitTeamRequest(
+                    id=swit_team.id,
+                    **fields_to_update
+                ).model_dump(exclude_none=True, by_alias=True))
+            self._swit.update_team(swit_team, **fields_to_update)
+            self._report.record('team.update', swit_team.name, team_id=swit_team.id, fields=fields_to_update)
+        except HTTPStatusError as e:
+            if swit_team.ref_id:
+                self._failed_team_ref_ids.add(swit_team.ref_id)
+            self._report.record('team.update', swit_team.name, str(e), team_id=swit_team.id,
+                                fields=fields_to_update)
+
+    def _add_members(self, swit_team: SwitTeam, members_to_add: set[str]) -> None:
+        self._api_client.post(
+            '/team.user.add',
+            json={
+                'id': swit_team.id,
+                'user_ids': list(members_to_add)
+            })
+        self._swit.add_members(swit_team, members_to_add)
+        self._report.record('team.members.add', swit_team.name, team_id=swit_team.id,
+                            user_ids=sorted(members_to_add))
+
+    def _remove_members(self, swit_team: SwitTeam, members_to_remove: set[str]) -> None:
+        self._api_client.post(
+            '/team.user.remove',
+            json={
+                'id': swit_team.id,
+                'user_ids': list(members_to_remove)
+            })
+        self._swit.remove_members(swit_team, members_to_remove)
+        self._report.record('team.members.remove', swit_team.name, team_id=swit_team.id,
+                            user_ids=sorted(members_to_remove))
+
+    def _record_applied(self) -> None:
+        for idp_team in self._plan.changed_teams:
+            swit_team = self._swit.teams.get_by_ref(idp_team.ref_id)
+            if swit_team and idp_team.ref_id not in self._failed_team_ref_ids:
+                self._applied.record_team(idp_team, swit_team.id)
+        for ref_id in self._failed_team_ref_ids:
+            self._applied.record_failure(ref_id)
+        self._applied.save()
 
     def _sort(self) -> None:
         print("Sorting teams...")
-        swit_teams_by_ref, all_swit_teams, _ = self._get_existing_swit_teams()
-        for idp_team in self._idp_teams:
-            swit_team = swit_teams_by_ref.get(idp_team.ref_id)
+        swit_teams = self._swit.teams
+        # Positions of the children of each IdP team
+        idp_team_child_orders: defaultdict[str, dict[str, int]] = defaultdict(dict)
+        for idp_team in self._idp.teams:
+            if idp_team.parent_ref_id:
+                child_orders = idp_team_child_orders[idp_team.parent_ref_id]
+                child_orders[idp_team.ref_id] = len(child_orders)
+        for idp_team in self._idp.teams:
+            swit_team = swit_teams.get_by_ref(idp_team.ref_id)
             if swit_team is None:
                 continue
             # Find children of the team
-            idp_team_child_ids = [team.ref_id for team in self._idp_teams if team.parent_ref_id == idp_team.ref_id]
-            swit_team_children = [team for team in all_swit_teams if team.parent_id == swit_team.id]
+            idp_team_child_order = idp_team_child_orders.get(idp_team.ref_id, {})
+            swit_team_children = swit_teams.get_children(swit_team.id)
 
             def _sort_children(target_team: SwitTeam) -> int:
-                target_team_ref_id = target_team.ref_id
-                if target_team_ref_id and target_team_ref_id in idp_team_child_ids:
-                    primary_order = idp_team_child_ids.index(target_team_ref_id)
-                else:
-                    # If the id is not in all_ids, set primary_order to a large number
-                    primary_order = len(idp_team_child_ids)
-                return primary_order
+                # If the team is not a child on the IdP, it goes last
+                return idp_team_child_order.get(target_team.ref_id or '', len(idp_team_child_order))
 
             swit_team_children_sorted = sorted(swit_team_children, key=_sort_children)
             if not any(o1 != o2 for o1, o2 in zip(swit_team_children, swit_team_children_sorted)):
                 # If the children are already sorted
                 continue
-            self._api_client.post(
+            self._executor.submit(
+                self._api_client.post,
                 '/team.sort',
                 json={
                     'parent_id': swit_team.id,
                     'team_ids': [team.id for team in swit_team_children_sorted]
                 })
-            logger.info(f"Sorted team: {swit_team.name}")
-            time.sleep(_SLEEP_TIME)
-
-    def _get_existing_swit_teams(self) -> tuple[dict[str, SwitTeam], list[SwitTeam], str]:
-        """Get existing swit teams"""
-        res = self._api_client.get('/user.team.list')
-        raw_swit_teams: list[dict[str, Any]] = res.json()['data']['team']
-        root_team_id = next(team['team_id'] for team in raw_swit_teams if team['depth'] == 0)
-        all_swit_teams = [SwitTeam.model_validate(team_json) for team_json in raw_swit_teams]
-
-        # ATTENTION: Ensure that all ref_ids are unique
-        ref_ids = [team.ref_id for team in all_swit_teams if team.ref_id]
-        counter = Counter(ref_ids)
-        duplicates = [ref_id for ref_id, count in counter.items() if count > 1]
-        deleted_team_ids = []
-        for duplicate in duplicates:
-            duplicate_teams = [team for team in all_swit_teams if team.ref_id == duplicate]
-            # Keep the team with the most members
-            duplicate_teams.sort(key=lambda team: len(team.user_ids), reverse=True)
-            for team in duplicate_teams[1:]:
-                try:
-                    self._api_client.post('/team.delete',
-                                          json={'id': team.id})
-                except HTTPStatusError:
-                    pass
-                deleted_team_ids.append(team.id)
-
-        # ATTENTION: Exclude the root team and 'Unassigned' team
-        #  because they're not actual teams
-        all_swit_teams = [team for team in all_swit_teams
-                          if team.id != root_team_id and team.name != 'Unassigned'
-                          and team.id not in deleted_team_ids]
-        swit_teams_by_ref = {
-            swit_team.ref_id: swit_team
-            for swit_team in all_swit_teams if swit_team.ref_id
-        }
-        return swit_teams_by_ref, all_swit_teams, root_team_id
-
-
-def _get_unique_team_name(team_name: str, all_swit_teams: list[SwitTeam]) -> str:
-    """
-    ATTENTION: Get a unique team name by adding a number suffix. Be aware that:
-      1. Duplicate team names are not allowed on Swit.
-      2. Duplicates must be checked case-insensitively.
-    """
-    cleaned_team_name = _clean_string(team_name)
-    # Be aware that the Swit API is case-insensitive
-    existing_team_names = {team.name.lower() for team in all_swit_teams}
-    if cleaned_team_name.lower() not in existing_team_names:
-        return cleaned_team_name
-    for i in range(2, 100):
-        new_team_name = f"{cleaned_team_name} ({i})"
-        if new_team_name.lower() not in existing_team_names:
-            return new_team_name
-    raise RuntimeError(f"Failed to generate a unique team name for {team_name}")
-
-
-def _clean_string(string: str) -> str:
-    """
-    ATTENTION: Replace @ # < > § ▒ { } ; * with underscore in the string
-        and remove duplicated number suffixes
-    """
-    string = re.sub(r'[@#<>§▒{};*]', '_', string)
-    # Remove duplicated number suffixes
-    string = re.sub(r' \([0-9]+\)$', '', string)
-    return string.strip()
+            self._report.record('team.sort', swit_team.name, team_id=swit_team.id)
+        self._executor.wait()
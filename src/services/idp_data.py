@@ -1,23 +1,50 @@
+import hashlib
 import json
 import re
-from typing import Optional, TypedDict
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable, Iterator, Optional, TypedDict
 
-from pydantic import BaseModel
+from ldap3 import BASE, Connection
+from ldap3.utils.conv import escape_filter_chars
 
 from src.core.constants import settings
-from src.services.ldap_connection import connect_ldap, LdapSettings
+from src.core.logger import provisioning_logger as logger
+from src.core.metrics import ldap_entries, ldap_search_duration, ldap_searches
+from src.database import get_failed_entries, get_ldap_watermark, upsert_ldap_watermark
+from src.services.ldap_connection import LdapConnectionPool, LdapSettings
+from src.services.ldap_dn import DnIndex, DnKey, is_under, parse_dn_key
+from src.services.swit_schemas import LdapWatermark
 
+_USER_ATTRIBUTES = ['distinguishedName', 'mail', 'displayName', 'mobile']
+_GROUP_ATTRIBUTES = ['distinguishedName', 'member', 'memberOf', 'displayName']
+# Profile photos, in order of preference. AD usually keeps a small JPEG in thumbnailPhoto
+_PHOTO_ATTRIBUTES = ['thumbnailPhoto', 'jpegPhoto']
+# Number of DNs looked up with a single search filter
+_DN_BATCH_SIZE = 50
+# AD returns at most MaxValRange (1500 by default) values of `member` per entry, named like `member;range=0-1499`
+_MEMBER_RANGE = re.compile(r'member;range=(\d+)-(\d+|\*)', re.IGNORECASE)
 
-class IdpUser(BaseModel):
-    """A class to hold IdP user information"""
+
+@dataclass(slots=True)
+class IdpUser:
+    """
+    A class to hold IdP user information
+    It's built from trusted directory entries, so it's a plain slotted dataclass without validation
+    """
     ref_id: str
     name: str
     email: str
     phone_number: str
+    # SHA-256 of the profile photo if SYNC_PROFILE_PHOTOS is set. The photo is fetched again to be uploaded
+    photo_hash: Optional[str] = None
 
 
-class IdpTeam(BaseModel):
-    """A class to hold IdP team information"""
+@dataclass(slots=True)
+class IdpTeam:
+    """A class to hold IdP team information. See `IdpUser`"""
     ref_id: str
     name: str
     parent_ref_id: Optional[str]
@@ -38,72 +65,417 @@ class RawIdpTeam(TypedDict):
     displayName: str
 
 
-def import_idp_users() -> list[IdpUser]:
-    """Import users from IdP"""
-    raw_idp_users: list[RawIdpUser] = []
+@dataclass(slots=True)
+class _IdpGroup:
+    """
+    A group entry reduced to what its team is built from, with its members as DN keys,
+    so that the entries are dropped page by page instead of being held until every OU is searched
+    """
+    dn: str
+    name: str
+    parent_dn: Optional[str]
+    member_keys: list[DnKey]
+
+
+class IdpSnapshot:
+    """
+    Users and teams imported from the IdP once per sync run, shared by all sync phases
+    ATTENTION: Unless `is_full_scan` is set, it only holds the entries changed since the last successful run
+      (and whatever is needed to apply them), so absent entries must not be treated as deleted.
+    """
+    def __init__(self, users: list[IdpUser], teams: list[IdpTeam],
+                 is_full_scan: bool = True, watermark: Optional[LdapWatermark] = None) -> None:
+        self.users = users
+        self.teams = teams
+        self.users_by_ref_id = {user.ref_id: user for user in users}
+        self.users_by_email = {user.email: user for user in users}
+        self.teams_by_ref_id = {team.ref_id: team for team in teams}
+        self.is_full_scan = is_full_scan
+        self._watermark = watermark
 
+    def save_watermark(self) -> None:
+        """Call this only after the snapshot has been applied to Swit successfully"""
+        if self._watermark is not None:
+            upsert_ldap_watermark(self._watermark)
+
+
+def import_idp_snapshot() -> IdpSnapshot:
+    """Import users and teams from IdP"""
     if settings.IS_RUNNING_LOCALLY:
-        with open('fixtures/ldap_test_data.json') as f:
-            raw_idp_users = json.load(f)['users']
-    else:
-        with connect_ldap() as conn:
-            ldap_settings = LdapSettings()
-            for ou in ldap_settings.LDAP_USER_OUS.split(','):
-                conn.search(
-                    search_base=f'OU={ou},{ldap_settings.LDAP_SEARCH_BASE}',
-                    search_filter='(objectclass=*)',
-                    attributes=['distinguishedName', 'mail', 'displayName', 'mobile']
-                )
-                assert conn.response is not None, f'No response from the IdP for OU: {ou}'
-                raw_idp_users += [e['attributes'] for e in conn.response]
-
-    return [IdpUser(
-        ref_id=raw_user['distinguishedName'],
-        name=raw_user['displayName'].split("/")[0],
-        email=raw_user['mail'],
-        phone_number=raw_user.get('mobile') or ''
-    ) for raw_user in raw_idp_users if raw_user['mail']]
-
-
-def import_idp_teams() -> list[IdpTeam]:
-    """Import teams from IdP"""
-    idp_users = import_idp_users()
-    idp_users_by_ref_id = {idp_user.ref_id: idp_user for idp_user in idp_users}
-
-    raw_idp_teams: list[RawIdpTeam] = []
+        with open(settings.LOCAL_IDP_FIXTURE_PATH) as f:
+            fixture = json.load(f)
+        dn_index = DnIndex()
+        idp_users = list(_to_idp_users(fixture['users'], dn_index))
+        idp_teams = list(_to_idp_teams(list(_to_idp_groups(fixture['groups'], dn_index)), idp_users, dn_index))
+        return IdpSnapshot(idp_users, idp_teams)
+
+    # ATTENTION: All user and group OUs are searched at once, each over its own connection of the pool,
+    #  and their entries are merged in the order of the OUs
+    with LdapConnectionPool() as pool:
+        ldap_settings = LdapSettings()
+        with pool.connection() as conn:
+            watermark = _read_watermark(conn) if ldap_settings.LDAP_INCREMENTAL_SYNC else None
+        changed_since = _get_usn_to_import_from(watermark, ldap_settings)
+        dn_index = DnIndex()
+        if changed_since is None:
+            # Users and groups are converted as they're found, so that their entries aren't all held at once
+            user_futures = [pool.submit(_import_users, ou, dn_index)
+                            for ou in ldap_settings.LDAP_USER_OUS.split(',')]
+            group_futures = [pool.submit(_import_groups, ou, dn_index)
+                             for ou in ldap_settings.LDAP_GROUP_OUS.split(',')]
+            idp_users = [idp_user for future in user_futures for idp_user in future.result()]
+            idp_groups = [idp_group for future in group_futures for idp_group in future.result()]
+            idp_teams = list(_to_idp_teams(idp_groups, idp_users, dn_index))
+            return IdpSnapshot(idp_users, idp_teams, watermark=watermark)
+
+        raw_idp_users, raw_idp_teams = _search_changes(pool, changed_since, ldap_settings, dn_index)
+        idp_users = list(_to_idp_users(raw_idp_users, dn_index))
+        idp_teams = list(_to_idp_teams(list(_to_idp_groups(raw_idp_teams, dn_index)), idp_users, dn_index))
+        logger.info(f"Imported changes since USN {changed_since}: "
+                    f"{len(idp_users)} users, {len(idp_teams)} teams")
+        return IdpSnapshot(idp_users, idp_teams, is_full_scan=False, watermark=watermark)
 
+
+def fetch_idp_photos(ref_ids: Iterable[str]) -> Iterator[tuple[str, bytes]]:
+    """
+    Stream the profile photos of the given users as (ref_id, photo), a batch of users per search.
+    The photos are only hashed by the import, so that they aren't all held in memory.
+    """
     if settings.IS_RUNNING_LOCALLY:
-        with open('fixtures/ldap_test_data.json') as f:
-            raw_idp_teams = json.load(f)['groups']
-    else:
-        with connect_ldap() as conn:
-            ldap_settings = LdapSettings()
-            for ou in ldap_settings.LDAP_GROUP_OUS.split(','):
-                conn.search(
-                    search_base=f'OU={ou},{ldap_settings.LDAP_SEARCH_BASE}',
-                    search_filter='(objectclass=*)',
-                    attributes=['distinguishedName', 'member', 'memberOf', 'displayName']
-                )
-                assert conn.response is not None, f'No response from the IdP for OU: {ou}'
-                raw_idp_teams += [e['attributes'] for e in conn.response]
-
-    return [IdpTeam(
-        ref_id=raw_team['distinguishedName'],
-        name=raw_team['displayName'],
-        parent_ref_id=(raw_team['memberOf'][0]
-                       if raw_team['memberOf'] else None),
-        users=[idp_users_by_ref_id[user_ref_id] for user_ref_id
-               in raw_team['member']
-               if user_ref_id in idp_users_by_ref_id]
-    ) for raw_team in raw_idp_teams
-        if raw_team['displayName'] and not _check_for_exclusion(raw_team['distinguishedName'])
-    ]
-
-
-_teams_to_exclude = set(settings.TEAMS_TO_EXCLUDE.split(','))
-
-
-def _check_for_exclusion(distinguished_name: str) -> bool:
-    pattern = re.compile(r"CN=([^,]+)")
-    matches = pattern.findall(distinguished_name)
-    return len(set(matches) & _teams_to_exclude) > 0
+        # JSON fixtures have no photos
+        return
+    dn_index = DnIndex()
+    ref_ids_by_key = {dn_index.key(ref_id): ref_id for ref_id in ref_ids}
+    with LdapConnectionPool(max_workers=1) as pool, pool.connection() as conn:
+        for entry in _search_dns(conn, ref_ids_by_key.values(), ['distinguishedName'] + _PHOTO_ATTRIBUTES,
+                                 kind='photo'):
+            ref_id = ref_ids_by_key.get(dn_index.key(entry['distinguishedName']))
+            photo = _get_photo(entry)
+            if ref_id and photo:
+                yield ref_id, photo
+
+
+def hash_photo(photo: bytes) -> str:
+    return hashlib.sha256(photo).hexdigest()
+
+
+def _read_watermark(conn: Connection) -> LdapWatermark:
+    """
+    Read the current position of the DC we're bound to.
+    ATTENTION: It must be read before searching so that changes made during the search are imported next time
+    """
+    conn.search('', '(objectClass=*)', search_scope=BASE,
+                attributes=['highestCommittedUSN', 'dsServiceName'])
+    assert conn.response, 'No rootDSE from the IdP'
+    root_dse = conn.response[0]['attributes']
+    conn.search(root_dse['dsServiceName'], '(objectClass=*)', search_scope=BASE,
+                attributes=['invocationId'])
+    assert conn.response, 'No NTDS settings from the IdP'
+    return LdapWatermark(
+        invocation_id=str(conn.response[0]['attributes']['invocationId']),
+        highest_usn=int(root_dse['highestCommittedUSN']),
+        last_full_scan_at=datetime.now(timezone.utc)
+    )
+
+
+def _get_usn_to_import_from(watermark: Optional[LdapWatermark], ldap_settings: LdapSettings) -> Optional[int]:
+    """
+    Return the lowest USN of the changes to import, or None if a full scan is required.
+    If changes are imported incrementally, `watermark` keeps the time of the last full scan.
+    """
+    if watermark is None:
+        return None
+    last_watermark = get_ldap_watermark()
+    if last_watermark is None:
+        return None
+    if last_watermark.invocation_id != watermark.invocation_id \
+            or last_watermark.highest_usn > watermark.highest_usn:
+        # USNs are local to a DC, so they're meaningless on another DC or after a restore
+        logger.info("LDAP watermark is invalid for the current DC. Running a full scan...")
+        return None
+    if watermark.last_full_scan_at - last_watermark.last_full_scan_at \
+            >= timedelta(hours=ldap_settings.LDAP_FULL_SCAN_INTERVAL_HOURS):
+        return None
+    watermark.last_full_scan_at = last_watermark.last_full_scan_at
+    return last_watermark.highest_usn + 1
+
+
+def _search_changes(pool: LdapConnectionPool, changed_since: int, ldap_settings: LdapSettings,
+                    dn_index: DnIndex) -> tuple[list[RawIdpUser], list[RawIdpTeam]]:
+    """
+    Search the users and groups changed since the given USN or which failed to be applied,
+    plus the entries needed to apply them
+    """
+    search_filter = f'(&(objectclass=*)(uSNChanged>={changed_since}))'
+    user_futures = [pool.submit(_search_users, ou, search_filter) for ou in ldap_settings.LDAP_USER_OUS.split(',')]
+    group_futures = [pool.submit(_search_groups, ou, search_filter) for ou in ldap_settings.LDAP_GROUP_OUS.split(',')]
+    raw_idp_users: list[RawIdpUser] = [raw_user for future in user_futures for raw_user in future.result()]
+    raw_idp_teams: list[RawIdpTeam] = [raw_team for future in group_futures for raw_team in future.result()]
+    user_bases = _get_ou_bases(ldap_settings.LDAP_USER_OUS, ldap_settings)
+    group_bases = _get_ou_bases(ldap_settings.LDAP_GROUP_OUS, ldap_settings)
+    with pool.connection() as conn:
+        # The entries which failed to be applied by the last run are read again,
+        #  as the watermark has moved past them
+        imported_keys = {dn_index.key(raw_entry['distinguishedName'])
+                         for raw_entry in [*raw_idp_users, *raw_idp_teams]}
+        failed_dns = {dn_index.key(ref_id): ref_id for ref_id in get_failed_entries()
+                      if dn_index.key(ref_id) not in imported_keys}
+        for entry in _complete_member_ranges(conn, _search_dns(
+                conn, [dn for key, dn in failed_dns.items() if is_under(key, group_bases)], _GROUP_ATTRIBUTES)):
+            if 'group' in entry['objectClass']:
+                raw_idp_teams.append(entry)
+        for entry in _search_dns(conn, [dn for key, dn in failed_dns.items() if is_under(key, user_bases)],
+                                 _get_user_attributes()):
+            if 'group' not in entry['objectClass']:
+                raw_idp_users.append(entry)
+
+        # Moving a group changes `member` of its parent, not the group itself,
+        #  so the child groups of changed groups are read again to update their parents
+        changed_keys = {dn_index.key(raw_team['distinguishedName']) for raw_team in raw_idp_teams}
+        # ATTENTION: DNs are spelled like the entries say, not like `member`, so they're deduplicated by key
+        #  instead of being made canonical
+        child_group_dns = {dn_index.key(member): member for raw_team in raw_idp_teams for member in raw_team['member']
+                           if dn_index.key(member) not in changed_keys
+                           and is_under(dn_index.key(member), group_bases)}
+        for entry in _complete_member_ranges(conn, _search_dns(conn, child_group_dns.values(), _GROUP_ATTRIBUTES)):
+            if 'group' in entry['objectClass']:
+                raw_idp_teams.append(entry)
+
+        # The members of the teams are applied as a whole, so every member must be known
+        known_user_keys = {dn_index.key(raw_user['distinguishedName']) for raw_user in raw_idp_users}
+        member_dns = {dn_index.key(member): member for raw_team in raw_idp_teams for member in raw_team['member']
+                      if dn_index.key(member) not in known_user_keys and is_under(dn_index.key(member), user_bases)}
+        for entry in _search_dns(conn, member_dns.values(), _get_user_attributes()):
+            if 'group' not in entry['objectClass']:
+                raw_idp_users.append(entry)
+    return raw_idp_users, raw_idp_teams
+
+
+def _get_ou_bases(ous: str, ldap_settings: LdapSettings) -> tuple[DnKey, ...]:
+    """DN keys of the given OUs"""
+    return tuple(parse_dn_key(f'OU={ou},{ldap_settings.LDAP_SEARCH_BASE}') for ou in ous.split(','))
+
+
+def _get_user_attributes() -> list[str]:
+    return _USER_ATTRIBUTES + _PHOTO_ATTRIBUTES if settings.SYNC_PROFILE_PHOTOS else _USER_ATTRIBUTES
+
+
+def _get_photo(entry: Any) -> Optional[bytes]:
+    for attribute in _PHOTO_ATTRIBUTES:
+        value = entry.get(attribute)
+        # jpegPhoto may have several values
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if value:
+            return bytes(value)
+    return None
+
+
+def _import_users(conn: Connection, ou: str, dn_index: DnIndex) -> list[IdpUser]:
+    return list(_to_idp_users(_search_ou(conn, ou, _get_user_attributes()), dn_index))
+
+
+def _import_groups(conn: Connection, ou: str, dn_index: DnIndex) -> list[_IdpGroup]:
+    """The next ranges of members are fetched over the same connection"""
+    return list(_to_idp_groups(_complete_member_ranges(conn, _search_ou(conn, ou, _GROUP_ATTRIBUTES)), dn_index))
+
+
+def _search_users(conn: Connection, ou: str, search_filter: str) -> list[Any]:
+    return list(_search_ou(conn, ou, _get_user_attributes(), search_filter))
+
+
+def _search_groups(conn: Connection, ou: str, search_filter: str) -> list[Any]:
+    """
+    Only the changed groups are searched this way, as their entries are held to find the entries they refer to.
+    See `_import_groups`
+    """
+    return list(_complete_member_ranges(conn, _search_ou(conn, ou, _GROUP_ATTRIBUTES, search_filter)))
+
+
+def _search_ou(conn: Connection, ou: str, attributes: list[str],
+               search_filter: str = '(objectclass=*)') -> Iterator[Any]:
+    """
+    Stream the entries of the given OU page by page with the Simple Paged Results control,
+    so that neither the server's size limit nor the size of a single response bounds the import
+    """
+    ldap_settings = LdapSettings()
+    for entry in _measure_search('ou', conn.extend.standard.paged_search(
+            search_base=f'OU={ou},{ldap_settings.LDAP_SEARCH_BASE}',
+            search_filter=search_filter,
+            attributes=attributes,
+            paged_size=ldap_settings.LDAP_PAGE_SIZE,
+            generator=True)):
+        # Skip search result references
+        if entry['type'] == 'searchResEntry':
+            yield entry['attributes']
+
+
+def _search_dns(conn: Connection, dns: Iterable[str], attributes: list[str], kind: str = 'dn') -> Iterator[Any]:
+    """Stream the entries of the given DNs, looking up several DNs with each search"""
+    ldap_settings = LdapSettings()
+    dns = sorted(dns)
+    for i in range(0, len(dns), _DN_BATCH_SIZE):
+        search_filter = '(|{})'.format(''.join(
+            f'(distinguishedName={escape_filter_chars(dn)})' for dn in dns[i:i + _DN_BATCH_SIZE]))
+        for entry in _measure_search(kind, conn.extend.standard.paged_search(
+                search_base=ldap_settings.LDAP_SEARCH_BASE,
+                search_filter=search_filter,
+                attributes=attributes + ['objectClass'],
+                paged_size=ldap_settings.LDAP_PAGE_SIZE,
+                generator=True)):
+            if entry['type'] == 'searchResEntry':
+                yield entry['attributes']
+
+
+def _complete_member_ranges(conn: Connection, raw_idp_teams: Iterable[Any]) -> Iterator[Any]:
+    """
+    Fetch the members of groups too large for AD to return at once.
+    AD returns the first values of their `member` as `member;range=0-1499` and the next ones must be asked for
+    with `member;range=1500-*` and so on. Groups returned whole are passed on as they are,
+    while the others are held until a batch of them is full, because a single search fetches
+    the next range of every group of a batch.
+    """
+    # Groups waiting for their next range, by DN key, with the low bound of that range
+    pending_teams: dict[DnKey, tuple[RawIdpTeam, int]] = {}
+    for raw_team in raw_idp_teams:
+        next_low = _take_member_range(raw_team, raw_team)
+        if next_low is None:
+            yield raw_team
+            continue
+        pending_teams[parse_dn_key(raw_team['distinguishedName'])] = (raw_team, next_low)
+        if len(pending_teams) >= _DN_BATCH_SIZE:
+            yield from _fetch_member_ranges(conn, pending_teams)
+            pending_teams = {}
+    if pending_teams:
+        yield from _fetch_member_ranges(conn, pending_teams)
+
+
+def _fetch_member_ranges(conn: Connection,
+                         pending_teams: dict[DnKey, tuple[RawIdpTeam, int]]) -> Iterator[RawIdpTeam]:
+    """
+    Fetch range after range until every group is complete. Groups of the same range are searched together.
+    ATTENTION: The entries are matched by DN key, as AD may spell their DNs differently from the first search
+    """
+    while pending_teams:
+        dns_by_low: defaultdict[int, list[str]] = defaultdict(list)
+        for raw_team, low in pending_teams.values():
+            dns_by_low[low].append(raw_team['distinguishedName'])
+        next_pending_teams: dict[DnKey, tuple[RawIdpTeam, int]] = {}
+        for low, dns in dns_by_low.items():
+            for entry in _search_member_range(conn, dns, low):
+                key = parse_dn_key(entry['distinguishedName'])
+                raw_team, _ = pending_teams[key]
+                next_low = _take_member_range(raw_team, entry)
+                if next_low is not None:
+                    next_pending_teams[key] = (raw_team, next_low)
+        # Including the groups deleted in the meantime, which aren't returned anymore
+        for key, (raw_team, _) in pending_teams.items():
+            if key not in next_pending_teams:
+                yield raw_team
+        pending_teams = next_pending_teams
+
+
+def _search_member_range(conn: Connection, dns: list[str], low: int) -> list[Any]:
+    """
+    ATTENTION: With `empty_attributes`, ldap3 deletes `member` from entries returning it by range,
+      which raises a KeyError when only the range was requested. It's turned off meanwhile,
+      so the entries are fetched at once.
+    """
+    empty_attributes = conn.empty_attributes
+    conn.empty_attributes = False
+    try:
+        return list(_search_dns(conn, dns, ['distinguishedName', f'member;range={low}-*'], kind='range'))
+    finally:
+        conn.empty_attributes = empty_attributes
+
+
+def _take_member_range(raw_team: RawIdpTeam, entry: Any) -> Optional[int]:
+    """
+    Move the values of `member;range=...` of `entry` to the members of `raw_team`.
+    Returns the low bound of the next range, or None if there are no more values.
+    """
+    range_names = [name for name in entry.keys() if _MEMBER_RANGE.fullmatch(name)]
+    if not range_names:
+        return None
+    if 'member' not in raw_team:
+        # The attribute itself is left out when it's returned by range
+        raw_team['member'] = []
+    match = _MEMBER_RANGE.fullmatch(range_names[0])
+    assert match
+    raw_team['member'].extend(entry[range_names[0]])
+    del entry[range_names[0]]
+    return None if match[2] == '*' else int(match[2]) + 1
+
+
+def _measure_search(kind: str, entries: Iterator[Any]) -> Iterator[Any]:
+    """Record a streamed search. Only the time spent waiting for the server is measured, not consuming entries"""
+    ldap_searches.inc(kind=kind)
+    entry_count = 0
+    duration = 0.0
+    try:
+        while True:
+            start_time = time.perf_counter()
+            try:
+                entry = next(entries)
+            except StopIteration:
+                return
+            finally:
+                duration += time.perf_counter() - start_time
+            entry_count += 1
+            yield entry
+    finally:
+        ldap_entries.inc(entry_count, kind=kind)
+        ldap_search_duration.observe(duration, kind=kind)
+
+
+def _to_idp_users(raw_idp_users: Iterable[RawIdpUser], dn_index: DnIndex) -> Iterator[IdpUser]:
+    for raw_user in raw_idp_users:
+        if not raw_user['mail']:
+            continue
+        yield IdpUser(
+            ref_id=dn_index.canonical(raw_user['distinguishedName']),
+            name=raw_user['displayName'].split("/")[0],
+            email=raw_user['mail'],
+            phone_number=raw_user.get('mobile') or '',
+            photo_hash=hash_photo(photo) if (photo := _get_photo(raw_user)) else None
+        )
+
+
+def _to_idp_groups(raw_idp_teams: Iterable[RawIdpTeam], dn_index: DnIndex) -> Iterator[_IdpGroup]:
+    for raw_team in raw_idp_teams:
+        if not raw_team['displayName'] or _is_excluded(dn_index.key(raw_team['distinguishedName'])):
+            continue
+        yield _IdpGroup(
+            dn=raw_team['distinguishedName'],
+            name=raw_team['displayName'],
+            parent_dn=raw_team['memberOf'][0] if raw_team['memberOf'] else None,
+            member_keys=[dn_index.key(member) for member in raw_team['member']]
+        )
+
+
+def _to_idp_teams(idp_groups: list[_IdpGroup], idp_users: list[IdpUser], dn_index: DnIndex) -> Iterator[IdpTeam]:
+    """
+    Members and parents are looked up by their DN keys
+    and spelled like the ref_ids of the users and teams they refer to
+    """
+    idp_users_by_key = {dn_index.key(user.ref_id): user for user in idp_users}
+    # ATTENTION: The own DNs of all the groups are registered before any parent is resolved,
+    #  otherwise a child coming first would spell the ref_id of its parent with its `memberOf` value
+    for idp_group in idp_groups:
+        dn_index.canonical(idp_group.dn)
+    for idp_group in idp_groups:
+        yield IdpTeam(
+            ref_id=dn_index.canonical(idp_group.dn),
+            name=idp_group.name,
+            parent_ref_id=dn_index.canonical(idp_group.parent_dn) if idp_group.parent_dn else None,
+            users=[idp_users_by_key[member_key] for member_key in idp_group.member_keys
+                   if member_key in idp_users_by_key]
+        )
+
+
+# Case-folded CNs. A group is excluded if any CN of its DN is one of them, e.g. a group nested in an excluded one
+_teams_to_exclude = frozenset(name.strip().casefold() for name in settings.TEAMS_TO_EXCLUDE.split(',') if name.strip())
+
+
+def _is_excluded(key: DnKey) -> bool:
+    return any(attribute_type == 'cn' and value in _teams_to_exclude for attribute_type, value in key)
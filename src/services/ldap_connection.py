@@ -1,8 +1,20 @@
 import ssl
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from types import TracebackType
+from typing import Any, Callable, Iterator, Optional, TypeVar, Union
 
-from ldap3 import Tls, Server, ALL, SYNC, SIMPLE, Connection
+from ldap3 import Tls, Server, ServerPool, ALL, FIRST, SYNC, SIMPLE, Connection
+from ldap3.core.exceptions import LDAPException
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from src.core.metrics import ldap_binds
+
+_T = TypeVar('_T')
+# Cycles through the DCs of LDAP_SERVER_DOMAIN before giving up
+_SERVER_POOL_CYCLES = 2
+
 
 class LdapSettings(BaseSettings):
     model_config = SettingsConfigDict(
@@ -11,28 +23,154 @@ class LdapSettings(BaseSettings):
         extra="ignore"
     )
 
-    LDAP_SERVER_DOMAIN: str
+    LDAP_SERVER_DOMAIN: str  # Comma-separated DCs are tried in order, e.g. when the first one is down
     LDAP_SERVER_PORT: int
     LDAP_USER: str
     LDAP_PASSWORD: str
     LDAP_SEARCH_BASE: str
     LDAP_USER_OUS: str
     LDAP_GROUP_OUS: str
+    LDAP_PAGE_SIZE: int = 500  # Entries per page of a paged search. AD's MaxPageSize is 1000 by default
+    LDAP_SEARCH_CONCURRENCY: int = 8  # OUs searched at once, each over its own connection
+
+    # Import only the entries changed since the last successful run (Active Directory only)
+    LDAP_INCREMENTAL_SYNC: bool = False
+    LDAP_FULL_SCAN_INTERVAL_HOURS: int = 24  # A full scan is still done at this interval
+
 
+# Connects to an in-process stand-in of the directory instead of the IdP. See `use_stand_in_directory`
+_connect_stand_in: Optional[Callable[[str, str], Connection]] = None
 
-def connect_ldap() -> Connection:
+
+def use_stand_in_directory(connect: Optional[Callable[[str, str], Connection]]) -> None:
+    """
+    Connect with `connect(user, password)` instead of to the IdP, e.g. to an in-process stand-in in benchmarks.
+    None restores the IdP.
+    """
+    global _connect_stand_in
+    _connect_stand_in = connect
+
+
+def connect_ldap(server: Optional[Server] = None) -> Connection:
+    """
+    Connect to `server`, or to the first available DC of LDAP_SERVER_DOMAIN.
+    Every connection is bound once, when it's entered or by `LdapConnectionPool`
+    """
     ldap_settings = LdapSettings()
-    tls_config = Tls(validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1_2)
-    server = Server(
-        ldap_settings.LDAP_SERVER_DOMAIN,
-        port=ldap_settings.LDAP_SERVER_PORT,
-        tls=tls_config,
-        get_info=ALL
-    )
+    ldap_binds.inc()
+    if _connect_stand_in is not None:
+        return _connect_stand_in(ldap_settings.LDAP_USER, ldap_settings.LDAP_PASSWORD)
     return Connection(
-        server,
+        server or _get_servers(ldap_settings),
         user=ldap_settings.LDAP_USER,
         password=ldap_settings.LDAP_PASSWORD,
         client_strategy=SYNC,
-        authentication=SIMPLE
+        authentication=SIMPLE,
+        # ATTENTION: Otherwise a failed page of a paged search silently ends the search
+        raise_exceptions=True,
+        # Values returned by range are fetched by idp_data, a batch of groups at a time
+        auto_range=False
     )
+
+
+def _get_servers(ldap_settings: LdapSettings) -> Union[Server, ServerPool]:
+    tls_config = Tls(validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1_2)
+    servers = [Server(
+        domain.strip(),
+        port=ldap_settings.LDAP_SERVER_PORT,
+        tls=tls_config,
+        get_info=ALL
+    ) for domain in ldap_settings.LDAP_SERVER_DOMAIN.split(',')]
+    if len(servers) == 1:
+        return servers[0]
+    return ServerPool(servers, FIRST, active=_SERVER_POOL_CYCLES, exhaust=False)  # type: ignore[arg-type]
+
+
+class LdapConnectionPool:
+    """
+    Bound connections lent to the threads searching the directory at once.
+    Connections are opened when none is idle, so there are as many as searches run at once,
+    and they are all unbound when the pool is closed.
+    ATTENTION: All connections are made to the DC the first one was bound to,
+      because USNs of the incremental sync are local to a DC.
+    """
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or LdapSettings().LDAP_SEARCH_CONCURRENCY,
+            thread_name_prefix='ldap_reader'
+        )
+        self._lock = threading.Lock()
+        self._server: Optional[Server] = None
+        self._connections: list[Connection] = []
+        self._idle_connections: list[Connection] = []
+
+    def __enter__(self) -> 'LdapConnectionPool':
+        # Bind the first connection right away to fail early and to pick the DC
+        try:
+            with self.connection():
+                pass
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """Lend a connection to the calling thread"""
+        with self._lock:
+            conn = self._idle_connections.pop() if self._idle_connections else None
+        if conn is None:
+            conn = self._open()
+        try:
+            yield conn
+        except BaseException:
+            # It may be left in the middle of a paged search
+            self._discard(conn)
+            raise
+        with self._lock:
+            self._idle_connections.append(conn)
+
+    def submit(self, fn: Callable[..., _T], *args: Any) -> 'Future[_T]':
+        """Run `fn(conn, *args)` on a worker thread with a connection of the pool"""
+        return self._executor.submit(self._run, fn, *args)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            connections, self._connections, self._idle_connections = self._connections, [], []
+        for conn in connections:
+            _unbind(conn)
+
+    def _run(self, fn: Callable[..., _T], *args: Any) -> _T:
+        with self.connection() as conn:
+            return fn(conn, *args)
+
+    def _open(self) -> Connection:
+        conn = connect_ldap(self._server)
+        conn.bind()
+        with self._lock:
+            self._connections.append(conn)
+            if self._server is None:
+                # The DC picked from the server pool
+                self._server = conn.server
+        return conn
+
+    def _discard(self, conn: Connection) -> None:
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        _unbind(conn)
+
+
+def _unbind(conn: Connection) -> None:
+    try:
+        conn.unbind()
+    except LDAPException:
+        # The connection may already be broken
+        pass
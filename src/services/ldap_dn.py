@@ -0,0 +1,51 @@
+"""
+Distinguished names compared the way AD compares them.
+AD may spell the DN of the same entry differently, e.g. `memberOf` in another case than `distinguishedName`,
+so DNs used as ref_ids are compared by their keys, never as strings.
+"""
+import re
+import sys
+
+# The RDNs of a DN, which are separated by unescaped commas
+_RDN = re.compile(r'(?:[^,\\]|\\.)+')
+
+# (attribute type, value) of each RDN from the entry up, e.g. (('cn', 'sales team'), ('ou', 'groups'), ...)
+DnKey = tuple[tuple[str, str], ...]
+
+
+def parse_dn_key(dn: str) -> DnKey:
+    """Attribute types are lowercased and values case-folded. Spaces around the separators are ignored"""
+    rdns = []
+    for rdn in _RDN.findall(dn):
+        attribute_type, _, value = rdn.partition('=')
+        rdns.append((sys.intern(attribute_type.strip().lower()), value.strip().casefold()))
+    return tuple(rdns)
+
+
+def is_under(key: DnKey, base_keys: tuple[DnKey, ...]) -> bool:
+    """Whether the entry is below one of the bases, e.g. one of the OUs of a search"""
+    return any(len(key) > len(base_key) and key[-len(base_key):] == base_key for base_key in base_keys)
+
+
+class DnIndex:
+    """
+    Parses each DN once and spells all the DNs of an entry the way the first of them was spelled
+    It may be shared by threads, as its dicts are only changed by single operations.
+    ATTENTION: Every DN seen is kept, so use one index per sync run
+    """
+    def __init__(self) -> None:
+        self._keys: dict[str, DnKey] = {}
+        # Spellings of the same entry share a single key
+        self._shared_keys: dict[DnKey, DnKey] = {}
+        self._dns_by_key: dict[DnKey, str] = {}
+
+    def key(self, dn: str) -> DnKey:
+        key = self._keys.get(dn)
+        if key is None:
+            key = parse_dn_key(dn)
+            key = self._keys[dn] = self._shared_keys.setdefault(key, key)
+        return key
+
+    def canonical(self, dn: str) -> str:
+        return self._dns_by_key.setdefault(self.key(dn), dn)
+
@@ -12,20 +12,28 @@ class _Scheduler:
     def __init__(self) -> None:
         self._event: Optional[threading.Event] = None
         self._job: Optional[schedule.Job] = None
+        self._interval_job: Optional[schedule.Job] = None
 
     def initialize(self) -> None:
         """Initialize scheduler"""
-        if not settings.SCHEDULE_TIME or self._job:
+        if not (settings.SCHEDULE_TIME or settings.SCHEDULE_INTERVAL_MINUTES) \
+                or self._job or self._interval_job:
             return None
         self._run_continuously()
-        self._job = schedule.every().day.at(settings.SCHEDULE_TIME).do(provisioner.start)
-        print(f"Scheduled job: {self._job} at {settings.SCHEDULE_TIME}")
+        if settings.SCHEDULE_TIME:
+            self._job = schedule.every().day.at(settings.SCHEDULE_TIME).do(provisioner.start)
+            print(f"Scheduled job: {self._job} at {settings.SCHEDULE_TIME}")
+        if settings.SCHEDULE_INTERVAL_MINUTES:
+            # A run is skipped if the previous one is still in progress
+            self._interval_job = schedule.every(settings.SCHEDULE_INTERVAL_MINUTES).minutes.do(provisioner.start)
+            print(f"Scheduled job: {self._interval_job}")
 
     def stop(self) -> None:
         """Stop scheduler if exists"""
-        if self._job:
-            schedule.cancel_job(self._job)
-            print(f"Cancelled job: {self._job}")
+        for job in (self._job, self._interval_job):
+            if job:
+                schedule.cancel_job(job)
+                print(f"Cancelled job: {job}")
         if self._event:
             self._event.set()
             print("Scheduler event set to cease continuous run.")
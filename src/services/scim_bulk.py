@@ -0,0 +1,175 @@
+"""
+Applies user updates through the SCIM API, grouped into /Bulk requests.
+"""
+import asyncio
+import threading
+from typing import Any, Optional
+
+from httpx import AsyncClient, Client, HTTPStatusError, Response
+
+from src.core.constants import settings
+from src.services.sync_plan import UserUpdate
+from src.services.write_executor import SwitWriteExecutor
+
+# TODO: Replace the SCIM API with the new API when it's ready
+SCIM_BASE_URL = 'https://saml.swit.io/scim/v2'
+
+# Responses of the /Bulk endpoint meaning that the server doesn't support it
+_BULK_UNAVAILABLE_STATUS_CODES = (404, 405, 501)
+
+
+class ScimUserUpdater:
+    """
+    Sends the operations of many users in a single SCIM /Bulk request (RFC 7644 3.7)
+    and maps the result of each operation back to its user.
+    ATTENTION: Once the server turns out not to support /Bulk, users are patched one by one for the rest of the run.
+    """
+    def __init__(self, client: Client, executor: SwitWriteExecutor,
+                 max_operations: Optional[int] = None, base_url: str = SCIM_BASE_URL) -> None:
+        self._client = client
+        self._executor = executor
+        self._max_operations = max(1, max_operations or settings.SCIM_BULK_MAX_OPERATIONS)
+        self._base_url = base_url
+        self._is_bulk_available = self._max_operations > 1
+        self._lock = threading.Lock()
+        self._errors: dict[str, str] = {}
+
+    def update(self, user_updates: list[UserUpdate]) -> dict[str, str]:
+        """Returns the errors of the users which failed to be updated, keyed by Swit user id"""
+        self._errors = {}
+        for i in range(0, len(user_updates), self._max_operations):
+            self._executor.submit(self._update_chunk, user_updates[i:i + self._max_operations])
+        self._executor.wait()
+        return self._errors
+
+    def _update_chunk(self, user_updates: list[UserUpdate]) -> None:
+        if not self._is_bulk_available or len(user_updates) == 1:
+            for user_update in user_updates:
+                self._patch(user_update)
+            return
+
+        res = self._send('POST', f"{self._base_url}/Bulk", _get_bulk_body(user_updates))
+        if res.status_code in _BULK_UNAVAILABLE_STATUS_CODES:
+            self._is_bulk_available = False
+            self._update_chunk(user_updates)
+            return
+        if res.status_code == 413:  # Payload too large
+            half = len(user_updates) // 2
+            self._update_chunk(user_updates[:half])
+            self._update_chunk(user_updates[half:])
+            return
+        with self._lock:
+            self._errors.update(_get_bulk_errors(user_updates, res))
+
+    def _patch(self, user_update: UserUpdate) -> None:
+        res = self._send('PATCH', f"{self._base_url}/Users/{user_update.user_id}", _get_patch_body(user_update))
+        if not res.is_success:
+            self._fail([user_update], _get_error(res.status_code, _get_json(res)))
+
+    def _send(self, method: str, url: str, body: dict[str, Any]) -> Response:
+        try:
+            return self._client.request(method, url, json=body)
+        except HTTPStatusError as e:
+            # SwitApiClient raises on failures, which are mapped to users instead
+            return e.response
+
+    def _fail(self, user_updates: list[UserUpdate], error: str) -> None:
+        with self._lock:
+            for user_update in user_updates:
+                self._errors[user_update.user_id] = error
+
+
+class AsyncScimUserUpdater:
+    """The asyncio counterpart of `ScimUserUpdater`"""
+    def __init__(self, client: AsyncClient, max_operations: Optional[int] = None,
+                 base_url: str = SCIM_BASE_URL) -> None:
+        self._client = client
+        self._max_operations = max(1, max_operations or settings.SCIM_BULK_MAX_OPERATIONS)
+        self._base_url = base_url
+        self._is_bulk_available = self._max_operations > 1
+        self._errors: dict[str, str] = {}
+
+    async def update(self, user_updates: list[UserUpdate]) -> dict[str, str]:
+        """Returns the errors of the users which failed to be updated, keyed by Swit user id"""
+        self._errors = {}
+        await asyncio.gather(*(self._update_chunk(user_updates[i:i + self._max_operations])
+                               for i in range(0, len(user_updates), self._max_operations)))
+        return self._errors
+
+    async def _update_chunk(self, user_updates: list[UserUpdate]) -> None:
+        if not self._is_bulk_available or len(user_updates) == 1:
+            await asyncio.gather(*(self._patch(user_update) for user_update in user_updates))
+            return
+
+        res = await self._send('POST', f"{self._base_url}/Bulk", _get_bulk_body(user_updates))
+        if res.status_code in _BULK_UNAVAILABLE_STATUS_CODES:
+            self._is_bulk_available = False
+            await self._update_chunk(user_updates)
+            return
+        if res.status_code == 413:  # Payload too large
+            half = len(user_updates) // 2
+            await asyncio.gather(self._update_chunk(user_updates[:half]), self._update_chunk(user_updates[half:]))
+            return
+        self._errors.update(_get_bulk_errors(user_updates, res))
+
+    async def _patch(self, user_update: UserUpdate) -> None:
+        res = await self._send('PATCH', f"{self._base_url}/Users/{user_update.user_id}",
+                               _get_patch_body(user_update))
+        if not res.is_success:
+            self._errors[user_update.user_id] = _get_error(res.status_code, _get_json(res))
+
+    async def _send(self, method: str, url: str, body: dict[str, Any]) -> Response:
+        try:
+            return await self._client.request(method, url, json=body)
+        except HTTPStatusError as e:
+            # AsyncSwitApiClient raises on failures, which are mapped to users instead
+            return e.response
+
+
+def _get_bulk_body(user_updates: list[UserUpdate]) -> dict[str, Any]:
+    return {
+        "schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkRequest"],
+        "Operations": [{
+            "method": "PATCH",
+            "bulkId": user_update.user_id,
+            "path": f"/Users/{user_update.user_id}",
+            "data": _get_patch_body(user_update)
+        } for user_update in user_updates]
+    }
+
+
+def _get_bulk_errors(user_updates: list[UserUpdate], res: Response) -> dict[str, str]:
+    """Map the result of each operation of a /Bulk response back to its user"""
+    if not res.is_success:
+        return {user_update.user_id: f"Bulk request failed with {res.status_code}" for user_update in user_updates}
+    body = _get_json(res)
+    operations = body.get('Operations', []) if isinstance(body, dict) else []
+    results = {operation.get('bulkId'): operation for operation in operations}
+    errors = {}
+    for user_update in user_updates:
+        result = results.get(user_update.user_id)
+        if result is None:
+            # The server stops processing when too many operations have failed
+            errors[user_update.user_id] = "Not processed"
+        elif int(result.get('status', 0)) >= 300:
+            errors[user_update.user_id] = _get_error(int(result['status']), result.get('response'))
+    return errors
+
+
+def _get_patch_body(user_update: UserUpdate) -> dict[str, Any]:
+    return {
+        "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+        "Operations": user_update.operations
+    }
+
+
+def _get_error(status_code: int, response: Any) -> str:
+    detail = response.get('detail') if isinstance(response, dict) else None
+    return f"{status_code} {detail}" if detail else str(status_code)
+
+
+def _get_json(res: Response) -> Any:
+    try:
+        return res.json()
+    except ValueError:
+        return None
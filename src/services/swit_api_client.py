@@ -1,51 +1,299 @@
 """
 Makes request to the Swit API using the access token stored.
 """
+import asyncio
+import random
+import re
+import threading
 import time
-from httpx import Client, Response
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from typing import Any, Optional
 
-from typing import Any
+from httpx import AsyncClient, Client, Response, TimeoutException, ConnectTimeout, PoolTimeout, URL
 
 from src.core.constants import settings
+from src.core.http import is_http2_available, shared_transport
 from src.core.logger import provisioning_logger as logger
-from src.database import get_service_account
-from src.services.swit_oauth import refresh_access_token
+from src.core.metrics import swit_api_request_duration, swit_api_requests, swit_api_retries
+from src.services.swit_oauth import token_manager
+
+# ATTENTION: These endpoints must not be retried after the request may have reached the server,
+#  otherwise the same entity could be created twice
+_NON_IDEMPOTENT_PATHS = ('/team.create', '/organization.user.create')
+
+_BACKOFF_BASE_SECONDS = 0.5
+_BACKOFF_MAX_SECONDS = 30.0
+# `X-RateLimit-Reset` values from this one (in 2001) on are unix timestamps rather than numbers of seconds
+_MIN_RATE_LIMIT_RESET_TIMESTAMP = 1_000_000_000
+
+# User ids in SCIM paths would make a metric series per user
+_SCIM_USER_PATH = re.compile(r'/Users/[^/]+$')
+
+
+class _RateGovernor:
+    """
+    Paces requests of every SwitApiClient in the process with an AIMD policy:
+    the rate grows additively on each success and is halved on each 429.
+    """
+    def __init__(self, initial_rate: float, max_rate: float, min_rate: float = 0.5,
+                 additive_increase: float = 0.1, multiplicative_decrease: float = 0.5) -> None:
+        self._lock = threading.Lock()
+        self._rate = initial_rate
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._additive_increase = additive_increase
+        self._multiplicative_decrease = multiplicative_decrease
+        self._next_slot = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def acquire(self) -> None:
+        """Block until the caller may send its next request"""
+        time.sleep(self.reserve())
+
+    def reserve(self) -> float:
+        """Reserve a slot for the next request and return how long to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + 1 / self._rate
+        return slot - now
+
+    def on_success(self, res: Response) -> None:
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._additive_increase)
+            # Respect the server's budget before it starts answering with 429
+            remaining = res.headers.get('x-ratelimit-remaining')
+            reset_after = _parse_rate_limit_reset(res.headers.get('x-ratelimit-reset'))
+            if remaining is not None and remaining.isdigit() and int(remaining) == 0 \
+                    and reset_after is not None:
+                self._pause(reset_after)
+
+    def on_throttled(self, retry_after: Optional[float]) -> None:
+        with self._lock:
+            self._rate = max(self._min_rate, self._rate * self._multiplicative_decrease)
+            self._pause(retry_after if retry_after is not None else 1 / self._rate)
+
+    def _pause(self, seconds: float) -> None:
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+rate_governor = _RateGovernor(
+    initial_rate=settings.SWIT_API_RATE_LIMIT,
+    max_rate=max(settings.SWIT_API_RATE_LIMIT, settings.SWIT_API_MAX_RATE_LIMIT)
+)
+
+
+class _Next(Enum):
+    RETURN = 'return'
+    REFRESH_TOKEN = 'refresh_token'
+    RETRY = 'retry'
+
+
+class _RequestAttempts:
+    """
+    Decides what follows each attempt of a request: returning the response, refreshing the token or retrying.
+    It never sends nor sleeps, so that `SwitApiClient` and `AsyncSwitApiClient` retry exactly the same way.
+    """
+    def __init__(self, method: str, url: URL | str) -> None:
+        self._method = method
+        self._url = url
+        self._is_idempotent = not str(url).endswith(_NON_IDEMPOTENT_PATHS)
+        self._is_token_refreshed = False
+        self._attempt = 0
+
+    def after_timeout(self, e: TimeoutException) -> Optional[float]:
+        """Return how long to wait before retrying, or None to give up"""
+        _record_failure(self._method, self._url, e)
+        # Connecting never reaches the server, so it's safe to retry on any endpoint
+        is_retryable = self._is_idempotent or isinstance(e, (ConnectTimeout, PoolTimeout))
+        if not is_retryable or self._attempt >= settings.SWIT_API_MAX_RETRIES:
+            return None
+        swit_api_retries.inc(reason='timeout')
+        delay = _get_backoff(self._attempt)
+        logger.info(f"{type(e).__name__} for {self._url}. Retrying in {delay:.1f} seconds...")
+        self._attempt += 1
+        return delay
+
+    def after_response(self, res: Response, duration: float) -> tuple[_Next, float]:
+        """Return what to do next, and how long to wait before doing it"""
+        _record_response(res, duration)
+
+        if res.status_code == 401 and not self._is_token_refreshed:
+            self._is_token_refreshed = True
+            swit_api_retries.inc(reason='401')
+            return _Next.REFRESH_TOKEN, 0.0
+
+        if res.status_code == 429 and self._attempt < settings.SWIT_API_MAX_RETRIES:  # Too many requests
+            # The rate governor paces the retry
+            rate_governor.on_throttled(_parse_retry_after(res))
+            logger.info(f"Too many requests. Slowing down to {rate_governor.rate:.1f} requests/s "
+                        f"for {res.request.url}...")
+            swit_api_retries.inc(reason='429')
+            self._attempt += 1
+            return _Next.RETRY, 0.0
+
+        # 501 Not Implemented won't change by retrying
+        if res.is_server_error and res.status_code != 501 and self._is_idempotent \
+                and self._attempt < settings.SWIT_API_MAX_RETRIES:
+            delay = _get_backoff(self._attempt)
+            logger.info(f"Server error {res.status_code} for {res.request.url}. "
+                        f"Retrying in {delay:.1f} seconds...")
+            swit_api_retries.inc(reason='5xx')
+            self._attempt += 1
+            return _Next.RETRY, delay
+
+        if res.is_success:
+            rate_governor.on_success(res)
+        else:
+            logger.error(f"Failed request: {_describe_request(res)}")
+        return _Next.RETURN, 0.0
 
 
 class SwitApiClient(Client):
     def __init__(self) -> None:
         super().__init__(
-            timeout=10,
-            base_url=settings.SWIT_BASE_URL + '/v1/api'
+            timeout=settings.HTTP_TIMEOUT_SECONDS,
+            base_url=settings.SWIT_BASE_URL + '/v1/api',
+            # Connections are kept alive across runs
+            transport=shared_transport
         )
-        self._token_info = get_service_account()
-        self._update_token_header()
-
-    def request(self, *args: Any, **kwargs: Any) -> Response:
-        res = super().request(*args, **kwargs)
-        if res.status_code == 401:
-            refresh_access_token(self._token_info)
-            self._update_token_header()
-            logger.info("Token refreshed")
-            res = super().request(*args, **kwargs)
-
-        retry_after = int(res.request.headers.get('x-retry-after', '0'))
-        if res.status_code == 429 and retry_after < 5:  # Too many requests
-            # Wait the specified number of seconds
-            retry_after += 1
-            logger.info(f"Too many requests. Waiting {retry_after} seconds for {res.request.url}...")
-            time.sleep(retry_after)
-            # Make the request again
-            res.request.headers.update({'x-retry-after': str(retry_after)})
-            kwargs['headers'] = res.request.headers
-            res = self.request(*args, **kwargs)
-
-        if not res.is_success:
-            logger.error(f"Failed request: {res.request.content.decode('utf-8')}")
+
+    def request(self, method: str, url: URL | str, **kwargs: Any) -> Response:
+        attempts = _RequestAttempts(method, url)
+        while True:
+            rate_governor.acquire()
+            access_token = token_manager.get_access_token()
+            start_time = time.perf_counter()
+            try:
+                res = super().request(method, url, **_with_authorization(kwargs, access_token))
+            except TimeoutException as e:
+                delay = attempts.after_timeout(e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            next_step, delay = attempts.after_response(res, time.perf_counter() - start_time)
+            if next_step == _Next.RETURN:
+                break
+            if next_step == _Next.REFRESH_TOKEN:
+                token_manager.refresh(access_token)
+                logger.info("Token refreshed")
+            time.sleep(delay)
+        res.raise_for_status()
+        return res
+
+
+class AsyncSwitApiClient(AsyncClient):
+    """
+    The asyncio counterpart of `SwitApiClient`, used when SWIT_ASYNC_SYNC is set.
+    Requests are multiplexed over HTTP/2 if the optional `h2` package is installed.
+    It has its own connection pool because async connections are bound to the event loop of a run.
+    Retries are decided by `_RequestAttempts`, like those of `SwitApiClient`.
+    """
+    def __init__(self, max_in_flight: Optional[int] = None) -> None:
+        super().__init__(
+            timeout=settings.HTTP_TIMEOUT_SECONDS,
+            base_url=settings.SWIT_BASE_URL + '/v1/api',
+            http2=is_http2_available()
+        )
+        # Caps the requests in flight, which would otherwise be every coroutine at once
+        self._semaphore = asyncio.Semaphore(max_in_flight or settings.SWIT_ASYNC_MAX_IN_FLIGHT)
+
+    async def request(self, method: str, url: URL | str, **kwargs: Any) -> Response:
+        attempts = _RequestAttempts(method, url)
+        while True:
+            await asyncio.sleep(rate_governor.reserve())
+            # Refreshing blocks, so it's done in a thread
+            access_token = await asyncio.to_thread(token_manager.get_access_token) \
+                if token_manager.is_refresh_due else token_manager.get_access_token()
+            try:
+                async with self._semaphore:
+                    # Waiting for the semaphore isn't latency of the API
+                    start_time = time.perf_counter()
+                    res = await super().request(method, url, **_with_authorization(kwargs, access_token))
+            except TimeoutException as e:
+                delay = attempts.after_timeout(e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            next_step, delay = attempts.after_response(res, time.perf_counter() - start_time)
+            if next_step == _Next.RETURN:
+                break
+            if next_step == _Next.REFRESH_TOKEN:
+                await asyncio.to_thread(token_manager.refresh, access_token)
+                logger.info("Token refreshed")
+            await asyncio.sleep(delay)
         res.raise_for_status()
         return res
 
-    def _update_token_header(self) -> None:
-        self.headers.update({
-            "Authorization": f"Bearer {self._token_info.access_token}"
-        })
+
+def _with_authorization(kwargs: dict[str, Any], access_token: str) -> dict[str, Any]:
+    """The token is set per request because it may be refreshed by another thread at any time"""
+    headers = dict(kwargs.get('headers') or {})
+    headers['Authorization'] = f"Bearer {access_token}"
+    return {**kwargs, 'headers': headers}
+
+
+def _describe_request(res: Response) -> str:
+    """Only JSON bodies are shown, so that multipart bodies such as profile photos don't flood the log"""
+    request = res.request
+    description = f"{request.method} {request.url} ({res.status_code})"
+    if 'json' in request.headers.get('content-type', ''):
+        description += f" {request.content.decode('utf-8', errors='replace')}"
+    return description
+
+
+def _get_endpoint(url: URL | str) -> str:
+    path = URL(url).path.removeprefix('/v1/api')
+    return _SCIM_USER_PATH.sub('/Users/{id}', path)
+
+
+def _record_response(res: Response, duration: float) -> None:
+    """Every attempt is recorded, so 401 and 429 show up even when they're retried successfully"""
+    method = res.request.method
+    endpoint = _get_endpoint(res.request.url)
+    swit_api_requests.inc(method=method, endpoint=endpoint, status=str(res.status_code))
+    swit_api_request_duration.observe(duration, method=method, endpoint=endpoint)
+
+
+def _record_failure(method: str, url: URL | str, e: Exception) -> None:
+    swit_api_requests.inc(method=method, endpoint=_get_endpoint(url), status=type(e).__name__)
+
+
+def _get_backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(_BACKOFF_MAX_SECONDS, _BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def _parse_retry_after(res: Response) -> Optional[float]:
+    """`Retry-After` is either a number of seconds or an HTTP date"""
+    value = res.headers.get('retry-after') or res.headers.get('x-retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_rate_limit_reset(value: Optional[str]) -> Optional[float]:
+    """`X-RateLimit-Reset` is either a number of seconds or a unix timestamp"""
+    if not value:
+        return None
+    try:
+        reset = float(value)
+    except ValueError:
+        return None
+    if reset >= _MIN_RATE_LIMIT_RESET_TIMESTAMP:
+        reset -= time.time()
+    return max(0.0, reset)
@@ -1,9 +1,11 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
 from urllib.parse import urlencode
 
-from httpx import Client
-
 from src.core.constants import settings
-from src.database import upsert_service_account
+from src.core.http import http_client
+from src.database import get_service_account, upsert_service_account
 from src.services.swit_schemas import SwitTokens
 
 
@@ -28,11 +30,12 @@ def exchange_authorization_code_for_token(code: str, redirect_uri: str) -> None:
         'client_id': settings.SWIT_CLIENT_ID,
         'client_secret': settings.SWIT_CLIENT_SECRET,
     }
-    with Client() as client:
-        response = client.post(token_url, data=data)
+    response = http_client.post(token_url, data=data)
     response.raise_for_status()  # Ensure to raise an exception for HTTP errors
     token_info = SwitTokens.model_validate(response.json())
+    token_info.expires_at = _get_expires_at(response.json())
     upsert_service_account(token_info)
+    token_manager.set_tokens(token_info)
 
 def refresh_access_token(token_info: SwitTokens) -> None:
     """ Refresh swit token """
@@ -48,10 +51,68 @@ def refresh_access_token(token_info: SwitTokens) -> None:
     }
 
     token_url = f"{settings.SWIT_BASE_URL}/oauth/token"
-    with Client() as client:
-        res = client.post(token_url, data=data_obj, headers=headers, timeout=10)
-        res.raise_for_status()
-    new_token_json: dict[str, str] = res.json()
+    res = http_client.post(token_url, data=data_obj, headers=headers)
+    res.raise_for_status()
+    new_token_json: dict[str, Any] = res.json()
     token_info.access_token = new_token_json["access_token"]
     token_info.refresh_token = new_token_json["refresh_token"]
+    token_info.expires_at = _get_expires_at(new_token_json)
     upsert_service_account(token_info)
+
+
+def _get_expires_at(token_json: dict[str, Any]) -> Optional[datetime]:
+    expires_in = token_json.get('expires_in')
+    if not isinstance(expires_in, (int, float)):
+        return None
+    return datetime.now(timezone.utc) + timedelta(seconds=expires_in)
+
+
+class _TokenManager:
+    """
+    Keeps the service account's tokens in memory and refreshes them shortly before they expire.
+    ATTENTION: A refresh token can be used only once, so concurrent refreshes are coalesced into one (single-flight).
+      Callers wait for the refresh in progress instead of starting another one with the same refresh token.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._tokens: Optional[SwitTokens] = None
+
+    def get_access_token(self) -> str:
+        with self._lock:
+            tokens = self._get_tokens()
+            if self._is_expiring(tokens):
+                refresh_access_token(tokens)
+            return tokens.access_token
+
+    @property
+    def is_refresh_due(self) -> bool:
+        """Whether `get_access_token` would block on a refresh"""
+        with self._lock:
+            return self._tokens is None or self._is_expiring(self._tokens)
+
+    def refresh(self, rejected_access_token: str) -> None:
+        """Refresh after a 401, unless another caller has already replaced the rejected token"""
+        with self._lock:
+            tokens = self._get_tokens()
+            if tokens.access_token == rejected_access_token:
+                refresh_access_token(tokens)
+
+    def set_tokens(self, tokens: SwitTokens) -> None:
+        with self._lock:
+            self._tokens = tokens
+
+    def _get_tokens(self) -> SwitTokens:
+        if self._tokens is None:
+            self._tokens = get_service_account()
+        return self._tokens
+
+    @staticmethod
+    def _is_expiring(tokens: SwitTokens) -> bool:
+        if tokens.expires_at is None:
+            # Tokens of unknown expiry are refreshed on 401
+            return False
+        refresh_at = tokens.expires_at - timedelta(seconds=settings.SWIT_TOKEN_REFRESH_MARGIN_SECONDS)
+        return datetime.now(timezone.utc) >= refresh_at
+
+
+token_manager = _TokenManager()
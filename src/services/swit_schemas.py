@@ -1,11 +1,15 @@
 import re
+from datetime import datetime
 from enum import IntEnum
 
 from typing import Optional, Annotated
 from pydantic import BaseModel, Field, ConfigDict, AfterValidator
+from pydantic.dataclasses import dataclass
 
 from src.core.constants import settings
 
+_NON_PHONE_NUMBER_CHARACTERS = re.compile(r'[^0-9+-]')
+
 
 class SwitUserRoleEnum(IntEnum):
     MASTER = 10
@@ -14,15 +18,19 @@ class SwitUserRoleEnum(IntEnum):
     GUEST = 40
 
 
-class SwitUser(BaseModel):
-    """A class to hold team information"""
-    model_config = ConfigDict(populate_by_name=True, extra='ignore')
+@dataclass(slots=True, kw_only=True, config=ConfigDict(populate_by_name=True, extra='ignore'))
+class SwitUser:
+    """
+    A class to hold user information
+    ATTENTION: It's a slotted dataclass rather than a BaseModel to keep every user of a large organization
+      in memory cheaply. It's still validated like a model.
+    """
 
     id: str = Field(..., alias='user_id')
     name: str = Field(..., alias='user_name')
     email: str
     phone_number: Annotated[str,
-    AfterValidator(lambda v: re.sub(r'[^0-9+-]', '', v)),
+    AfterValidator(lambda v: _NON_PHONE_NUMBER_CHARACTERS.sub('', v)),
     Field(..., alias='tel')]
     timezone: str
     language: str
@@ -30,6 +38,23 @@ class SwitUser(BaseModel):
     role: SwitUserRoleEnum
 
 
+class _SwitUserListData(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
+    users: list[SwitUser]
+
+
+class SwitUserListResponse(BaseModel):
+    """
+    A class to decode a page of `/organization.user.list`
+    ATTENTION: Decode it with `model_validate_json` so that the JSON is parsed and validated in one pass
+      without building intermediate dicts
+    """
+    model_config = ConfigDict(extra='ignore')
+
+    data: _SwitUserListData
+
+
 class SwitUserRequest(BaseModel):
     """A class when used to create a Swit user"""
     model_config = ConfigDict(populate_by_name=True, extra='forbid')
@@ -51,6 +76,24 @@ class SwitTeam(BaseModel):
     user_ids: list[str] = Field([], alias='users')
 
 
+class SwitTeamListItem(SwitTeam):
+    """A class to hold Swit team information returned by `/user.team.list`"""
+    depth: int
+
+
+class _SwitTeamListData(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
+    team: list[SwitTeamListItem]
+
+
+class SwitTeamListResponse(BaseModel):
+    """A class to decode `/user.team.list`. See `SwitUserListResponse`"""
+    model_config = ConfigDict(extra='ignore')
+
+    data: _SwitTeamListData
+
+
 class SwitTeamRequest(BaseModel):
     """A class when used to update or create a Swit team"""
     model_config = ConfigDict(populate_by_name=True, strict=True, extra='forbid')
@@ -67,3 +110,35 @@ class SwitTokens(BaseModel):
 
     access_token: str
     refresh_token: str
+    expires_at: Optional[datetime] = None  # Unknown for tokens stored before the expiry was tracked
+
+
+class AppliedSwitUser(BaseModel):
+    """A class to hold what was last applied to a Swit user"""
+    model_config = ConfigDict(extra='ignore')
+
+    ref_id: str
+    email: str
+    swit_user_id: Optional[str]  # None if the user doesn't exist on Swit
+    name: str
+    phone_number: str
+    content_hash: str
+
+
+class AppliedSwitTeam(BaseModel):
+    """A class to hold what was last applied to a Swit team"""
+    model_config = ConfigDict(extra='ignore')
+
+    ref_id: str
+    swit_team_id: str
+    name: str
+    parent_ref_id: Optional[str]
+    member_emails: list[str]
+    content_hash: str
+
+
+class LdapWatermark(BaseModel):
+    """The position in the directory up to which changes have been applied to Swit"""
+    invocation_id: str  # Identifies the database of the DC that issued the USN
+    highest_usn: int
+    last_full_scan_at: datetime
@@ -0,0 +1,226 @@
+"""
+Swit users and teams fetched once per sync run.
+"""
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+from src.core.constants import settings
+from src.services.ldap_dn import DnIndex, DnKey
+from src.services.swit_api_client import SwitApiClient
+from src.services.swit_schemas import SwitTeam, SwitUser, SwitUserListResponse, SwitTeamListResponse
+
+_USER_PAGE_SIZE = 1000
+
+
+class TeamDirectory:
+    """
+    Swit teams indexed by id, ref_id (by its DN key, see `ldap_dn`), case-folded name and parent id
+    ATTENTION: The indexes are kept up-to-date incrementally,
+      so the name and parent of a team must only be changed through `update`
+    """
+    def __init__(self, root_team_id: str, teams: Iterable[SwitTeam]) -> None:
+        self.root_team_id = root_team_id
+        self._teams_by_id: dict[str, SwitTeam] = {}
+        self._dn_index = DnIndex()
+        self._teams_by_ref_id: dict[DnKey, SwitTeam] = {}
+        self._name_counts: Counter[str] = Counter()
+        self._reserved_names: set[str] = set()
+        # Children are kept in dicts to remove them in O(1) while keeping their order
+        self._children_by_parent_id: defaultdict[str, dict[str, SwitTeam]] = defaultdict(dict)
+        for team in teams:
+            self.add(team)
+
+    def __iter__(self) -> Iterator[SwitTeam]:
+        return iter(list(self._teams_by_id.values()))
+
+    def __len__(self) -> int:
+        return len(self._teams_by_id)
+
+    def get(self, team_id: str) -> Optional[SwitTeam]:
+        return self._teams_by_id.get(team_id)
+
+    def get_by_ref(self, ref_id: str) -> Optional[SwitTeam]:
+        return self._teams_by_ref_id.get(self._dn_index.key(ref_id))
+
+    def get_children(self, parent_id: str) -> list[SwitTeam]:
+        return list(self._children_by_parent_id.get(parent_id, {}).values())
+
+    def is_name_taken(self, name: str) -> bool:
+        """Be aware that the Swit API is case-insensitive"""
+        key = name.casefold()
+        return self._name_counts[key] > 0 or key in self._reserved_names
+
+    def reserve_name(self, name: str) -> None:
+        """Keep a name taken for a team which is about to be created or renamed"""
+        self._reserved_names.add(name.casefold())
+
+    def add(self, team: SwitTeam) -> None:
+        self._teams_by_id[team.id] = team
+        if team.ref_id:
+            self._teams_by_ref_id[self._dn_index.key(team.ref_id)] = team
+        self._name_counts[team.name.casefold()] += 1
+        self._children_by_parent_id[team.parent_id][team.id] = team
+
+    def remove(self, team: SwitTeam) -> None:
+        if self._teams_by_id.pop(team.id, None) is None:
+            return
+        if team.ref_id and self.get_by_ref(team.ref_id) is team:
+            del self._teams_by_ref_id[self._dn_index.key(team.ref_id)]
+        self._name_counts[team.name.casefold()] -= 1
+        self._children_by_parent_id[team.parent_id].pop(team.id, None)
+
+    def update(self, team: SwitTeam, name: Optional[str] = None, parent_id: Optional[str] = None) -> None:
+        is_indexed = team.id in self._teams_by_id
+        if is_indexed:
+            self.remove(team)
+        if name is not None:
+            team.name = name
+        if parent_id is not None:
+            team.parent_id = parent_id
+        if is_indexed:
+            self.add(team)
+
+
+class SwitSnapshot:
+    """
+    Holds the state of the Swit organization for one sync run.
+    ATTENTION: Our own successful writes must be applied to the snapshot with the methods below
+      so that later phases see the current state without listing the organization again.
+      They may be called from the write executor's threads.
+    """
+    def __init__(self, api_client: SwitApiClient) -> None:
+        self._api_client = api_client
+        self._lock = threading.Lock()
+        self._users_by_email: Optional[dict[str, SwitUser]] = None
+        self._teams: Optional[TeamDirectory] = None
+        self._duplicate_teams: list[SwitTeam] = []
+
+    @property
+    def users_by_email(self) -> dict[str, SwitUser]:
+        if self._users_by_email is None:
+            self._users_by_email = self._fetch_users()
+        return self._users_by_email
+
+    @property
+    def teams(self) -> TeamDirectory:
+        """All teams except for the root team and 'Unassigned' team"""
+        if self._teams is None:
+            self._teams = self._fetch_teams()
+        return self._teams
+
+    @property
+    def duplicate_teams(self) -> list[SwitTeam]:
+        """
+        Teams whose ref_id is another team's too, except for the one with the most members.
+        They're in `teams` but never found by ref_id, and are left to the sync plan to delete.
+        """
+        if self._teams is None:
+            self._teams = self._fetch_teams()
+        return self._duplicate_teams
+
+    def update_user(self, email: str, name: str, phone_number: str) -> None:
+        with self._lock:
+            # Users may be updated without being listed
+            if self._users_by_email is None or email not in self._users_by_email:
+                return
+            swit_user = self._users_by_email[email]
+            swit_user.name = name
+            swit_user.phone_number = phone_number
+
+    def add_team(self, swit_team: SwitTeam) -> None:
+        with self._lock:
+            self._get_teams().add(swit_team)
+
+    def remove_team(self, swit_team: SwitTeam) -> None:
+        with self._lock:
+            self._get_teams().remove(swit_team)
+
+    def update_team(self, swit_team: SwitTeam,
+                    name: Optional[str] = None, parent_id: Optional[str] = None) -> None:
+        with self._lock:
+            self._get_teams().update(swit_team, name=name, parent_id=parent_id)
+
+    def add_members(self, swit_team: SwitTeam, user_ids: set[str]) -> None:
+        with self._lock:
+            swit_team.user_ids = swit_team.user_ids + sorted(user_ids - set(swit_team.user_ids))
+
+    def remove_members(self, swit_team: SwitTeam, user_ids: set[str]) -> None:
+        with self._lock:
+            swit_team.user_ids = [user_id for user_id in swit_team.user_ids if user_id not in user_ids]
+
+    def _get_teams(self) -> TeamDirectory:
+        assert self._teams is not None, 'Teams must be fetched before they are modified'
+        return self._teams
+
+    def _fetch_users(self) -> dict[str, SwitUser]:
+        """
+        Get existing swit users
+        Once the page size is known, pages are requested ahead of the one being decoded,
+        SWIT_READ_CONCURRENCY at a time. A page shorter than the ones before it is the last one,
+        so no empty page needs to be awaited.
+        """
+        swit_users_by_email: dict[str, SwitUser] = {}
+        with ThreadPoolExecutor(max_workers=settings.SWIT_READ_CONCURRENCY,
+                                thread_name_prefix='swit_reader') as pool:
+            futures: dict[int, Future[list[SwitUser]]] = {}
+            page = next_page = 1
+            page_size = 0
+            is_page_size_known = False
+            while True:
+                window = settings.SWIT_READ_CONCURRENCY if is_page_size_known else 1
+                while next_page < page + window:
+                    futures[next_page] = pool.submit(self._fetch_user_page, next_page)
+                    next_page += 1
+                swit_users = futures.pop(page).result()
+                # Map swit users by email
+                for swit_user in swit_users:
+                    swit_users_by_email[swit_user.email] = swit_user
+                if not swit_users or len(swit_users) < page_size:
+                    break
+                # ATTENTION: The server may return fewer users per page than requested,
+                #  so the page size is only known after a full page or two pages of the same size
+                is_page_size_known = len(swit_users) == _USER_PAGE_SIZE or len(swit_users) == page_size
+                page_size = len(swit_users)
+                page += 1
+            for future in futures.values():
+                future.cancel()
+        return swit_users_by_email
+
+    def _fetch_user_page(self, page: int) -> list[SwitUser]:
+        res = self._api_client.get(
+            '/organization.user.list',
+            params={
+                'cnt': _USER_PAGE_SIZE,
+                'page': page,
+            })
+        return SwitUserListResponse.model_validate_json(res.content).data.users
+
+    def _fetch_teams(self) -> TeamDirectory:
+        """Get existing swit teams"""
+        res = self._api_client.get('/user.team.list')
+        swit_team_list_items = SwitTeamListResponse.model_validate_json(res.content).data.team
+        root_team_id = next(team.id for team in swit_team_list_items if team.depth == 0)
+
+        # ATTENTION: Ensure that all ref_ids are unique, including those spelled differently
+        dn_index = DnIndex()
+        teams_by_ref_id: defaultdict[DnKey, list[SwitTeam]] = defaultdict(list)
+        for swit_team in swit_team_list_items:
+            if swit_team.ref_id:
+                teams_by_ref_id[dn_index.key(swit_team.ref_id)].append(swit_team)
+        self._duplicate_teams = []
+        for duplicate_teams in teams_by_ref_id.values():
+            if len(duplicate_teams) < 2:
+                continue
+            # Keep the team with the most members
+            duplicate_teams.sort(key=lambda team: len(team.user_ids), reverse=True)
+            self._duplicate_teams.extend(duplicate_teams[1:])
+
+        # ATTENTION: Exclude the root team and 'Unassigned' team
+        #  because they're not actual teams.
+        #  Duplicates are added first so that the teams kept are the ones found by ref_id
+        duplicate_team_ids = {team.id for team in self._duplicate_teams}
+        return TeamDirectory(root_team_id, sorted(
+            (team for team in swit_team_list_items if team.id != root_team_id and team.name != 'Unassigned'),
+            key=lambda team: team.id not in duplicate_team_ids))
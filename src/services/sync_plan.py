@@ -0,0 +1,352 @@
+"""
+Computes the changes needed to bring Swit in line with the IdP without writing anything.
+"""
+import re
+from functools import lru_cache
+from typing import Optional
+
+from pydantic import BaseModel, PrivateAttr
+
+from src.services.applied_state import AppliedState
+from src.services.idp_data import IdpSnapshot, IdpTeam
+from src.services.ldap_dn import parse_dn_key
+from src.services.swit_snapshot import SwitSnapshot, TeamDirectory
+
+
+class UserUpdate(BaseModel):
+    """SCIM patch operations for a Swit user"""
+    ref_id: str
+    user_id: str
+    email: str
+    name: str
+    phone_number: str
+    operations: list[dict[str, str]]
+
+
+class TeamDeletion(BaseModel):
+    team_id: str
+    name: str
+
+
+class TeamCreation(BaseModel):
+    """
+    ATTENTION: `parent_ref_id` is set instead of `parent_id`
+      when the parent is created by the same plan at a lower `level`
+    """
+    ref_id: str
+    name: str
+    parent_id: Optional[str] = None
+    parent_ref_id: Optional[str] = None
+    level: int
+
+
+class TeamUpdate(BaseModel):
+    """Only the fields to change are set. See `TeamCreation` for the parent fields"""
+    ref_id: str
+    team_id: str
+    name: Optional[str] = None
+    parent_id: Optional[str] = None
+    parent_ref_id: Optional[str] = None
+
+
+class TeamMembershipUpdate(BaseModel):
+    """The team is referred to by ref_id because it may be created by the same plan"""
+    ref_id: str
+    user_ids_to_add: list[str] = []
+    user_ids_to_remove: list[str] = []
+
+
+class SyncPlan(BaseModel):
+    """
+    Every write a sync run is going to make, in the order they must be applied:
+    user updates, team deletions, team creations level by level, then team updates and memberships.
+    """
+    user_updates: list[UserUpdate] = []
+    team_deletions: list[TeamDeletion] = []
+    team_creations: list[TeamCreation] = []
+    team_updates: list[TeamUpdate] = []
+    team_membership_updates: list[TeamMembershipUpdate] = []
+    warnings: list[str] = []
+    # The IdP teams to record as applied once the plan has been applied
+    _changed_teams: list[IdpTeam] = PrivateAttr(default_factory=list)
+
+    @property
+    def changed_teams(self) -> list[IdpTeam]:
+        return self._changed_teams
+
+    @property
+    def has_team_changes(self) -> bool:
+        return bool(self._changed_teams or self.team_deletions or self.team_creations
+                    or self.team_updates or self.team_membership_updates)
+
+
+def plan_sync(idp: IdpSnapshot, swit: SwitSnapshot, applied: AppliedState) -> SyncPlan:
+    """
+    Diff the IdP against Swit. Nothing is written to Swit or to the database.
+    ATTENTION: Users are recorded in `applied` (in memory only) as they will be once the plan is applied,
+      because whether a team has changed depends on which of its members exist on Swit.
+      The records are persisted only when the plan is applied.
+    """
+    plan = SyncPlan()
+    _SyncPlanner(plan, idp, swit, applied)
+    return plan
+
+
+class _SyncPlanner:
+    def __init__(self, plan: SyncPlan, idp: IdpSnapshot, swit: SwitSnapshot, applied: AppliedState) -> None:
+        self._plan = plan
+        self._idp = idp
+        self._swit = swit
+        self._applied = applied
+        self._cyclic_team_ref_ids: set[str] = set()
+        self._created_team_ref_ids: set[str] = set()
+        self._plan_users()
+        self._plan_teams()
+
+    def _plan_users(self) -> None:
+        for idp_user in self._idp.users:
+            username = _clean_string(idp_user.name)
+            if self._applied.is_user_up_to_date(idp_user.ref_id, idp_user.email, username, idp_user.phone_number):
+                continue
+
+            applied_user = self._applied.users.get(idp_user.ref_id)
+            if applied_user and not self._applied.is_full_reconciliation:
+                # The user is compared against what was last applied instead of listing all Swit users
+                if applied_user.swit_user_id is None:
+                    # Users who haven't joined Swit are looked up again at the next full reconciliation
+                    self._applied.record_user(idp_user.ref_id, idp_user.email, None,
+                                              username, idp_user.phone_number)
+                    continue
+                swit_user_id = applied_user.swit_user_id
+                swit_user_name = applied_user.name
+                swit_user_phone_number = applied_user.phone_number
+            else:
+                swit_user = self._swit.users_by_email.get(idp_user.email)
+
+                # Users who haven't joined Swit are created by SSO, not by the sync
+                if not swit_user:
+                    self._applied.record_user(idp_user.ref_id, idp_user.email, None,
+                                              username, idp_user.phone_number)
+                    continue
+                swit_user_id = swit_user.id
+                swit_user_name = swit_user.name
+                swit_user_phone_number = swit_user.phone_number
+
+            # TODO: Replace the SCIM API with the new API when it's ready
+            operations = []
+            if username != swit_user_name:
+                operations.append({
+                    "op": "Replace",
+                    "path": "displayName",
+                    "value": username
+                })
+            if idp_user.phone_number != swit_user_phone_number:
+                operations.append({
+                    "op": "Replace",
+                    "path": "phoneNumbers[type eq \"mobile\"].value",
+                    "value": idp_user.phone_number
+                })
+            self._applied.record_user(idp_user.ref_id, idp_user.email, swit_user_id,
+                                      username, idp_user.phone_number)
+            if operations:
+                self._plan.user_updates.append(UserUpdate(
+                    ref_id=idp_user.ref_id,
+                    user_id=swit_user_id,
+                    email=idp_user.email,
+                    name=username,
+                    phone_number=idp_user.phone_number,
+                    operations=operations
+                ))
+
+    def _plan_teams(self) -> None:
+        # Only the teams changed since they were last applied need to be compared against Swit
+        changed_teams = [team for team in self._idp.teams if not self._applied.is_team_up_to_date(team)]
+        removed_team_ref_ids = self._applied.teams.keys() - self._idp.teams_by_ref_id.keys() \
+            if self._idp.is_full_scan else set()
+        # ATTENTION: Duplicate teams aren't looked for here, as that would list the teams on every run.
+        #  They're deleted whenever the teams are compared, at the latest at the next full reconciliation
+        if not changed_teams and not removed_team_ref_ids and not self._applied.is_full_reconciliation:
+            return
+        self._plan._changed_teams = changed_teams
+        self._cyclic_team_ref_ids = _find_cyclic_teams(self._idp.teams)
+        if self._cyclic_team_ref_ids:
+            self._plan.warnings.append(f"Cyclic team hierarchy in the IdP. These teams are placed under "
+                                       f"the root team: {sorted(self._cyclic_team_ref_ids)}")
+
+        # Names are tracked on a copy because the Swit snapshot must only reflect writes that succeeded
+        swit_teams = TeamDirectory(self._swit.teams.root_team_id, self._swit.teams)
+        self._plan_deletions(swit_teams)
+        for ref_id in removed_team_ref_ids:
+            self._applied.forget_team(ref_id)
+        self._plan_creations(swit_teams, changed_teams)
+        self._plan_updates(swit_teams, changed_teams)
+
+    def _plan_deletions(self, swit_teams: TeamDirectory) -> None:
+        # ATTENTION: Every ref_id must be unique on Swit, including those spelled differently
+        for swit_team in self._swit.duplicate_teams:
+            self._plan.team_deletions.append(TeamDeletion(team_id=swit_team.id, name=swit_team.name))
+            swit_teams.remove(swit_team)
+        if not self._idp.is_full_scan:
+            # Deleted groups can't be told apart from unchanged ones in an incremental import
+            return
+        # ref_ids of Swit teams may be spelled differently from the DNs the IdP returns now
+        idp_team_keys = {parse_dn_key(ref_id) for ref_id in self._idp.teams_by_ref_id}
+        for swit_team in swit_teams:
+            if swit_team.ref_id and parse_dn_key(swit_team.ref_id) in idp_team_keys:
+                # If the team is in IdP
+                continue
+            self._plan.team_deletions.append(TeamDeletion(team_id=swit_team.id, name=swit_team.name))
+            # Names of deleted teams can be reused
+            swit_teams.remove(swit_team)
+
+    def _plan_creations(self, swit_teams: TeamDirectory, changed_teams: list[IdpTeam]) -> None:
+        """
+        Teams are created in topological order of the IdP hierarchy
+        so that each team is created directly under its parent instead of being moved there afterwards.
+        """
+        # Create a new one if it doesn't exist on Swit
+        teams_to_create = {idp_team.ref_id: idp_team for idp_team in changed_teams
+                           if swit_teams.get_by_ref(idp_team.ref_id) is None}
+        dangling_team_names = [idp_team.name for idp_team in teams_to_create.values()
+                               if idp_team.parent_ref_id
+                               and idp_team.parent_ref_id not in teams_to_create
+                               and idp_team.parent_ref_id not in self._idp.teams_by_ref_id
+                               and swit_teams.get_by_ref(idp_team.parent_ref_id) is None]
+        if dangling_team_names:
+            self._plan.warnings.append(f"Parent teams not found. These teams are created under the root team: "
+                                       f"{dangling_team_names}")
+
+        level = 0
+        while teams_to_create:
+            # Cycles are broken beforehand, so at least one team is ready at each level
+            ready_teams = [idp_team for idp_team in teams_to_create.values()
+                           if idp_team.parent_ref_id not in teams_to_create
+                           or idp_team.ref_id in self._cyclic_team_ref_ids]
+            for idp_team in ready_teams:
+                del teams_to_create[idp_team.ref_id]
+                team_name = _get_unique_team_name(idp_team.name, swit_teams)
+                swit_teams.reserve_name(team_name)
+                parent_id, parent_ref_id = self._get_parent(idp_team, swit_teams)
+                self._plan.team_creations.append(TeamCreation(
+                    ref_id=idp_team.ref_id,
+                    name=team_name,
+                    parent_id=parent_id,
+                    parent_ref_id=parent_ref_id,
+                    level=level
+                ))
+                self._created_team_ref_ids.add(idp_team.ref_id)
+                # New teams have no members yet
+                user_ids = self._get_swit_user_ids(idp_team)
+                if user_ids:
+                    self._plan.team_membership_updates.append(TeamMembershipUpdate(
+                        ref_id=idp_team.ref_id,
+                        user_ids_to_add=sorted(user_ids)
+                    ))
+            level += 1
+
+    def _plan_updates(self, swit_teams: TeamDirectory, changed_teams: list[IdpTeam]) -> None:
+        for idp_team in changed_teams:
+            swit_team = swit_teams.get_by_ref(idp_team.ref_id)
+            if swit_team is None:
+                # It's created by this plan
+                continue
+
+            # Collect fields to update to minimize API calls
+            team_update = TeamUpdate(ref_id=idp_team.ref_id, team_id=swit_team.id)
+
+            # Update team name
+            if _clean_string(swit_team.name) != _clean_string(idp_team.name):
+                team_update.name = _get_unique_team_name(idp_team.name, swit_teams)
+                swit_teams.reserve_name(team_update.name)
+
+            # Update parent team
+            parent_id, parent_ref_id = self._get_parent(idp_team, swit_teams)
+            if parent_ref_id is not None or parent_id != swit_team.parent_id:
+                team_update.parent_id = parent_id
+                team_update.parent_ref_id = parent_ref_id
+
+            if team_update.name is not None or team_update.parent_id or team_update.parent_ref_id:
+                self._plan.team_updates.append(team_update)
+
+            # Check that team members are up-to-date
+            swit_team_user_ids = set(swit_team.user_ids)
+            idp_team_user_ids = self._get_swit_user_ids(idp_team)
+            members_to_add = idp_team_user_ids - swit_team_user_ids
+            members_to_remove = swit_team_user_ids - idp_team_user_ids
+            if members_to_add or members_to_remove:
+                self._plan.team_membership_updates.append(TeamMembershipUpdate(
+                    ref_id=idp_team.ref_id,
+                    user_ids_to_add=sorted(members_to_add),
+                    user_ids_to_remove=sorted(members_to_remove)
+                ))
+
+    def _get_parent(self, idp_team: IdpTeam, swit_teams: TeamDirectory) -> tuple[Optional[str], Optional[str]]:
+        """
+        Returns (parent_id, None) if the parent exists on Swit or (None, parent_ref_id) if it's about to be created.
+        Teams without a parent are placed under the root team.
+        """
+        if idp_team.parent_ref_id and idp_team.ref_id not in self._cyclic_team_ref_ids:
+            parent_swit_team = swit_teams.get_by_ref(idp_team.parent_ref_id)
+            if parent_swit_team:
+                return parent_swit_team.id, None
+            if idp_team.parent_ref_id in self._created_team_ref_ids:
+                return None, idp_team.parent_ref_id
+        return swit_teams.root_team_id, None
+
+    def _get_swit_user_ids(self, idp_team: IdpTeam) -> set[str]:
+        swit_users_by_email = self._swit.users_by_email
+        return {swit_users_by_email[idp_user.email].id
+                for idp_user in idp_team.users
+                if idp_user.email in swit_users_by_email}
+
+
+def _find_cyclic_teams(idp_teams: list[IdpTeam]) -> set[str]:
+    """Find the ref_ids of the teams which are their own ancestors"""
+    parent_ref_ids = {idp_team.ref_id: idp_team.parent_ref_id for idp_team in idp_teams}
+    cyclic_team_ref_ids: set[str] = set()
+    visited_ref_ids: set[str] = set()
+    for ref_id in parent_ref_ids:
+        # Walk up from each team until reaching a root or a team visited from another start
+        path: dict[str, int] = {}
+        current: Optional[str] = ref_id
+        while current is not None and current in parent_ref_ids and current not in visited_ref_ids:
+            if current in path:
+                cyclic_team_ref_ids.update(list(path)[path[current]:])
+                break
+            path[current] = len(path)
+            current = parent_ref_ids[current]
+        visited_ref_ids.update(path)
+    return cyclic_team_ref_ids
+
+
+def _get_unique_team_name(team_name: str, swit_teams: TeamDirectory) -> str:
+    """
+    ATTENTION: Get a unique team name by adding a number suffix. Be aware that:
+      1. Duplicate team names are not allowed on Swit.
+      2. Duplicates must be checked case-insensitively. See `TeamDirectory.is_name_taken`.
+    """
+    cleaned_team_name = _clean_string(team_name)
+    if not swit_teams.is_name_taken(cleaned_team_name):
+        return cleaned_team_name
+    for i in range(2, 100):
+        new_team_name = f"{cleaned_team_name} ({i})"
+        if not swit_teams.is_name_taken(new_team_name):
+            return new_team_name
+    raise RuntimeError(f"Failed to generate a unique team name for {team_name}")
+
+
+_INVALID_CHARACTERS = re.compile(r'[@#<>§▒{};*]')
+_NUMBER_SUFFIX = re.compile(r' \([0-9]+\)$')
+
+
+@lru_cache(maxsize=65536)
+def _clean_string(string: str) -> str:
+    """
+    ATTENTION: Replace @ # < > § ▒ { } ; * with underscore in the string
+        and remove duplicated number suffixes
+    It's memoized because the same names are cleaned several times per run.
+    """
+    string = _INVALID_CHARACTERS.sub('_', string)
+    # Remove duplicated number suffixes
+    string = _NUMBER_SUFFIX.sub('', string)
+    return string.strip()
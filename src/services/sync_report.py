@@ -0,0 +1,140 @@
+"""
+Collects what a sync run did and rolls it up into a single summary message.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Iterator, Optional, TextIO
+
+from src.core.constants import settings
+from src.core.logger import provisioning_logger as logger
+from src.core.metrics import sync_entities, sync_phase_duration
+
+# Number of names shown per operation in the summary
+_EXAMPLE_COUNT = 5
+# Report files are named after the start of their run, so that sorting them by name sorts them by age
+_DETAIL_FILE_FORMAT = '%Y%m%dT%H%M%SZ.jsonl'
+_DETAIL_FILE_PATTERN = '????????T??????Z.jsonl'
+
+_OPERATION_LABELS = {
+    'user.update': 'Updated users',
+    'user.activate': 'Activated users',
+    'user.deactivate': 'Deactivated users',
+    'user.photo.update': 'Updated profile photos',
+    'team.delete': 'Deleted teams',
+    'team.create': 'Created teams',
+    'team.update': 'Updated teams',
+    'team.members.add': 'Added members to teams',
+    'team.members.remove': 'Removed members from teams',
+    'team.sort': 'Sorted teams',
+}
+
+
+class SyncReport:
+    """
+    Structured events of one sync run.
+    Every event is written to a JSONL file in SYNC_REPORT_DIR while only counts and a few examples
+    are kept in memory for the summary, which is logged (and so sent to the webhook) once per run.
+    ATTENTION: Events are recorded from the write executor's threads.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started_at = datetime.now(timezone.utc)
+        self._start_time = time.perf_counter()
+        self._counts: Counter[str] = Counter()
+        self._failure_counts: Counter[str] = Counter()
+        self._examples: defaultdict[str, list[str]] = defaultdict(list)
+        self._failure_examples: defaultdict[str, list[str]] = defaultdict(list)
+        self._phase_durations: dict[str, float] = {}
+        # The file is created at the first event, so that runs without changes leave nothing behind
+        self.detail_path: Optional[str] = None
+        self._detail_file: Optional[TextIO] = None
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._counts or self._failure_counts)
+
+    @property
+    def has_failures(self) -> bool:
+        return bool(self._failure_counts)
+
+    def record(self, operation: str, name: str, error: Optional[str] = None, **details: Any) -> None:
+        """Record a write to Swit. `error` is set if it failed"""
+        event = {
+            'at': datetime.now(timezone.utc).isoformat(),
+            'operation': operation,
+            'name': name,
+            'error': error,
+            **details
+        }
+        sync_entities.inc(operation=operation, result='success' if error is None else 'failure')
+        with self._lock:
+            if error is None:
+                self._counts[operation] += 1
+                if len(self._examples[operation]) < _EXAMPLE_COUNT:
+                    self._examples[operation].append(name)
+            else:
+                self._failure_counts[operation] += 1
+                if len(self._failure_examples[operation]) < _EXAMPLE_COUNT:
+                    self._failure_examples[operation].append(f"{name} ({error})")
+            detail_file = self._get_detail_file()
+            if detail_file:
+                detail_file.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._phase_durations[name] = time.perf_counter() - start_time
+            sync_phase_duration.set(self._phase_durations[name], phase=name)
+
+    def summarize(self) -> str:
+        lines = [f"Sync started at {self._started_at.isoformat(timespec='seconds')} "
+                 f"took {time.perf_counter() - self._start_time:.1f}s"]
+        with self._lock:
+            for operation, count in self._counts.items():
+                lines.append(f"- {_OPERATION_LABELS.get(operation, operation)}: {count} "
+                             f"(e.g. {', '.join(self._examples[operation])})")
+            for operation, count in self._failure_counts.items():
+                lines.append(f"- Failed {operation}: {count} "
+                             f"(e.g. {', '.join(self._failure_examples[operation])})")
+        if self._phase_durations:
+            lines.append("Phases: " + ', '.join(f"{name} {duration:.1f}s"
+                                                for name, duration in self._phase_durations.items()))
+        if self.detail_path:
+            lines.append(f"Details: {self.detail_path}")
+        return '\n'.join(lines)
+
+    def _get_detail_file(self) -> Optional[TextIO]:
+        if self._detail_file is None and settings.SYNC_REPORT_DIR:
+            os.makedirs(settings.SYNC_REPORT_DIR, exist_ok=True)
+            self.detail_path = os.path.join(settings.SYNC_REPORT_DIR, self._started_at.strftime(_DETAIL_FILE_FORMAT))
+            self._detail_file = open(self.detail_path, 'a', encoding='utf-8')
+            _remove_old_reports()
+        return self._detail_file
+
+    def close(self) -> None:
+        with self._lock:
+            if self._detail_file:
+                self._detail_file.close()
+                self._detail_file = None
+
+
+def _remove_old_reports() -> None:
+    """Keep only the latest SYNC_REPORT_RETENTION_COUNT report files, including the one just created"""
+    if settings.SYNC_REPORT_RETENTION_COUNT <= 0:
+        return
+    paths = sorted(glob.glob(os.path.join(glob.escape(settings.SYNC_REPORT_DIR), _DETAIL_FILE_PATTERN)))
+    for path in paths[:-settings.SYNC_REPORT_RETENTION_COUNT]:
+        try:
+            os.remove(path)
+        except OSError as e:
+            # ATTENTION: A report that can't be removed must not fail the sync recording it
+            logger.warning(f"Failed to remove the old sync report {path}: {e}")
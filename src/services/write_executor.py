@@ -0,0 +1,56 @@
+"""
+Runs mutating Swit API calls on a bounded worker pool.
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from types import TracebackType
+from typing import Any, Callable, Optional, TypeVar
+
+from src.core.constants import settings
+
+_T = TypeVar('_T')
+
+
+class SwitWriteExecutor:
+    """
+    Runs independent write operations concurrently.
+    ATTENTION: Operations submitted before a `wait()` call are not ordered with each other,
+      so call `wait()` between operations that depend on each other
+      (e.g. a team must be created before it is re-parented or gets members).
+    Requests are paced by the rate governor of `SwitApiClient`, not by the executor.
+    """
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers or settings.SWIT_WRITE_CONCURRENCY,
+            thread_name_prefix='swit_writer'
+        )
+        self._lock = threading.Lock()
+        self._pending: list[Future[Any]] = []
+
+    def __enter__(self) -> 'SwitWriteExecutor':
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.shutdown()
+
+    def submit(self, fn: Callable[..., _T], *args: Any, **kwargs: Any) -> 'Future[_T]':
+        future = self._pool.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._pending.append(future)
+        return future
+
+    def wait(self) -> None:
+        """Block until every submitted operation has finished and re-raise the first failure"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        wait(pending)
+        for future in pending:
+            exception = future.exception()
+            if exception is not None:
+                raise exception
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,175 @@
+import contextlib
+import io
+import json
+import os
+import runpy
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from httpx import AsyncClient, MockTransport, Response
+
+from benchmarks.fixture_generator import SEARCH_BASE, generate_fixture
+from benchmarks.stand_in_directory import StandInDirectory
+from benchmarks.stand_in_swit import StandInSwitApi
+from src import database
+from src.app import create_app
+from src.core.constants import settings
+from src.core.http import shared_transport
+from src.core.metrics import sync_entities, sync_runs
+from src.database import close_db, get_applied_teams, get_applied_users, get_failed_entries, get_ldap_watermark, \
+    init_db
+from src.services import async_data_sync, swit_api_client
+from src.services.data_sync import plan_sync_to_swit, sync_to_swit
+from src.services.ldap_connection import use_stand_in_directory
+from src.services.swit_oauth import token_manager
+from src.services.swit_schemas import SwitTokens
+from src.services.sync_plan import SyncPlan
+
+_MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+_BIND_USER = 'CN=svc,OU=Service Accounts,DC=example,DC=com'
+_BIND_PASSWORD = 'secret'
+
+
+class SyncToSwitTestCase(unittest.TestCase):
+    """Syncs a fixture to an in-process stand-in of the Swit API, keeping the database in memory"""
+    def setUp(self) -> None:
+        fixture_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(fixture_dir.cleanup)
+        self.fixture_path = os.path.join(fixture_dir.name, 'fixture.json')
+        self.fixture = generate_fixture(100)
+        self._save_fixture()
+        for name, value in {
+            'IS_RUNNING_LOCALLY': True,
+            'LOCAL_IDP_FIXTURE_PATH': self.fixture_path,
+            'SYNC_REPORT_DIR': '',
+            'SYNC_PROFILE_PHOTOS': False,
+            'SWIT_ASYNC_SYNC': False,
+        }.items():
+            setting = mock.patch.object(settings, name, value)
+            setting.start()
+            self.addCleanup(setting.stop)
+        # Requests aren't paced
+        governor = mock.patch.object(swit_api_client, 'rate_governor', swit_api_client._RateGovernor(1000, 1000))
+        governor.start()
+        self.addCleanup(governor.stop)
+        db_name = mock.patch.object(database, '_DB_NAME', ':memory:')
+        db_name.start()
+        self.addCleanup(db_name.stop)
+        close_db()
+        self.addCleanup(close_db)
+        init_db()
+        tokens = mock.patch.object(token_manager, '_tokens', SwitTokens(
+            access_token='test', refresh_token='test', expires_at=datetime.now(timezone.utc) + timedelta(days=1)))
+        tokens.start()
+        self.addCleanup(tokens.stop)
+        self.stand_in = StandInSwitApi()
+        self.stand_in.add_users_from_fixture(self.fixture)
+        shared_transport.replace_pool(self.stand_in)
+        self.addCleanup(shared_transport.close_pool)
+
+    def test_dry_run(self) -> None:
+        # A sync would save the watermark of the stand-in directory
+        self._use_stand_in_directory()
+        client = create_app().test_client()
+        dry_runs = {
+            'plan_sync_to_swit': lambda: plan_sync_to_swit().model_dump_json(),
+            'plan_only=1': lambda: client.post('/user_update?plan_only=1', headers={
+                'x-secret-key': settings.OPERATION_AUTH_KEY}).get_data(as_text=True),
+            '--dry-run': self._run_main_dry_run,
+        }
+        for name, dry_run in dry_runs.items():
+            with self.subTest(name):
+                self.stand_in.reset_counts()
+                plan = SyncPlan.model_validate_json(dry_run())
+                self.assertTrue(plan.user_updates and plan.team_creations)
+                self.assertEqual([call for call in self.stand_in.calls if not call.startswith('GET ')], [])
+                self.assertIsNone(get_ldap_watermark())
+                self.assertEqual((get_applied_users(), get_applied_teams(), get_failed_entries()), ({}, {}, set()))
+        # Unlike the dry runs
+        sync_to_swit()
+        self.assertIsNotNone(get_ldap_watermark())
+        self.assertTrue(get_applied_teams())
+
+    def test_failed_team_deletion(self) -> None:
+        deletion_counts = self._delete_group(Response(403, json={'detail': 'Forbidden'}))
+        self.assertEqual(deletion_counts, {'success': 0, 'failure': 1})
+
+    def test_team_already_deleted(self) -> None:
+        deletion_counts = self._delete_group(Response(404, json={'detail': 'Team not found'}))
+        self.assertEqual(deletion_counts, {'success': 1, 'failure': 0})
+
+    def test_failed_team_creations_with_asyncio(self) -> None:
+        for name, value in {'SWIT_ASYNC_SYNC': True, 'SWIT_BASE_URL': 'https://swit.test'}.items():
+            setting = mock.patch.object(settings, name, value)
+            setting.start()
+            self.addCleanup(setting.stop)
+        # Requests are sent to the stand-in without the retries of AsyncSwitApiClient
+        api_client = mock.patch.object(async_data_sync, 'AsyncSwitApiClient', lambda: AsyncClient(
+            base_url='https://swit.test/v1/api', transport=MockTransport(self.stand_in.handle_request)))
+        api_client.start()
+        self.addCleanup(api_client.stop)
+        top_level_group_count = sum(1 for group in self.fixture['groups'] if not group['memberOf'])
+        failed_creation_count = sync_entities.get(operation='team.create', result='failure')
+        failed_run_count = sync_runs.get(result='failure')
+        with mock.patch.object(self.stand_in, '_create_team', return_value=Response(403, json={'detail': 'Forbidden'})):
+            sync_to_swit()
+        # Every failure of the level is recorded, and the run is aborted before the next level
+        self.assertEqual(sync_entities.get(operation='team.create', result='failure') - failed_creation_count,
+                         top_level_group_count)
+        self.assertEqual(sync_runs.get(result='failure') - failed_run_count, 1)
+        self.assertEqual(self.stand_in.calls['POST /team.create'], top_level_group_count)
+
+    def _delete_group(self, res: Response) -> dict[str, float]:
+        """Sync, remove a group without child groups from the IdP and sync again while Swit answers with `res`"""
+        sync_to_swit()
+        group_dns = {group['distinguishedName'] for group in self.fixture['groups']}
+        leaf = next(group for group in self.fixture['groups'] if not set(group['member']) & group_dns)
+        self.fixture['groups'].remove(leaf)
+        for group in self.fixture['groups']:
+            group['member'] = [member for member in group['member'] if member != leaf['distinguishedName']]
+        self._save_fixture()
+        counts = {result: sync_entities.get(operation='team.delete', result=result)
+                  for result in ('success', 'failure')}
+        failed_run_count = sync_runs.get(result='failure')
+        with mock.patch.object(self.stand_in, '_delete_team', return_value=res):
+            sync_to_swit()
+        self.assertEqual(sync_runs.get(result='failure'), failed_run_count)
+        return {result: sync_entities.get(operation='team.delete', result=result) - count
+                for result, count in counts.items()}
+
+    def _use_stand_in_directory(self) -> None:
+        env = mock.patch.dict(os.environ, {
+            'LDAP_SERVER_DOMAIN': 'stand_in_directory',
+            'LDAP_SERVER_PORT': '636',
+            'LDAP_USER': _BIND_USER,
+            'LDAP_PASSWORD': _BIND_PASSWORD,
+            'LDAP_SEARCH_BASE': SEARCH_BASE,
+            'LDAP_USER_OUS': 'Users',
+            'LDAP_GROUP_OUS': 'Groups',
+            'LDAP_INCREMENTAL_SYNC': 'True',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        is_running_locally = mock.patch.object(settings, 'IS_RUNNING_LOCALLY', False)
+        is_running_locally.start()
+        self.addCleanup(is_running_locally.stop)
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD).connect)
+        self.addCleanup(use_stand_in_directory, None)
+
+    def _run_main_dry_run(self) -> str:
+        stdout = io.StringIO()
+        with mock.patch.object(sys, 'argv', [_MAIN_PATH, '--dry-run']), contextlib.redirect_stdout(stdout), \
+                self.assertRaises(SystemExit):
+            runpy.run_path(_MAIN_PATH, run_name='__main__')
+        return stdout.getvalue()
+
+    def _save_fixture(self) -> None:
+        with open(self.fixture_path, 'w') as f:
+            json.dump(self.fixture, f)
+
+
+if __name__ == '__main__':
+    unittest.main()
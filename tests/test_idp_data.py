@@ -0,0 +1,241 @@
+import math
+import os
+import unittest
+from datetime import timedelta
+from typing import Any
+from unittest import mock
+
+from benchmarks.fixture_generator import SEARCH_BASE, generate_fixture
+from benchmarks.stand_in_directory import StandInDirectory
+from src import database
+from src.core.constants import settings
+from src.core.metrics import ldap_binds, ldap_searches
+from src.database import close_db, get_ldap_watermark, init_db, replace_failed_entries, upsert_ldap_watermark
+from src.services import idp_data
+from src.services.idp_data import IdpSnapshot, fetch_idp_photos, hash_photo, import_idp_snapshot
+from src.services.ldap_connection import use_stand_in_directory
+from src.services.swit_schemas import LdapWatermark
+
+_BIND_USER = 'CN=svc,OU=Service Accounts,DC=example,DC=com'
+_BIND_PASSWORD = 'secret'
+
+
+class LdapImportTestCase(unittest.TestCase):
+    """Imports from an in-process stand-in of the directory"""
+    def setUp(self) -> None:
+        env = mock.patch.dict(os.environ, {
+            'LDAP_SERVER_DOMAIN': 'stand_in_directory',
+            'LDAP_SERVER_PORT': '636',
+            'LDAP_USER': _BIND_USER,
+            'LDAP_PASSWORD': _BIND_PASSWORD,
+            'LDAP_SEARCH_BASE': SEARCH_BASE,
+            'LDAP_USER_OUS': 'Users1,Users2',
+            'LDAP_GROUP_OUS': 'Groups',
+            'LDAP_PAGE_SIZE': '50',
+            'LDAP_INCREMENTAL_SYNC': 'False',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        is_running_locally = mock.patch.object(settings, 'IS_RUNNING_LOCALLY', False)
+        is_running_locally.start()
+        self.addCleanup(is_running_locally.stop)
+        self.fixture = generate_fixture(300, user_ous=('Users1', 'Users2'))
+        self.addCleanup(use_stand_in_directory, None)
+
+    def test_import(self) -> None:
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD).connect)
+        idp = import_idp_snapshot()
+        self._assert_imported(idp)
+
+    def test_import_over_a_single_connection(self) -> None:
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD).connect)
+        bind_count = ldap_binds.get()
+        with mock.patch.dict(os.environ, {'LDAP_SEARCH_CONCURRENCY': '1'}):
+            idp = import_idp_snapshot()
+        self._assert_imported(idp)
+        self.assertEqual(ldap_binds.get() - bind_count, 1)
+
+    def test_ranged_members(self) -> None:
+        max_value_range = 7
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD, max_value_range).connect)
+        range_search_count = ldap_searches.get(kind='range')
+        idp = import_idp_snapshot()
+        self._assert_imported(idp)
+        # Every group fits in a batch, so each range is fetched for all groups at once
+        max_member_count = max(len(group['member']) for group in self.fixture['groups'])
+        self.assertEqual(ldap_searches.get(kind='range') - range_search_count,
+                         math.ceil(max_member_count / max_value_range) - 1)
+
+    def test_ranged_members_of_differently_spelled_dns(self) -> None:
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD, max_value_range=7).connect)
+        search_member_range = idp_data._search_member_range
+
+        def search_respelled_member_range(*args: Any) -> list[Any]:
+            # AD may spell the DNs of the next ranges differently from the first search
+            return [{**entry, 'distinguishedName': entry['distinguishedName'].upper().replace(',', ', ')}
+                    for entry in search_member_range(*args)]
+
+        with mock.patch.object(idp_data, '_search_member_range', search_respelled_member_range):
+            idp = import_idp_snapshot()
+        self._assert_imported(idp)
+
+    def test_differently_spelled_dns(self) -> None:
+        # AD may return `member` and `memberOf` in another case than the DNs of the entries
+        for group in self.fixture['groups']:
+            group['member'] = [member.upper() for member in group['member']]
+            group['memberOf'] = [parent.lower().replace(',', ', ') for parent in group['memberOf']]
+        excluded_group = next(group for group in self.fixture['groups'] if group['memberOf'])
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD).connect)
+        excluded_cn = excluded_group['distinguishedName'].split(',')[0].removeprefix('CN=')
+        with mock.patch.object(idp_data, '_teams_to_exclude', frozenset({excluded_cn.casefold()})):
+            idp = import_idp_snapshot()
+        self.assertNotIn(excluded_group['distinguishedName'], idp.teams_by_ref_id)
+        for idp_team in idp.teams:
+            self.assertTrue(idp_team.parent_ref_id is None or idp_team.parent_ref_id in idp.teams_by_ref_id)
+        self.assertEqual(sum(len(idp_team.users) for idp_team in idp.teams),
+                         sum(len(set(group['member']) & {user['distinguishedName'].upper()
+                                                         for user in self.fixture['users'] if user['mail']})
+                             for group in self.fixture['groups'] if group is not excluded_group))
+
+    def test_child_group_before_its_differently_spelled_parent(self) -> None:
+        parent_dns_by_child_dn = {group['distinguishedName']: group['memberOf'][0]
+                                  for group in self.fixture['groups'] if group['memberOf']}
+        for group in self.fixture['groups']:
+            group['memberOf'] = [parent.lower().replace(',', ', ') for parent in group['memberOf']]
+        self.fixture['groups'].reverse()
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD).connect)
+        idp = import_idp_snapshot()
+        self.assertTrue(parent_dns_by_child_dn)
+        for child_dn, parent_dn in parent_dns_by_child_dn.items():
+            self.assertEqual(idp.teams_by_ref_id[child_dn].parent_ref_id, parent_dn)
+
+    def test_photos(self) -> None:
+        photos = {user['distinguishedName']: b'\xff\xd8\xff' + user['distinguishedName'].encode('utf-8')
+                  for user in self.fixture['users'][::3] if user['mail']}
+        for user in self.fixture['users']:
+            if user['distinguishedName'] in photos:
+                user['thumbnailPhoto'] = photos[user['distinguishedName']]
+        use_stand_in_directory(StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD).connect)
+        with mock.patch.object(settings, 'SYNC_PROFILE_PHOTOS', True):
+            idp = import_idp_snapshot()
+            # Only the hashes are kept by the import
+            self.assertEqual({idp_user.ref_id: idp_user.photo_hash for idp_user in idp.users if idp_user.photo_hash},
+                             {ref_id: hash_photo(photo) for ref_id, photo in photos.items()})
+            ref_ids = list(photos)[:5] + [ref_id for ref_id in idp.users_by_ref_id if ref_id not in photos][:5]
+            self.assertEqual(dict(fetch_idp_photos(ref_ids)), {ref_id: photos[ref_id] for ref_id in ref_ids[:5]})
+
+    def test_incremental_import(self) -> None:
+        stand_in = self._use_incremental_stand_in()
+        idp = import_idp_snapshot()
+        self.assertTrue(idp.is_full_scan)
+        idp.save_watermark()
+
+        user = next(user for user in self.fixture['users'] if user['mail'])
+        stand_in.modify(user['distinguishedName'], {'displayName': 'Renamed'})
+        idp = import_idp_snapshot()
+        self.assertFalse(idp.is_full_scan)
+        self.assertEqual([idp_user.ref_id for idp_user in idp.users], [user['distinguishedName']])
+        self.assertEqual(idp.teams, [])
+        idp.save_watermark()
+
+        # Moving a group only changes the USN of its parents
+        user_ref_ids = {user['distinguishedName'] for user in self.fixture['users'] if user['mail']}
+        groups_by_dn = {group['distinguishedName']: group for group in self.fixture['groups']}
+        child = self.fixture['groups'][0]
+        old_parent = groups_by_dn[child['memberOf'][0]]
+        new_parent = next(group for group in reversed(self.fixture['groups']) if group is not old_parent)
+        stand_in.modify(new_parent['distinguishedName'],
+                        {'member': new_parent['member'] + [child['distinguishedName']]})
+        stand_in.modify(old_parent['distinguishedName'],
+                        {'member': [member for member in old_parent['member'] if member != child['distinguishedName']]})
+        idp = import_idp_snapshot()
+        self.assertFalse(idp.is_full_scan)
+        self.assertEqual(idp.teams_by_ref_id[child['distinguishedName']].parent_ref_id,
+                         new_parent['distinguishedName'])
+        # Every member of the teams read is imported, changed or not
+        for idp_team in idp.teams:
+            group = groups_by_dn[idp_team.ref_id]
+            self.assertEqual({user.ref_id for user in idp_team.users}, set(group['member']) & user_ref_ids)
+
+    def test_incremental_import_of_differently_spelled_members(self) -> None:
+        stand_in = self._use_incremental_stand_in()
+        import_idp_snapshot().save_watermark()
+        group_ref_ids = {group['distinguishedName'] for group in self.fixture['groups']}
+        parent = next(group for group in self.fixture['groups'] if set(group['member']) & group_ref_ids)
+        stand_in.modify(parent['distinguishedName'],
+                        {'member': [member.upper().replace(',', ', ') for member in parent['member']]})
+        idp = import_idp_snapshot()
+        self.assertFalse(idp.is_full_scan)
+        # The unchanged child groups and members are read again, whatever their spelling
+        child_ref_ids = set(parent['member']) & group_ref_ids
+        self.assertEqual({idp_team.ref_id for idp_team in idp.teams} - {parent['distinguishedName']}, child_ref_ids)
+        for idp_team in idp.teams:
+            self.assertEqual(idp_team.parent_ref_id,
+                             None if idp_team.ref_id == parent['distinguishedName'] else parent['distinguishedName'])
+
+    def test_incremental_import_of_failed_entries(self) -> None:
+        self._use_incremental_stand_in()
+        import_idp_snapshot().save_watermark()
+        # Entries which failed to be applied are read again, although they haven't changed
+        user = next(user for user in self.fixture['users'] if user['mail'])
+        group = self.fixture['groups'][0]
+        replace_failed_entries([user['distinguishedName'], group['distinguishedName']])
+        idp = import_idp_snapshot()
+        self.assertFalse(idp.is_full_scan)
+        self.assertIn(user['distinguishedName'], idp.users_by_ref_id)
+        self.assertIn(group['distinguishedName'], idp.teams_by_ref_id)
+        replace_failed_entries([])
+        idp = import_idp_snapshot()
+        self.assertEqual((idp.users, idp.teams), ([], []))
+
+    def test_full_scan_instead_of_incremental_import(self) -> None:
+        stand_in = self._use_incremental_stand_in()
+        import_idp_snapshot().save_watermark()
+        self.assertFalse(import_idp_snapshot().is_full_scan)
+        for case, invalidate in (
+                ('DC restored', stand_in.restore),
+                ('USN going backwards', lambda: upsert_ldap_watermark(self._get_watermark().model_copy(
+                    update={'highest_usn': stand_in.highest_usn + 1}))),
+                ('full scan due', lambda: upsert_ldap_watermark(self._get_watermark().model_copy(
+                    update={'last_full_scan_at': self._get_watermark().last_full_scan_at - timedelta(hours=24)})))):
+            with self.subTest(case):
+                invalidate()
+                idp = import_idp_snapshot()
+                self.assertTrue(idp.is_full_scan)
+                self._assert_imported(idp)
+                idp.save_watermark()
+                self.assertFalse(import_idp_snapshot().is_full_scan)
+
+    def _use_incremental_stand_in(self) -> StandInDirectory:
+        """The watermark is kept in a database in memory"""
+        env = mock.patch.dict(os.environ, {'LDAP_INCREMENTAL_SYNC': 'True', 'LDAP_FULL_SCAN_INTERVAL_HOURS': '24'})
+        env.start()
+        self.addCleanup(env.stop)
+        db_name = mock.patch.object(database, '_DB_NAME', ':memory:')
+        db_name.start()
+        self.addCleanup(db_name.stop)
+        close_db()
+        self.addCleanup(close_db)
+        init_db()
+        stand_in = StandInDirectory(self.fixture, _BIND_USER, _BIND_PASSWORD)
+        use_stand_in_directory(stand_in.connect)
+        return stand_in
+
+    @staticmethod
+    def _get_watermark() -> LdapWatermark:
+        watermark = get_ldap_watermark()
+        assert watermark is not None
+        return watermark
+
+    def _assert_imported(self, idp: IdpSnapshot) -> None:
+        user_ref_ids = {user['distinguishedName'] for user in self.fixture['users'] if user['mail']}
+        self.assertEqual(set(idp.users_by_ref_id), user_ref_ids)
+        self.assertEqual(len(idp.teams), len(self.fixture['groups']))
+        for group in self.fixture['groups']:
+            idp_team = idp.teams_by_ref_id[group['distinguishedName']]
+            self.assertEqual(idp_team.parent_ref_id, group['memberOf'][0] if group['memberOf'] else None)
+            self.assertEqual({user.ref_id for user in idp_team.users}, set(group['member']) & user_ref_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
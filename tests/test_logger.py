@@ -0,0 +1,75 @@
+import json
+import logging
+import threading
+import unittest
+from unittest import mock
+
+from httpx import Client, MockTransport, Request, Response
+
+from src.core import logger
+from src.core.constants import settings
+from src.core.logger import SwitWebhookBufferingHandler
+
+_WEBHOOK_URL = 'https://webhook.test/hook'
+
+
+class SwitWebhookBufferingHandlerTestCase(unittest.TestCase):
+    """Ships log records to a fake webhook, which keeps the text of each message"""
+    def setUp(self) -> None:
+        self.texts: list[str] = []
+        # Set while the fake webhook holds the first message, until `release` is set
+        self.is_holding = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        http_client = mock.patch.object(logger, 'http_client', Client(transport=MockTransport(self._receive)))
+        http_client.start()
+        self.addCleanup(http_client.stop)
+        webhook_url = mock.patch.object(settings, 'SWIT_WEBHOOK_URL', _WEBHOOK_URL)
+        webhook_url.start()
+        self.addCleanup(webhook_url.stop)
+
+    def test_batching(self) -> None:
+        handler = SwitWebhookBufferingHandler(queue_size=100)
+        for message in ['a', 'b', 'x' * 4000, 'y' * 4000, 'z' * 7000]:
+            handler.emit(logging.makeLogRecord({'msg': message}))
+        # Messages are batched up to 6000 characters, and longer ones are split
+        handler.close()
+        self.assertEqual(self.texts, ['a\nb\n' + 'x' * 4000, 'y' * 4000, 'z' * 6000, 'z' * 1000])
+
+    def test_flush(self) -> None:
+        handler = SwitWebhookBufferingHandler(queue_size=100)
+        self.addCleanup(handler.close)
+        handler.emit(logging.makeLogRecord({'msg': 'a'}))
+        handler.emit(logging.makeLogRecord({'msg': 'b'}))
+        self.assertEqual(self.texts, [])
+        # The messages are sent without waiting for the handler to close
+        handler.flush()
+        self.assertTrue(self.is_holding.wait(5))
+        self.assertEqual(self.texts, ['a\nb'])
+
+    def test_dropping_when_full(self) -> None:
+        handler = SwitWebhookBufferingHandler(queue_size=2)
+        self.release.clear()
+        handler.emit(logging.makeLogRecord({'msg': 'first'}))
+        handler.flush()
+        self.assertTrue(self.is_holding.wait(5))
+        # The shipper is busy sending, so only 2 of these fit in the queue and logging doesn't block
+        for i in range(5):
+            handler.emit(logging.makeLogRecord({'msg': f'm{i}'}))
+        self.release.set()
+        handler.close()
+        self.assertEqual(self.texts, [
+            'first',
+            'm0\nm1\n... 3 log messages were dropped because the log queue was full'
+        ])
+
+    def _receive(self, request: Request) -> Response:
+        assert str(request.url) == _WEBHOOK_URL
+        self.texts.append(json.loads(request.content)['text'])
+        self.is_holding.set()
+        self.release.wait(5)
+        return Response(200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import unittest
+from unittest import mock
+
+from src import database
+from src.app import create_app
+from src.core.metrics import Histogram
+from src.database import close_db
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # The database is kept in memory, so that the tests leave no database file behind
+        db_name = mock.patch.object(database, '_DB_NAME', ':memory:')
+        db_name.start()
+        self.addCleanup(db_name.stop)
+        close_db()
+        self.addCleanup(close_db)
+
+    def test_histogram(self) -> None:
+        histogram = Histogram('test_duration_seconds', 'Test', ('endpoint',), buckets=(0.1, 1.0))
+        for duration in (0.05, 0.5, 0.5, 3.0):
+            histogram.observe(duration, endpoint='/team.create')
+        self.assertEqual(histogram.expose()[2:], [
+            'test_duration_seconds_bucket{endpoint="/team.create",le="0.1"} 1',
+            'test_duration_seconds_bucket{endpoint="/team.create",le="1"} 3',
+            'test_duration_seconds_bucket{endpoint="/team.create",le="+Inf"} 4',
+            'test_duration_seconds_sum{endpoint="/team.create"} 4.05',
+            'test_duration_seconds_count{endpoint="/team.create"} 4',
+        ])
+
+    def test_metrics_route(self) -> None:
+        client = create_app().test_client()
+        rv = client.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('# TYPE swit_api_requests_total counter', rv.get_data(as_text=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
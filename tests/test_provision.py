@@ -1,11 +1,21 @@
 import unittest
+from unittest import mock
 
+from src import database
 from src.app import create_app
 from src.core.constants import settings
+from src.database import close_db
+from src.services.provision_manager import provisioner
 
 
 class TestCase(unittest.TestCase):
     def setUp(self) -> None:
+        # The database is kept in memory, so that the tests leave no database file behind
+        db_name = mock.patch.object(database, '_DB_NAME', ':memory:')
+        db_name.start()
+        self.addCleanup(db_name.stop)
+        close_db()
+        self.addCleanup(close_db)
         self.app = create_app()
         self.app.testing = True
         self.client = self.app.test_client()
@@ -15,6 +25,13 @@ class TestCase(unittest.TestCase):
             "x-secret-key": settings.OPERATION_AUTH_KEY
         })
         print(rv.data)
+        # The provisioning started in the background must be done with the database before it's closed
+        self.addCleanup(self._wait_for_provisioner)
+
+    @staticmethod
+    def _wait_for_provisioner() -> None:
+        if provisioner._thread:
+            provisioner._thread.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import unittest
+from typing import Any
+
+from httpx import AsyncClient, Client, MockTransport, Request, Response
+
+from src.services.scim_bulk import AsyncScimUserUpdater, ScimUserUpdater
+from src.services.sync_plan import UserUpdate
+from src.services.write_executor import SwitWriteExecutor
+
+
+class StandInScimServer:
+    """Keeps display names of users in memory, like the SCIM API of Swit"""
+    def __init__(self, is_bulk_supported: bool = True) -> None:
+        self.names = {f'u{i}': 'old' for i in range(5)}
+        self.is_bulk_supported = is_bulk_supported
+        self.requests: list[str] = []
+
+    def handle(self, request: Request) -> Response:
+        path = request.url.path.removeprefix('/scim/v2')
+        self.requests.append(f'{request.method} {path}')
+        body = json.loads(request.content)
+        if path == '/Bulk':
+            if not self.is_bulk_supported:
+                return Response(501)
+            return Response(200, json={
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkResponse"],
+                "Operations": [self._patch_in_bulk(operation) for operation in body['Operations']]
+            })
+        return self._patch(path.removeprefix('/Users/'), body)
+
+    def _patch_in_bulk(self, operation: dict[str, Any]) -> dict[str, Any]:
+        res = self._patch(operation['path'].removeprefix('/Users/'), operation['data'])
+        return {
+            "method": "PATCH",
+            "bulkId": operation['bulkId'],
+            "status": str(res.status_code),
+            "response": res.json()
+        }
+
+    def _patch(self, user_id: str, body: dict[str, Any]) -> Response:
+        if user_id not in self.names:
+            return Response(404, json={"detail": "User not found"})
+        for operation in body['Operations']:
+            self.names[user_id] = operation['value']
+        return Response(200, json={"id": user_id})
+
+
+def _user_update(user_id: str) -> UserUpdate:
+    return UserUpdate(
+        ref_id=f'CN={user_id}',
+        user_id=user_id,
+        email=f'{user_id}@example.com',
+        name='new',
+        phone_number='',
+        operations=[{"op": "Replace", "path": "displayName", "value": "new"}]
+    )
+
+
+class ScimUserUpdaterTestCase(unittest.TestCase):
+    def _update(self, server: StandInScimServer, user_ids: list[str]) -> dict[str, str]:
+        with Client(transport=MockTransport(server.handle)) as client, SwitWriteExecutor(max_workers=1) as executor:
+            updater = ScimUserUpdater(client, executor, max_operations=2, base_url='https://scim.test/scim/v2')
+            return updater.update([_user_update(user_id) for user_id in user_ids])
+
+    def test_bulk(self) -> None:
+        server = StandInScimServer()
+        errors = self._update(server, ['u0', 'u1', 'unknown', 'u3', 'u4'])
+        # A single remaining user is patched directly
+        self.assertEqual(server.requests, ['POST /Bulk', 'POST /Bulk', 'PATCH /Users/u4'])
+        self.assertEqual(errors, {'unknown': '404 User not found'})
+        self.assertEqual(set(server.names.values()), {'old', 'new'})
+        self.assertEqual(server.names['u2'], 'old')
+
+    def test_fallback_to_patch(self) -> None:
+        server = StandInScimServer(is_bulk_supported=False)
+        errors = self._update(server, ['u0', 'u1', 'unknown'])
+        self.assertEqual(server.requests, ['POST /Bulk', 'PATCH /Users/u0', 'PATCH /Users/u1', 'PATCH /Users/unknown'])
+        self.assertEqual(errors, {'unknown': '404 User not found'})
+
+    def test_async_bulk(self) -> None:
+        async def update(server: StandInScimServer) -> dict[str, str]:
+            async with AsyncClient(transport=MockTransport(server.handle)) as client:
+                updater = AsyncScimUserUpdater(client, max_operations=2, base_url='https://scim.test/scim/v2')
+                return await updater.update([_user_update(user_id) for user_id in ['u0', 'unknown', 'u2']])
+
+        server = StandInScimServer()
+        errors = asyncio.run(update(server))
+        self.assertEqual(sorted(server.requests), ['PATCH /Users/u2', 'POST /Bulk'])
+        self.assertEqual(errors, {'unknown': '404 User not found'})
+        self.assertEqual(server.names['u2'], 'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import random
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from typing import Optional
+from unittest import mock
+
+from httpx import Response
+
+from src.services.swit_api_client import _RateGovernor, _get_backoff, _parse_rate_limit_reset, _parse_retry_after
+
+
+class RateGovernorTestCase(unittest.TestCase):
+    def test_additive_increase(self) -> None:
+        governor = _RateGovernor(initial_rate=2.0, max_rate=2.25, additive_increase=0.1)
+        rates = []
+        for _ in range(3):
+            governor.on_success(Response(200))
+            rates.append(governor.rate)
+        self.assertEqual([round(rate, 2) for rate in rates], [2.1, 2.2, 2.25])
+
+    def test_multiplicative_decrease(self) -> None:
+        governor = _RateGovernor(initial_rate=4.0, max_rate=4.0, min_rate=0.75, multiplicative_decrease=0.5)
+        rates = []
+        for _ in range(3):
+            governor.on_throttled(0.0)
+            rates.append(governor.rate)
+        self.assertEqual(rates, [2.0, 1.0, 0.75])
+
+    def test_pacing(self) -> None:
+        governor = _RateGovernor(initial_rate=4.0, max_rate=4.0)
+        delays = [governor.reserve() for _ in range(3)]
+        for delay, expected_delay in zip(delays, [0.0, 0.25, 0.5]):
+            self.assertAlmostEqual(delay, expected_delay, delta=0.05)
+
+    def test_pause(self) -> None:
+        for case, pause in (
+                ('Retry-After', lambda governor: governor.on_throttled(3.0)),
+                ('exhausted budget', lambda governor: governor.on_success(Response(200, headers={
+                    'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '3'})))):
+            with self.subTest(case):
+                governor = _RateGovernor(initial_rate=100.0, max_rate=100.0)
+                pause(governor)
+                self.assertAlmostEqual(governor.reserve(), 3.0, delta=0.05)
+
+    def test_no_pause_with_budget_left(self) -> None:
+        governor = _RateGovernor(initial_rate=100.0, max_rate=100.0)
+        governor.on_success(Response(200, headers={'x-ratelimit-remaining': '1', 'x-ratelimit-reset': '3'}))
+        self.assertAlmostEqual(governor.reserve(), 0.0, delta=0.05)
+
+
+class HeaderParsingTestCase(unittest.TestCase):
+    def test_retry_after(self) -> None:
+        in_10_seconds = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=10), usegmt=True)
+        cases: list[tuple[str, dict[str, str], Optional[float]]] = [
+            ('seconds', {'retry-after': '3'}, 3.0),
+            ('fractional seconds', {'retry-after': '0.5'}, 0.5),
+            ('negative seconds', {'retry-after': '-1'}, 0.0),
+            ('HTTP date', {'retry-after': in_10_seconds}, 10.0),
+            ('past HTTP date', {'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'}, 0.0),
+            ('X-Retry-After', {'x-retry-after': '2'}, 2.0),
+            ('garbage', {'retry-after': 'soon'}, None),
+            ('missing', {}, None),
+        ]
+        for case, headers, expected in cases:
+            with self.subTest(case):
+                retry_after = _parse_retry_after(Response(429, headers=headers))
+                if expected is None:
+                    self.assertIsNone(retry_after)
+                else:
+                    assert retry_after is not None
+                    self.assertAlmostEqual(retry_after, expected, delta=1.0)
+
+    def test_rate_limit_reset(self) -> None:
+        now = time.time()
+        cases: list[tuple[str, Optional[str], Optional[float]]] = [
+            ('seconds', '30', 30.0),
+            ('a day in seconds', '86400', 86400.0),
+            ('epoch timestamp', str(int(now) + 30), 30.0),
+            ('past epoch timestamp', str(int(now) - 30), 0.0),
+            ('HTTP date', 'Wed, 21 Oct 2015 07:28:00 GMT', None),
+            ('garbage', 'soon', None),
+            ('missing', None, None),
+        ]
+        for case, value, expected in cases:
+            with self.subTest(case):
+                reset = _parse_rate_limit_reset(value)
+                if expected is None:
+                    self.assertIsNone(reset)
+                else:
+                    assert reset is not None
+                    self.assertAlmostEqual(reset, expected, delta=1.0)
+
+    def test_backoff(self) -> None:
+        # Full jitter: a uniform delay up to the exponential cap
+        with mock.patch.object(random, 'uniform', side_effect=lambda low, high: (low, high)):
+            self.assertEqual([_get_backoff(attempt) for attempt in range(8)],
+                             [(0, 0.5), (0, 1.0), (0, 2.0), (0, 4.0), (0, 8.0), (0, 16.0), (0, 30.0), (0, 30.0)])
+        for attempt in range(8):
+            self.assertTrue(0 <= _get_backoff(attempt) <= 30.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
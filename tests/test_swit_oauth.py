@@ -0,0 +1,77 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+from unittest import mock
+from urllib.parse import parse_qs
+
+from httpx import Client, MockTransport, Request, Response
+
+from src.services import swit_oauth
+from src.services.swit_oauth import _TokenManager
+from src.services.swit_schemas import SwitTokens
+
+_THREAD_COUNT = 8
+
+
+class TokenManagerTestCase(unittest.TestCase):
+    """Refreshes the tokens against a stand-in of the OAuth server, which is slow to answer"""
+    def setUp(self) -> None:
+        self.refresh_tokens: list[str] = []
+        self._lock = threading.Lock()
+        http_client = mock.patch.object(swit_oauth, 'http_client', Client(transport=MockTransport(self._refresh)))
+        http_client.start()
+        self.addCleanup(http_client.stop)
+        # The tokens aren't stored
+        upsert_service_account = mock.patch.object(swit_oauth, 'upsert_service_account')
+        upsert_service_account.start()
+        self.addCleanup(upsert_service_account.stop)
+
+    def test_single_flight_refresh_of_expired_token(self) -> None:
+        token_manager = self._get_token_manager(expires_at=datetime.now(timezone.utc) - timedelta(seconds=1))
+        access_tokens = self._call_at_once(token_manager.get_access_token)
+        self.assertEqual(self.refresh_tokens, ['refresh-0'])
+        self.assertEqual(access_tokens, ['access-1'] * _THREAD_COUNT)
+
+    def test_single_flight_refresh_after_401(self) -> None:
+        token_manager = self._get_token_manager(expires_at=None)
+        self._call_at_once(lambda: token_manager.refresh('access-0'))
+        self.assertEqual(self.refresh_tokens, ['refresh-0'])
+        self.assertEqual(token_manager.get_access_token(), 'access-1')
+
+    @staticmethod
+    def _get_token_manager(expires_at: Optional[datetime]) -> _TokenManager:
+        token_manager = _TokenManager()
+        token_manager.set_tokens(SwitTokens(access_token='access-0', refresh_token='refresh-0', expires_at=expires_at))
+        return token_manager
+
+    @staticmethod
+    def _call_at_once(call: Callable[[], object]) -> list[object]:
+        barrier = threading.Barrier(_THREAD_COUNT)
+
+        def call_after_barrier() -> object:
+            barrier.wait()
+            return call()
+
+        with ThreadPoolExecutor(max_workers=_THREAD_COUNT) as pool:
+            futures = [pool.submit(call_after_barrier) for _ in range(_THREAD_COUNT)]
+            return [future.result() for future in futures]
+
+    def _refresh(self, request: Request) -> Response:
+        refresh_token = parse_qs(request.content.decode())['refresh_token'][0]
+        with self._lock:
+            self.refresh_tokens.append(refresh_token)
+            count = len(self.refresh_tokens)
+        # Every other caller arrives while the refresh is in flight
+        time.sleep(0.05)
+        return Response(200, json={
+            'access_token': f'access-{count}',
+            'refresh_token': f'refresh-{count}',
+            'expires_in': 3600
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
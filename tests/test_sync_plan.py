@@ -0,0 +1,90 @@
+import unittest
+from typing import Optional
+from unittest import mock
+
+from src import database
+from src.database import close_db, init_db
+from src.services.applied_state import AppliedState
+from src.services.idp_data import IdpSnapshot, IdpTeam
+from src.services.swit_api_client import SwitApiClient
+from src.services.swit_schemas import SwitTeam
+from src.services.swit_snapshot import SwitSnapshot, TeamDirectory
+from src.services.sync_plan import SyncPlan, TeamCreation, _find_cyclic_teams, plan_sync
+
+_ROOT_TEAM_ID = 'root'
+
+
+def _dn(name: str) -> str:
+    return f'CN={name},OU=Groups,DC=example,DC=com'
+
+
+def _idp_team(name: str, parent_name: Optional[str] = None) -> IdpTeam:
+    return IdpTeam(ref_id=_dn(name), name=name, parent_ref_id=_dn(parent_name) if parent_name else None, users=[])
+
+
+class _SwitSnapshot(SwitSnapshot):
+    """Holds the given teams, and no users, instead of listing them"""
+    def __init__(self, teams: list[SwitTeam]) -> None:
+        self.api_client = mock.Mock(spec=SwitApiClient)
+        super().__init__(self.api_client)
+        self._users_by_email = {}
+        self._teams = TeamDirectory(_ROOT_TEAM_ID, teams)
+
+
+class SyncPlanTestCase(unittest.TestCase):
+    """Plans the teams of a small IdP against a small Swit organization"""
+    def setUp(self) -> None:
+        # The last-applied state is empty, so that every team is compared against Swit
+        db_name = mock.patch.object(database, '_DB_NAME', ':memory:')
+        db_name.start()
+        self.addCleanup(db_name.stop)
+        close_db()
+        self.addCleanup(close_db)
+        init_db()
+
+    def test_creation_levels(self) -> None:
+        # Children come before their parents in the IdP
+        plan = self._plan([_idp_team('C', 'B'), _idp_team('B', 'A'), _idp_team('A'),
+                           _idp_team('D'), _idp_team('E', 'D')],
+                          [SwitTeam(id='d', name='D', parent_id=_ROOT_TEAM_ID, ref_id=_dn('D'))])
+        self.assertEqual(sorted(plan.team_creations, key=lambda team_creation: team_creation.level), [
+            TeamCreation(ref_id=_dn('A'), name='A', parent_id=_ROOT_TEAM_ID, level=0),
+            TeamCreation(ref_id=_dn('E'), name='E', parent_id='d', level=0),
+            TeamCreation(ref_id=_dn('B'), name='B', parent_ref_id=_dn('A'), level=1),
+            TeamCreation(ref_id=_dn('C'), name='C', parent_ref_id=_dn('B'), level=2),
+        ])
+        self.assertEqual(plan.team_updates, [])
+        self.assertEqual(plan.warnings, [])
+
+    def test_cyclic_teams(self) -> None:
+        idp_teams = [_idp_team('X', 'Y'), _idp_team('Y', 'X'), _idp_team('Z', 'X')]
+        self.assertEqual(_find_cyclic_teams(idp_teams), {_dn('X'), _dn('Y')})
+        plan = self._plan(idp_teams, [])
+        # The cycle is broken by placing its teams under the root team
+        self.assertEqual(plan.team_creations, [
+            TeamCreation(ref_id=_dn('X'), name='X', parent_id=_ROOT_TEAM_ID, level=0),
+            TeamCreation(ref_id=_dn('Y'), name='Y', parent_id=_ROOT_TEAM_ID, level=0),
+            TeamCreation(ref_id=_dn('Z'), name='Z', parent_ref_id=_dn('X'), level=1),
+        ])
+        self.assertEqual(len(plan.warnings), 1)
+        self.assertIn('Cyclic team hierarchy', plan.warnings[0])
+
+    def test_dangling_parent(self) -> None:
+        # The parent is neither in the IdP nor on Swit
+        plan = self._plan([_idp_team('Orphan', 'Missing')], [])
+        self.assertEqual(plan.team_creations, [
+            TeamCreation(ref_id=_dn('Orphan'), name='Orphan', parent_id=_ROOT_TEAM_ID, level=0),
+        ])
+        self.assertEqual(plan.warnings,
+                         ["Parent teams not found. These teams are created under the root team: ['Orphan']"])
+
+    def _plan(self, idp_teams: list[IdpTeam], swit_teams: list[SwitTeam]) -> SyncPlan:
+        swit = _SwitSnapshot(swit_teams)
+        plan = plan_sync(IdpSnapshot([], idp_teams), swit, AppliedState(is_idp_full_scan=True))
+        self.assertEqual(swit.api_client.method_calls, [])
+        self.assertEqual(plan.team_deletions, [])
+        return plan
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.core.constants import settings
+from src.services.sync_report import SyncReport
+
+_OLD_REPORT_NAMES = ['20240101T000000Z.jsonl', '20240102T000000Z.jsonl', '20240103T000000Z.jsonl']
+
+
+class SyncReportRetentionTestCase(unittest.TestCase):
+    """Records a change of a new run into a directory holding the reports of older runs"""
+    def setUp(self) -> None:
+        report_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(report_dir.cleanup)
+        self.report_dir = report_dir.name
+        for name in [*_OLD_REPORT_NAMES, 'notes.txt']:
+            open(os.path.join(self.report_dir, name), 'w').close()
+        setting = mock.patch.object(settings, 'SYNC_REPORT_DIR', self.report_dir)
+        setting.start()
+        self.addCleanup(setting.stop)
+
+    def test_retention(self) -> None:
+        detail_name = self._record_change(retention_count=2)
+        # The new report counts towards the retention, and files that aren't reports are left alone
+        self.assertEqual(sorted(os.listdir(self.report_dir)), [_OLD_REPORT_NAMES[2], detail_name, 'notes.txt'])
+
+    def test_unlimited_retention(self) -> None:
+        detail_name = self._record_change(retention_count=0)
+        self.assertEqual(sorted(os.listdir(self.report_dir)), [*_OLD_REPORT_NAMES, detail_name, 'notes.txt'])
+
+    def test_no_changes(self) -> None:
+        # Runs without changes create no report, and so remove none
+        with mock.patch.object(settings, 'SYNC_REPORT_RETENTION_COUNT', 1):
+            SyncReport().close()
+        self.assertEqual(len(os.listdir(self.report_dir)), len(_OLD_REPORT_NAMES) + 1)
+
+    @staticmethod
+    def _record_change(retention_count: int) -> str:
+        with mock.patch.object(settings, 'SYNC_REPORT_RETENTION_COUNT', retention_count):
+            report = SyncReport()
+            report.record('user.update', 'alice')
+            report.close()
+        assert report.detail_path is not None
+        return os.path.basename(report.detail_path)
+
+
+if __name__ == '__main__':
+    unittest.main()